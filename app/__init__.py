@@ -12,6 +12,9 @@ from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
 from redis import Redis
 import rq
+from app.cache import Cache
+from app.mailer import MailPool
+from app.search import create_backend as create_search_backend
 
 
 db = SQLAlchemy()
@@ -26,7 +29,7 @@ babel = Babel()
 
 def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     # app.redis = Redis()
@@ -36,6 +39,7 @@ def create_app(config_class=Config):
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
+    app.mail_pool = MailPool(app, mail)
     moment.init_app(app)
     babel.init_app(app)
 
@@ -53,6 +57,14 @@ def create_app(config_class=Config):
 
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.search_backend = create_search_backend(app)
+    app.search_cache = Cache('search', app.config['SEARCH_CACHE_SIZE'],
+                             app.config['SEARCH_CACHE_TTL']) \
+        if app.config['SEARCH_CACHE'] else None
+    app.translation_cache = Cache(
+        'translate', app.config['TRANSLATION_CACHE_SIZE'],
+        app.config['TRANSLATION_CACHE_TTL']) \
+        if app.config['TRANSLATION_CACHE'] else None
 
     if not app.debug and not app.testing:
         # email error logs:
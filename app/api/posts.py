@@ -0,0 +1,69 @@
+'''
+Post API routes:
+
+HTTP    Resource URL                  Notes
+POST    /api/posts                    Create posts, many at a time.
+'''
+
+from flask import current_app, g, jsonify, request
+from app import db
+from app.api import bp
+from app.api.errors import bad_request
+from app.api.tokens import token_auth
+from app.language import post_language
+from app.models import Post
+
+
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    data = request.get_json() or {}
+    items = data.get('posts')
+    if not isinstance(items, list) or not items:
+        return bad_request('must include a list of posts')
+    if len(items) > current_app.config['API_BULK_SIZE']:
+        return bad_request('at most {} posts at a time'.format(
+            current_app.config['API_BULK_SIZE']))
+    results, posts = [], []
+    for item in items:
+        body = item.get('body') if isinstance(item, dict) else None
+        if not isinstance(body, str) or not body.strip():
+            results.append({'status': 400, 'message': 'must include a body'})
+        elif len(body) > 300:
+            results.append({'status': 400,
+                            'message': 'body must be at most 300 characters'})
+        else:
+            results.append(None)
+            posts.append((body, post_language(body)))
+    ids = iter(Post.bulk_create(g.current_user, posts) if posts else [])
+    db.session.commit()
+    return jsonify({'results': [
+        result or {'status': 201, 'id': next(ids)} for result in results]})
+
+
+# Bulk creation
+# -----------------------------------------------------------------------------
+# A client importing a few thousand posts used to need... a few thousand
+# requests (and there was no API for posts at all). POST /api/posts takes up to
+# API_BULK_SIZE of them at once, as the posts of the user the token belongs
+# to:
+
+# $ http POST http://localhost:5000/api/posts "Authorization:Bearer <token>" posts:='[{"body": "Hello"}, {"body": ""}]'
+
+# The valid ones are inserted by Post.bulk_create() with multi-row INSERTs
+# (200 posts each) and committed together, and the response has one result
+# per post, in the same order, each with its own status:
+
+# {"results": [{"status": 201, "id": 57}, {"status": 400, "message": "must include a body"}]}
+
+# Rows inserted this way don't go through the session, so none of the events
+# that normally follow a new post fire. bulk_create() does their work itself:
+# it adds to the author's post_count with one UPDATE, and once the transaction
+# commits it indexes the posts for search, pushes them to the followers'
+# timelines, and queues language detection or pre-translation where needed.
+
+# The ids of the new posts come from the INSERT itself: PostgreSQL returns
+# them (RETURNING), and with SQLite the rows of one statement get consecutive
+# ids that end at the one cursor.lastrowid reports. Reading them back
+# afterwards (by author and timestamp, say) could pick up posts that another
+# request inserted at the same moment.
@@ -4,24 +4,143 @@ User API routes:
 HTTP    Resource URL                  Notes
 GET     /api/users/<id> 	          Return a user.
 GET 	/api/users 	                  Return the collection of all users.
+                                      (?limit=&cursor= for the next page,
+                                      ?format=ndjson to stream all of them)
 GET 	/api/users/<id>/followers 	  Return the followers of this user.
 GET 	/api/users/<id>/followed 	  Return the users this user is following.
+GET     /api/users?ids=1,2,3          Return the users with the given ids.
+POST    /api/users/<id>/following     Follow users (many at a time).
 POST 	/api/users 	                  Register a new user account.
 PUT 	/api/users/<id> 	          Modify a user.
+
+All the GETs take ?fields=username,about_me,... to return only those fields
+(and the id).
 '''
 
-from flask import jsonify, request, url_for
+import hashlib
+import json
+from flask import Response, current_app, g, jsonify, request, \
+    stream_with_context, url_for
 from app import db
 from app.api import bp
 from app.api.errors import bad_request
 from app.api.tokens import token_auth
 from app.models import User
+from app.pagination import decode_key
+
+
+def _fields():
+    '''Reads the fields the client wants (?fields=username,about_me) from the
+    query string. Returns None for all of them.'''
+    if not request.args.get('fields'):
+        return None
+    fields = set(request.args['fields'].split(',')) - {'id'}
+    unknown = fields - set(User.api_fields)
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+    return fields
+
+
+def _load_fields(query, fields):
+    # only read the columns that the fields need (and the ETag)
+    if fields is None:
+        return query
+    return query.options(db.load_only('version', 'updated', 'last_seen', *[
+        column for field in fields for column in User.api_fields[field]]))
+
+
+def _validators(users, *extra):
+    '''Returns the ETag and Last-Modified time of a response made of users,
+    from their versions and last_seen times, and anything else that changes
+    the response (the query string, the total...).'''
+    etag = hashlib.sha1(json.dumps(
+        [request.full_path] + [[user.id, user.version, str(user.last_seen)]
+                               for user in users] + list(extra),
+        default=str).encode('utf-8')).hexdigest()
+    times = [t for user in users for t in (user.updated, user.last_seen) if t]
+    return etag, max(times) if times else None
+
+
+def _not_modified(etag, last_modified):
+    '''Returns a 304 response if the client's copy is still current, going
+    by If-None-Match, or If-Modified-Since when there is no If-None-Match.'''
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    else:
+        fresh = False
+    if fresh:
+        return _conditional(Response(status=304), etag, last_modified)
+
+
+def _conditional(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def _collection(query, endpoint, total, owner=None, **kwargs):
+    '''Returns a page of users from query as JSON, or all of them as
+    newline-delimited JSON, streamed as they are read. total is a function
+    that returns the size of the collection, only called for a page. owner
+    is the user the collection belongs to, if any.'''
+    try:
+        fields = _fields()
+    except ValueError as e:
+        return bad_request(str(e))
+    query = _load_fields(query, fields)
+    if request.args.get('format') == 'ndjson' or \
+            request.accept_mimetypes.best == 'application/x-ndjson':
+        def generate():
+            for user in User.iter_collection(
+                    query, current_app.config['API_STREAM_BATCH_SIZE']):
+                yield json.dumps(user.to_dict(fields=fields)) + '\n'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'],
+                             type=int)
+    if limit < 1:
+        return bad_request('limit must be a positive number')
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_key(request.args['cursor'])
+        except ValueError:
+            return bad_request('invalid cursor')
+        if len(after) != 1 or not isinstance(after[0], int):
+            return bad_request('invalid cursor')
+        after = after[0]
+    limit = min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+    page = User.collection_page(query, limit, after)
+    # part of the ETag, since the page shows it
+    total = total()
+    etag, last_modified = _validators(
+        page[0] + ([owner] if owner else []), total)
+    response = _not_modified(etag, last_modified)
+    if response:
+        return response
+    return _conditional(jsonify(User.to_collection_dict(
+        query, endpoint, limit, after, total, fields, page, **kwargs)),
+        etag, last_modified)
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    try:
+        fields = _fields()
+    except ValueError as e:
+        return bad_request(str(e))
+    user = User.query.get_or_404(id)
+    etag, last_modified = _validators([user])
+    response = _not_modified(etag, last_modified)
+    if response:
+        return response
+    return _conditional(jsonify(user.to_dict(fields=fields)), etag,
+                        last_modified)
     # get_or_404() returns the object with the given id if it exists, but
     # instead of returning None when the id does not exist, it aborts the
     # request and returns a 404 error to the client. The advantage of
@@ -29,27 +148,89 @@ def get_user(id):
     # result of the query, simplifying the logic in view functions.
 
 
+def _lookup(ids):
+    '''Returns the users with the given ids, in that order, with one query,
+    and the ids that don't exist.'''
+    try:
+        fields = _fields()
+    except ValueError as e:
+        return bad_request(str(e))
+    try:
+        ids = [int(id) for id in ids.split(',')]
+    except ValueError:
+        return bad_request('ids must be a comma separated list of numbers')
+    if len(ids) > current_app.config['API_MAX_PAGE_SIZE']:
+        return bad_request('at most {} ids at a time'.format(
+            current_app.config['API_MAX_PAGE_SIZE']))
+    found = {user.id: user for user in _load_fields(
+        User.query.filter(User.id.in_(ids)), fields)}
+    users = [found[id] for id in ids if id in found]
+    etag, last_modified = _validators(users)
+    response = _not_modified(etag, last_modified)
+    if response:
+        return response
+    return _conditional(jsonify({
+        'items': [user.to_dict(fields=fields) for user in users],
+        '_meta': {'missing': [id for id in ids if id not in found]}}),
+        etag, last_modified)
+
+
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    data = User.to_collection_dict(User.query)
-    return jsonify(data)
+    if request.args.get('ids'):
+        return _lookup(request.args['ids'])
+    return _collection(User.query, 'api.get_users', User.query.count)
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    data = User.to_collection_dict(user.followers)
-    return jsonify(data)
+    return _collection(user.followers, 'api.get_followers',
+                       lambda: user.follower_count, user, id=id)
 
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
 def get_following(id):
     user = User.query.get_or_404(id)
-    data = User.to_collection_dict(user.following)
-    return jsonify(data)
+    return _collection(user.following, 'api.get_following',
+                       lambda: user.following_count, user, id=id)
+
+
+@bp.route('/users/<int:id>/following', methods=['POST'])
+@token_auth.login_required
+def follow_users(id):
+    user = User.query.get_or_404(id)
+    if g.current_user != user:
+        return bad_request('you can only follow users as yourself')
+    data = request.get_json() or {}
+    ids = data.get('user_ids')
+    # type() rather than isinstance(), which would let true and false through
+    if not isinstance(ids, list) or not ids or \
+            any(type(id) is not int for id in ids):
+        return bad_request('must include a list of user_ids')
+    if len(ids) > current_app.config['API_BULK_SIZE']:
+        return bad_request('at most {} users at a time'.format(
+            current_app.config['API_BULK_SIZE']))
+    found = {u.id: u for u in User.query.filter(User.id.in_(ids))}
+    followed = {u.id for u in user.follow_many(list(found.values()))}
+    db.session.commit()
+    results = []
+    for id in ids:
+        if id not in found:
+            results.append({'status': 404, 'message': 'no such user'})
+        elif id == user.id:
+            results.append({'status': 400,
+                            'message': "you can't follow yourself"})
+        elif id in followed:
+            # an id given twice is already followed the second time
+            followed.discard(id)
+            results.append({'status': 201})
+        else:
+            results.append({'status': 200, 'message': 'already following'})
+    return jsonify({'results': results})
 
 
 @bp.route('/users', methods=['POST'])
@@ -117,6 +298,87 @@ def update_user(id):
 # $ http DELETE http://localhost:5000/api/tokens "Authorization:Bearer <token>"
 
 
+# Paginated and streamed collections
+# -----------------------------------------------------------------------------
+# The collections used to be read with query.all() and returned in one
+# response, so the memory (and time) a request took grew with the number of
+# users. Now they come a page at a time, API_PAGE_SIZE users by default (up
+# to API_MAX_PAGE_SIZE with ?limit=), ordered by id:
+
+# {
+#     "items": [...],
+#     "_meta": {"limit": 100, "next_cursor": "WzEwMF0=", "total_items": 2500},
+#     "_links": {
+#         "self": "/api/users?limit=100",
+#         "next": "/api/users?limit=100&cursor=WzEwMF0="
+#     }
+# }
+
+# The cursor is the id of the last user of the page, and the next page is
+# WHERE id > :id ORDER BY id LIMIT :limit, which costs the same however deep
+# it is (see app/pagination.py). Clients follow _links.next until it is null.
+
+# Clients that want the whole collection can ask for it as newline-delimited
+# JSON instead, with ?format=ndjson or an Accept: application/x-ndjson header.
+# It is read API_STREAM_BATCH_SIZE users at a time and written out as it is
+# read, one user per line, so the server never holds more than one batch:
+
+# $ http --stream GET http://localhost:5000/api/users?format=ndjson "Authorization:Bearer <token>"
+
+# Clients that only need some of the fields of each user can list them in
+# ?fields=, for example ?fields=username to get just the ids and usernames.
+# The fields that are left out are not computed at all (the avatar URL is an
+# MD5 hash, the links are four url_for() calls), and the query for the page
+# only reads the columns the requested fields need (load_only()). The
+# counters are columns of the user table, so asking for them doesn't add any
+# queries, whatever the size of the page.
+
+
+# Batches
+# -----------------------------------------------------------------------------
+# Clients syncing many users used to ask for them one request at a time.
+# GET /api/users?ids=1,2,3 returns up to API_MAX_PAGE_SIZE of them with one
+# query, in the order asked for, and lists the ids that don't exist in
+# _meta.missing. It takes ?fields= and conditional requests like the rest.
+
+# POST /api/users/<id>/following follows up to API_BULK_SIZE users at once, as
+# the user the token belongs to:
+
+# $ http POST http://localhost:5000/api/users/1/following "Authorization:Bearer <token>" user_ids:='[2, 3, 99]'
+
+# The new follows are one multi-row INSERT into the followers table
+# (User.follow_many()), the counters of all the users involved are updated
+# with two UPDATEs, and everything is committed together. The follower's
+# cached timeline gets the recent posts of all the (push) authors from one
+# more query, whatever the number of users. The response has a result for
+# each id, in order: 201 followed, 200 already following, 404 no such user, or
+# 400 for yourself. For creating posts in bulk, see app/api/posts.py.
+
+
+# Conditional requests
+# -----------------------------------------------------------------------------
+# Clients that poll a user, or a list of followers, mostly get back exactly
+# what they got the last time. Each response now has an ETag and a
+# Last-Modified header, and a client that sends the ETag back in
+# If-None-Match (or the time in If-Modified-Since) gets an empty 304 Not
+# Modified response if nothing changed, without to_dict() being called.
+
+# The ETag is a hash of the users in the response, each as (id, version,
+# last_seen), plus the query string and the total. User.version is bumped in
+# the same UPDATE as the counters (add_to_counter()), so by every post and
+# every follow or unfollow, and by User.before_flush() when the username,
+# email or about_me change. last_seen changes far too often to bump the
+# version for it, so it goes into the hash by itself. A list changes its ETag
+# when any user in the page changes, when users are added or removed, and
+# (through the version of the user it belongs to, or the total for
+# /api/users) when the total does. The rows of the page are loaded once, and
+# serialized only if the ETag didn't match. The total of /api/users is a
+# COUNT(*), so _collection() only runs it for a page, where the ETag needs
+# it, and never for the streamed form, which has no ETag.
+
+# $ http GET http://localhost:5000/api/users/1 "Authorization:Bearer <token>" 'If-None-Match:"<etag>"'
+
+
 # zebro.id api request examples
 # -----------------------------------------------------------------------------
 
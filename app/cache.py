@@ -0,0 +1,196 @@
+from collections import OrderedDict
+import json
+import threading
+from time import sleep, time
+from flask import current_app
+import redis
+
+
+class LRU():
+    '''A small least-recently-used dictionary with expiring entries, safe to
+    share between the threads of a process.'''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+class Cache():
+    '''Caches JSON-serializable values in an in-process LRU, in front of
+    Redis keys that expire after ttl seconds. Counts hits and misses.'''
+    def __init__(self, name, size, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.local = LRU(size, ttl)
+        # counted here and added to Redis with the next command we send, so
+        # a local hit doesn't cost a round trip
+        self._counts = {}
+        self._lock = threading.Lock()
+        # keys being computed by a thread of this process
+        self._flights = {}
+
+    def _key(self, key):
+        return 'cache:{}:{}'.format(self.name, key)
+
+    def _count(self, outcome):
+        with self._lock:
+            self._counts[outcome] = self._counts.get(outcome, 0) + 1
+
+    def _send_counts(self, pipe):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        for outcome, count in counts.items():
+            pipe.hincrby(self._key('stats'), outcome, count)
+
+    def get(self, key):
+        '''Returns the cached value, or None.'''
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            pipe.get(self._key(key))
+            self._send_counts(pipe)
+            value = pipe.execute()[0]
+        except redis.exceptions.RedisError:
+            return None
+        if value is None:
+            self._count('misses')
+            return None
+        self._count('redis_hits')
+        value = json.loads(value.decode('utf-8'))
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            pipe.set(self._key(key), json.dumps(value), ex=self.ttl)
+            self._send_counts(pipe)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Could not write to the %s cache',
+                                       self.name, exc_info=True)
+
+    def fetch(self, key, compute, wait=10):
+        '''Returns the cached value, or the result of compute(), which is
+        cached unless it is None. While one caller (in any process) computes
+        a key, others asking for the same key wait for its result for up to
+        wait seconds, instead of computing it again.'''
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+        if not leader:
+            self._count('coalesced')
+            flight.wait(wait)
+            value = self.local.get(key)
+            return value if value is not None else compute()
+        try:
+            return self._compute_once(key, compute, wait)
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    def _compute_once(self, key, compute, wait):
+        lock = self._key(key) + ':lock'
+        try:
+            locked = current_app.redis.set(lock, 1, nx=True, ex=wait)
+        except redis.exceptions.RedisError:
+            locked = True  # no Redis, no other processes to wait for
+        if not locked:
+            # another process is computing it, poll for its result
+            self._count('coalesced')
+            deadline = time() + wait
+            while time() < deadline:
+                sleep(0.05)
+                try:
+                    value = current_app.redis.get(self._key(key))
+                except redis.exceptions.RedisError:
+                    break
+                if value is not None:
+                    value = json.loads(value.decode('utf-8'))
+                    self.local.set(key, value)
+                    return value
+        try:
+            value = compute()
+            if value is not None:
+                self.set(key, value)
+            return value
+        finally:
+            if locked:
+                try:
+                    current_app.redis.delete(lock)
+                except redis.exceptions.RedisError:
+                    pass
+
+    def stats(self):
+        '''Returns the hit and miss counts of all processes, the hit ratio,
+        and how many callers waited for another one's result.'''
+        pipe = current_app.redis.pipeline(transaction=False)
+        self._send_counts(pipe)
+        pipe.hgetall(self._key('stats'))
+        counts = {k.decode('utf-8'): int(v) for k, v in pipe.execute()[-1].items()}
+        stats = {outcome: counts.get(outcome, 0)
+                 for outcome in ('local_hits', 'redis_hits', 'misses')}
+        total = sum(stats.values())
+        stats['hit_ratio'] = (total - stats['misses']) / total if total else 0.0
+        stats['coalesced'] = counts.get('coalesced', 0)
+        return stats
+
+
+# Two-tier cache
+# -----------------------------------------------------------------------------
+# Cache keeps values in two places. Redis is shared by every web process (and
+# survives restarts), and the entries there expire on their own after ttl
+# seconds. In front of it each process keeps the most recently used entries in
+# a plain dictionary (LRU), so the most popular keys are answered without
+# leaving the process at all. A value found in Redis is copied into the local
+# LRU on the way out.
+
+# The local copy can't be invalidated from other processes, so this only suits
+# values that never go stale, or keys that change when the data does (the
+# search cache puts a generation number in its keys, see app/search.py). The
+# local entries also expire after ttl seconds.
+
+# Hits (local or Redis) and misses are counted in the cache:<name>:stats hash
+# in Redis, added up across all processes. To keep a local hit free, the
+# counts are kept in the process and sent along with the next command that
+# goes to Redis anyway. If Redis is down every lookup is a miss, and the
+# caller does the work as if there were no cache.
+
+# fetch() adds single-flight on top, for values that are expensive to compute
+# (a call to a paid API, for example). The first caller to miss a key takes a
+# Redis lock on it (SET NX with a timeout) and computes it, and any caller that
+# asks for the same key meanwhile waits for that result: threads of the same
+# process on an Event, other processes by polling the cache key. So a post that
+# a hundred people ask to translate at the same moment costs one upstream call.
+# If the first caller fails (compute() returns None), nothing is cached and
+# the waiting callers try for themselves.
@@ -1,13 +1,215 @@
+from multiprocessing import Pool
 import os
+from time import time
 import click
+from flask import current_app
+from app import create_app, db, outbox
+from app.language import detect as detect_language
+from app.models import Post, SearchableMixin, User
+
+
+def _searchable():
+    return {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+
+
+def _init_reindex_worker():
+    # each worker process gets its own app, and with it its own connections
+    create_app().app_context().push()
+
+
+def _reindex_shard(args):
+    name, min_id, max_id, batch_size = args
+    rows = []
+    indexed = _searchable()[name].reindex(batch_size, min_id, max_id,
+                                          progress=rows.append)
+    return sum(rows), indexed
+
+
+class _Progress():
+    '''Prints how far along a long job is, at most once a second.'''
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = self.last = time()
+
+    def __call__(self, count):
+        self.done += count
+        if time() - self.last >= 1 or self.done >= self.total:
+            self.last = time()
+            click.echo('{}: {}/{} ({:.0%}), {:.0f} rows/s'.format(
+                self.name, self.done, self.total,
+                self.done / max(self.total, 1),
+                self.done / max(self.last - self.start, 0.001)))
 
 
 def register(app):
+    @app.cli.group()
+    def timeline():
+        '''Home timeline cache commands'''
+        pass
+
+    @timeline.command()
+    @click.option('--username', default=None,
+                  help='Only rebuild the timeline of this user.')
+    def rebuild(username):
+        '''Rebuild the Redis home timelines from the database.'''
+        users = User.query
+        if username:
+            users = users.filter_by(username=username)
+        count = 0
+        for user in users.yield_per(100):
+            user.rebuild_timeline()
+            count += 1
+        click.echo('Rebuilt {} timeline(s).'.format(count))
+
+    @app.cli.command('flush-last-seen')
+    def flush_last_seen():
+        '''Write the buffered last_seen times to the database.'''
+        click.echo('Updated {} user(s).'.format(User.flush_last_seen()))
+
+    @app.cli.group()
+    def counters():
+        '''User counter column commands'''
+        pass
+
+    @counters.command()
+    @click.option('--repair', is_flag=True,
+                  help='Recount the users whose counters have drifted.')
+    @click.option('--batch-size', default=1000)
+    def check(repair, batch_size):
+        '''Compare the post/follower/following counters with the real counts.'''
+        drifted = set()
+        for user, name, stored, actual in User.counter_drift(batch_size):
+            click.echo('{} {}: {} (should be {})'.format(
+                user.username, name, stored, actual))
+            drifted.add(user.id)
+        if drifted and repair:
+            drifted = list(drifted)
+            for i in range(0, len(drifted), batch_size):
+                User.repair_counters(drifted[i:i + batch_size])
+            db.session.commit()
+            click.echo('Repaired {} user(s).'.format(len(drifted)))
+        elif not drifted:
+            click.echo('All counters are correct.')
+
+    @app.cli.group()
+    def language():
+        '''Post language detection commands'''
+        pass
+
+    @language.command()
+    @click.option('--batch-size', default=1000)
+    def detect(batch_size):
+        '''Detect the language of the posts that don't have one yet.'''
+        count = 0
+        while True:
+            posts = Post.query.filter(Post.language.is_(None)).order_by(
+                Post.id).limit(batch_size).all()
+            if not posts:
+                break
+            for post in posts:
+                post.language = detect_language(post.body)
+            db.session.commit()
+            count += len(posts)
+        click.echo('Detected the language of {} post(s).'.format(count))
+
+    @app.cli.group()
+    def mail():
+        '''Email commands'''
+        pass
+
+    @mail.command('stats')
+    def mail_stats():
+        '''Show how many emails were sent, how long they took and how many
+        are waiting.'''
+        stats = current_app.mail_pool.stats()
+        click.echo('Sent: {sent} ({failed} failed, {overflow} sent inline '
+                   'because the queue was full)'.format(**stats))
+        click.echo('Queued: {queue_depth}'.format(**stats))
+        click.echo('Latency: {latency_ms:.1f} ms (of which sending: '
+                   '{send_ms:.1f} ms)'.format(**stats))
+
+    @mail.command('outbox')
+    def mail_outbox():
+        '''Queue the outbox emails that are due for another attempt, and the
+        digests that are due.'''
+        emails, digests = outbox.sweep()
+        click.echo('Queued {} email(s) and {} digest(s).'.format(
+            emails, digests))
+
+    @app.cli.group()
+    def search():
+        '''Search index commands'''
+        pass
+
+    @search.command()
+    @click.option('--model', type=click.Choice(sorted(_searchable())),
+                  default=None, help='Only reindex this table.')
+    @click.option('--batch-size', default=1000,
+                  help='Documents per bulk request.')
+    @click.option('--workers', default=1,
+                  help='Processes to split the id range between.')
+    def reindex(model, batch_size, workers):
+        '''Rebuild the search index from the database.'''
+        if not current_app.search_backend:
+            raise RuntimeError('no search backend is configured')
+        for name, cls in sorted(_searchable().items()):
+            if model and name != model:
+                continue
+            total, min_id, max_id = db.session.query(
+                db.func.count(cls.id), db.func.min(cls.id),
+                db.func.max(cls.id)).one()
+            progress = _Progress(name, total)
+            if not total:
+                indexed = 0
+            elif workers <= 1:
+                indexed = cls.reindex(batch_size, progress=progress)
+            else:
+                # split the id range in more shards than there are workers,
+                # so a shard full of ids is not left running on its own at
+                # the end, and the progress moves more often
+                shards = workers * 8
+                step = (max_id - min_id) // shards + 1
+                jobs = [(name, lo, lo + step - 1, batch_size)
+                        for lo in range(min_id, max_id + 1, step)]
+                # connections must not be shared with the forked processes
+                db.session.remove()
+                db.engine.dispose()
+                indexed = 0
+                with Pool(workers, initializer=_init_reindex_worker) as pool:
+                    for rows, count in pool.imap_unordered(_reindex_shard,
+                                                           jobs):
+                        indexed += count
+                        progress(rows)
+            click.echo('{}: indexed {} of {} rows in {:.1f}s.'.format(
+                name, indexed, total, time() - progress.start))
+
+    @search.command()
+    def stats():
+        '''Show the hit and miss counts of the search result cache.'''
+        if not current_app.search_cache:
+            raise RuntimeError('the search cache is turned off')
+        stats = current_app.search_cache.stats()
+        click.echo('local hits: {local_hits}, redis hits: {redis_hits}, '
+                   'misses: {misses}, hit ratio: {hit_ratio:.1%}'.format(
+                       **stats))
+
     @app.cli.group()
     def translate():
         '''Translation and localization commands'''
         pass
 
+    @translate.command('cache-stats')
+    def cache_stats():
+        '''Show the hit and miss counts of the translation cache.'''
+        if not current_app.translation_cache:
+            raise RuntimeError('the translation cache is turned off')
+        stats = current_app.translation_cache.stats()
+        click.echo('local hits: {local_hits}, redis hits: {redis_hits}, '
+                   'misses: {misses}, hit ratio: {hit_ratio:.1%}, '
+                   'coalesced: {coalesced}'.format(**stats))
+
     @translate.command()
     def update():
         '''Update all languages.'''
@@ -45,6 +247,19 @@ def register(app):
 # commands inside a register() function that takes the app instance as an arg.
 
 
+# flask search reindex
+# -----------------------------------------------------------------------------
+# Rebuilds the search index of every searchable model (or just --model) with
+# SearchableMixin.reindex(), which sends --batch-size documents per bulk
+# request. With --workers N the id range is cut into shards that a pool of N
+# processes works through, each one with its own app and database connection
+# (multiprocessing doesn't share those across a fork), while the parent prints
+# the progress and throughput as the shards finish. Elasticsearch can usually
+# take a few bulk requests at once, so 2-4 workers per data node is a good
+# place to start.
+
+# (venv) $ flask search reindex --batch-size 2000 --workers 4
+
 # @translate.command()
 # -----------------------------------------------------------------------------
 # Note how the decorator from these functions is derived from the translate
@@ -1,16 +1,15 @@
-from threading import Thread
 from flask import current_app
 from flask_mail import Message
-from app import mail
-
-
-def send_asynchronous(app, msg):
-    with app.app_context():
-        mail.send(msg)
+from app import mail, outbox
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
-               attachments=None, sync=False):
+               attachments=None, sync=False, key=None, digest=False):
+    if current_app.config['MAIL_OUTBOX'] and not sync:
+        # saved, and sent by the RQ worker (see app/outbox.py)
+        outbox.add(subject, sender, recipients, text_body, html_body,
+                   attachments, key=key, digest=digest)
+        return
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
@@ -20,8 +19,8 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_asynchronous,
-            args=(current_app._get_current_object(), msg)).start()
+        # sent by a thread of the pool (see app/mailer.py)
+        current_app.mail_pool.submit(msg)
 
 
 # Asynchronous emails
@@ -66,3 +65,8 @@ def send_email(subject, sender, recipients, text_body, html_body,
 # we need to do is access the real application instance that is stored inside
 # this proxy object, and pass that as the app argument.
 # The current_app._get_current_object() expression does exactly that.
+
+# Starting a thread (and an SMTP connection) per email doesn't hold up when a
+# lot of them are sent at once, so the emails are now handed to a fixed pool
+# of sender threads instead, which is given the real application instance
+# when it's created. See app/mailer.py.
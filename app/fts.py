@@ -0,0 +1,152 @@
+import re
+import sqlite3
+import threading
+
+_WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+class SQLiteBackend():
+    '''Search backend that keeps the index in an SQLite FTS5 database file.'''
+    errors = (sqlite3.OperationalError,)
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._tables = set()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _table(self, conn, index, fields=None):
+        '''Returns the quoted table name of an index, creating the table
+        with the given fields if it doesn't exist yet. Returns None if it
+        doesn't exist and no fields were given.'''
+        if not re.match(r'^\w+$', index):
+            raise ValueError('invalid index name: ' + index)
+        table = '"fts_{}"'.format(index)
+        if index in self._tables:
+            return table
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?",
+            ('fts_' + index,)).fetchone()
+        if not exists:
+            if not fields:
+                return None
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, '
+                         'tokenize="unicode61 remove_diacritics 2")'.format(
+                             table, ', '.join(fields)))
+        self._tables.add(index)
+        return table
+
+    def index(self, index, documents):
+        '''Adds or replaces (id, payload) documents in one transaction.
+        Returns the number of documents that were indexed.'''
+        if not documents:
+            return 0
+        fields = sorted(documents[0][1])
+        conn = self._connection()
+        with conn:
+            table = self._table(conn, index, fields)
+            conn.executemany('DELETE FROM {} WHERE rowid = ?'.format(table),
+                             [(id,) for id, _ in documents])
+            conn.executemany(
+                'INSERT INTO {}(rowid, {}) VALUES (?, {})'.format(
+                    table, ', '.join(fields), ', '.join('?' * len(fields))),
+                [[id] + [payload.get(field) for field in fields]
+                 for id, payload in documents])
+        return len(documents)
+
+    def remove(self, index, ids):
+        conn = self._connection()
+        with conn:
+            table = self._table(conn, index)
+            if table:
+                conn.executemany(
+                    'DELETE FROM {} WHERE rowid = ?'.format(table),
+                    [(id,) for id in ids])
+
+    def _match(self, conn, index, query):
+        # each word quoted, so that what users type is never read as FTS5
+        # query syntax, and joined with OR like Elasticsearch's multi_match
+        words = _WORDS.findall(query)
+        if not words:
+            return None, None
+        return self._table(conn, index), \
+            ' OR '.join('"{}"'.format(word) for word in words)
+
+    def _count(self, conn, table, match, max_total):
+        # counting every match of a common word is most of the cost of a
+        # search, so stop counting at max_total
+        return conn.execute(
+            'SELECT count(*) FROM (SELECT 1 FROM {0} WHERE {0} MATCH ? '
+            'LIMIT ?)'.format(table), (match, max_total)).fetchone()[0]
+
+    def query(self, index, query, page, per_page, max_total=10000):
+        conn = self._connection()
+        table, match = self._match(conn, index, query)
+        if not table:
+            return [], 0
+        total = self._count(conn, table, match, max_total)
+        if total == 0:
+            return [], 0
+        rows = conn.execute(
+            'SELECT rowid FROM {0} WHERE {0} MATCH ? '
+            'ORDER BY rank, rowid DESC LIMIT ? OFFSET ?'.format(table),
+            (match, per_page, (page - 1) * per_page)).fetchall()
+        return [row[0] for row in rows], total
+
+    def query_after(self, index, query, size, after=None, reverse=False,
+                    max_total=10000):
+        '''Returns up to size (id, sort key) hits following the sort key
+        after, best first (worst first if reverse), and the total.'''
+        conn = self._connection()
+        table, match = self._match(conn, index, query)
+        if not table:
+            return [], 0
+        # rank is the BM25 score, negated, so the best match has the lowest
+        sql = 'SELECT rowid, rank FROM {0} WHERE {0} MATCH ?'.format(table)
+        params = [match]
+        if after is not None:
+            sql += ' AND (rank {0} ? OR (rank = ? AND rowid {1} ?))'.format(
+                *('<', '>') if reverse else ('>', '<'))
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY rank {0}, rowid {1} LIMIT ?'.format(
+            *('DESC', 'ASC') if reverse else ('ASC', 'DESC'))
+        rows = conn.execute(sql, params + [size]).fetchall()
+        total = self._count(conn, table, match, max_total)
+        return [(id, [rank, id]) for id, rank in rows], total
+
+
+# SQLite full-text search
+# -----------------------------------------------------------------------------
+# Without ELASTICSEARCH_URL the search box used to return nothing at all,
+# which is fine for running the unit tests but not for a small deployment
+# that doesn't want to run (and feed) a Java service just for search. With
+# SEARCH_BACKEND = 'sqlite' the index is kept in an SQLite database file
+# instead (SEARCH_SQLITE_PATH), using the FTS5 full-text extension that
+# ships with the sqlite3 module in most Python builds.
+
+# Each index is a virtual table fts_<index> with one column per searchable
+# field, and the id of the row in the application database as its rowid.
+# FTS5 keeps an inverted index of the words (tokenized with unicode61, so
+# case and accents don't matter) and ranks the matches with BM25, the same
+# family of scoring that Elasticsearch uses, through its built-in rank column.
+# Updates are incremental: a changed post is a DELETE and an INSERT of its
+# rowid, and a whole batch is one transaction. It works with everything in
+# app/search.py, including the async queue and flask search reindex.
+
+# Deep pages use the same (score, id) cursors as Elasticsearch's search_after
+# (see app/search.py), compared against the rank column, and the total stops
+# counting at SEARCH_MAX_TOTAL matches.
+
+# The database is opened in WAL mode so searches are not blocked while a
+# batch is being written. Writes still go one at a time, so flask search
+# reindex --workers doesn't speed it up the way it does with Elasticsearch.
+# To compare the two backends on your own data, see benchmarks/search.py.
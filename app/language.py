@@ -0,0 +1,160 @@
+from collections import Counter
+from importlib import import_module
+import threading
+from flask import current_app
+from guess_language import ALL_LATIN, ARABIC, CYRILLIC, DEVANAGARI, \
+    EXTENDED_LATIN, MAX_GRAMS, MAX_LENGTH, MIN_LENGTH, MODEL_ROOT, PT, \
+    SINGLETONS, WORD_RE, find_runs
+import redis
+
+_SCORED = (ALL_LATIN, ARABIC, CYRILLIC, DEVANAGARI, PT)
+_models = None
+_lock = threading.Lock()
+
+
+def load():
+    '''Loads the trigram models of guess_language, once per process. For
+    each group of languages that detect() chooses from, returns the sorted
+    languages and an index of {trigram: ((language number, rank), ...)}.'''
+    global _models
+    if _models is not None:
+        return _models
+    with _lock:
+        if _models is None:
+            models = {}
+            for group in _SCORED:
+                languages, index = [], {}
+                for language in sorted(group):
+                    try:
+                        model = import_module(
+                            MODEL_ROOT + language.lower()).model
+                    except ImportError:
+                        continue
+                    for trigram, rank in model.items():
+                        index.setdefault(trigram, []).append(
+                            (len(languages), rank))
+                    languages.append(language)
+                models[frozenset(group)] = (languages, {
+                    trigram: tuple(ranks) for trigram, ranks in index.items()})
+            _models = models
+    return _models
+
+
+def _closest(sample, group):
+    '''Returns the language of group whose model is the closest to the
+    trigrams of sample, by the same distance as guess_language.'''
+    languages, index = load()[frozenset(group)]
+    sample = sample.lower()
+    counts = Counter(sample[i:i + 3] for i in range(len(sample) - 2))
+    ordered = sorted(counts, key=lambda k: (-counts[k], k))[:MAX_GRAMS]
+    # every trigram starts as missing from every model, and the ones a model
+    # has are corrected as we find them, so each trigram is looked up once
+    # instead of once per language
+    distances = [len(ordered) * MAX_GRAMS] * len(languages)
+    for i, trigram in enumerate(ordered):
+        for j, rank in index.get(trigram, ()):
+            distances[j] += (i - rank if i > rank else rank - i) - MAX_GRAMS
+    return min(zip(distances, languages))[1]
+
+
+def _is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def detect(text):
+    '''Returns the language code of text, or '' if it can't tell.'''
+    words = WORD_RE.findall(text[:MAX_LENGTH].replace('’', "'"))
+    if not words:
+        return ''
+    # most posts are plain ASCII, which can only be Basic Latin
+    scripts = ['Basic Latin'] if _is_ascii(text) else find_runs(words)
+    if 'Hangul Syllables' in scripts or 'Hangul Jamo' in scripts or \
+            'Hangul Compatibility Jamo' in scripts or 'Hangul' in scripts:
+        return 'ko'
+    if 'Greek and Coptic' in scripts:
+        return 'el'
+    if 'Kana' in scripts:
+        return 'ja'
+    if 'CJK Unified Ideographs' in scripts or 'Bopomofo' in scripts or \
+            'Bopomofo Extended' in scripts or 'KangXi Radicals' in scripts:
+        return 'zh'
+    if 'Cyrillic' in scripts:
+        languages = CYRILLIC
+    elif 'Arabic' in scripts or 'Arabic Presentation Forms-A' in scripts or \
+            'Arabic Presentation Forms-B' in scripts:
+        languages = ARABIC
+    elif 'Devanagari' in scripts:
+        languages = DEVANAGARI
+    else:
+        for block, language in SINGLETONS:
+            if block in scripts:
+                return language
+        if 'Extended Latin' in scripts:
+            languages = EXTENDED_LATIN
+        elif 'Basic Latin' in scripts:
+            languages = ALL_LATIN
+        else:
+            return ''
+    sample = ' '.join(words)
+    # too short for the trigrams to mean anything
+    if len(sample) < MIN_LENGTH:
+        return ''
+    language = _closest(sample, languages)
+    if language == 'pt' and languages is EXTENDED_LATIN:
+        language = _closest(sample, PT)
+    return language if len(language) <= 5 else ''
+
+
+def post_language(text):
+    '''The language to store with a new post. None means it hasn't been
+    detected yet, and will be in the background once the post is committed
+    (see Post.after_flush() in models.py).'''
+    if current_app.config['LANGUAGE_DETECTION'] == 'async':
+        return None
+    return detect(text)
+
+
+def queue_detection(post_id):
+    try:
+        current_app.task_queue.enqueue('app.tasks.detect_post_language',
+                                       post_id)
+    except redis.exceptions.RedisError:
+        # flask language detect picks it up later
+        current_app.logger.warning('Could not queue language detection of '
+                                   'post %s', post_id, exc_info=True)
+
+
+# Detecting the language of posts
+# -----------------------------------------------------------------------------
+# Every new post used to go through guess_language() before it was saved, and
+# that was a noticeable part of the time it takes to post. detect() gives the
+# same answers, faster:
+
+# - guess_language compares the trigrams of the text with the model of each
+#   candidate language in turn (49 of them for Latin script), so each trigram
+#   is looked up 49 times. Here the models are loaded once per process (load())
+#   into one index of trigram -> ((language, rank), ...) per group of
+#   candidate languages, and each trigram of the text is looked up once.
+# - Text that is plain ASCII skips the scan of Unicode blocks, since it can
+#   only be Basic Latin.
+# - Text shorter than MIN_LENGTH letters is not scored at all. guess_language
+#   returns UNKNOWN for it anyway, unless the script gives the language away.
+# - It never asks PyEnchant. If it is installed, guess_language checks every
+#   word against the spelling dictionary of every language first, which is by
+#   far the slowest step.
+
+# Unknown languages come back as '', which is what the views used to store in
+# that case. To compare the two on posts in a few languages, see
+# benchmarks/language.py.
+
+# With LANGUAGE_DETECTION = 'async' the views don't detect anything, the post
+# is saved with language set to None, and once it is committed a
+# detect_post_language job is queued on RQ to fill it in (which is also when
+# a popular post gets queued for pre-translation, see app/translate.py). The
+# Translate link only shows up once the language is known. If the job can't
+# be queued, flask language detect finds the posts that have no language yet
+# and detects it for them.
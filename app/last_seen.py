@@ -0,0 +1,107 @@
+from datetime import datetime
+from time import time
+from uuid import uuid4
+from flask import current_app
+import redis
+
+KEY = 'last_seen'
+FLUSH_TIMER_KEY = 'last_seen:timer'
+SNAPSHOT_KEY = 'last_seen:flushing'
+SNAPSHOTS_KEY = 'last_seen:snapshots'
+# a snapshot is read straight after it is taken, so one this old belongs to a
+# process that died in between
+SNAPSHOT_TIMEOUT = 60
+
+
+def touch(user_id):
+    '''Buffers "user was seen now" in Redis. Returns True when the buffer is
+    due to be written to the database.'''
+    pipe = current_app.redis.pipeline()
+    pipe.hset(KEY, user_id, time())
+    pipe.hlen(KEY)
+    pipe.set(FLUSH_TIMER_KEY, 1, nx=True,
+             ex=current_app.config['LAST_SEEN_FLUSH_INTERVAL'])
+    _, pending, timer_expired = pipe.execute()
+    return pending >= current_app.config['LAST_SEEN_FLUSH_SIZE'] or \
+        bool(timer_expired)
+
+
+def get(user_id):
+    '''Returns the buffered last seen time of a user, or None.'''
+    seen = current_app.redis.hget(KEY, user_id)
+    return datetime.utcfromtimestamp(float(seen)) if seen else None
+
+
+def pop_all():
+    '''Takes everything out of the buffer, as {user_id: datetime}, including
+    what a process that died while flushing left behind.'''
+    conn = current_app.redis
+    now = time()
+    snapshot = '{}:{}'.format(SNAPSHOT_KEY, uuid4().hex)
+    # the snapshot is recorded in the same transaction as the rename, so it
+    # can't be lost if we die before reading it
+    pipe = conn.pipeline()
+    pipe.zadd(SNAPSHOTS_KEY, **{snapshot: now})
+    pipe.rename(KEY, snapshot)
+    try:
+        pipe.execute()
+    except redis.exceptions.ResponseError:
+        conn.zrem(SNAPSHOTS_KEY, snapshot)  # nothing buffered
+        snapshot = None
+    snapshots = conn.zrangebyscore(SNAPSHOTS_KEY, 0, now - SNAPSHOT_TIMEOUT)
+    if snapshot:
+        snapshots.append(snapshot)
+    if not snapshots:
+        return {}
+    pipe = conn.pipeline()
+    for key in snapshots:
+        pipe.hgetall(key)
+    pipe.delete(*snapshots)
+    pipe.zrem(SNAPSHOTS_KEY, *snapshots)
+    seen = {}
+    for entries in pipe.execute()[:len(snapshots)]:
+        for id, ts in entries.items():
+            seen[int(id)] = max(seen.get(int(id), 0), float(ts))
+    return {id: datetime.utcfromtimestamp(ts) for id, ts in seen.items()}
+
+
+def restore(seen):
+    '''Puts entries back in the buffer after a failed flush, without
+    overwriting anything newer.'''
+    pipe = current_app.redis.pipeline()
+    for user_id, when in seen.items():
+        pipe.hsetnx(KEY, user_id,
+                    (when - datetime(1970, 1, 1)).total_seconds())
+    pipe.execute()
+
+
+# Buffered last_seen updates
+# -----------------------------------------------------------------------------
+# The before_request() handler in main/routes.py used to set
+# current_user.last_seen and commit on every request, including the AJAX
+# calls the pages make in the background, so every page view was also a
+# write transaction on the user table.
+
+# The time is now written to a Redis hash instead (HSET last_seen <id> <time>),
+# which is cheap and overwrites itself, so a user who makes 50 requests a
+# minute still only has one entry. Every so often the whole hash is written
+# to the database with one executemany UPDATE (User.flush_last_seen()). The
+# flush happens when either:
+# - LAST_SEEN_FLUSH_SIZE users are waiting in the buffer, or
+# - LAST_SEEN_FLUSH_INTERVAL seconds have gone by since the last flush. The
+#   timer is a Redis key set with SET NX EX, so only the one request that
+#   finds the key expired and sets it again does the flush, no matter how
+#   many processes are running.
+
+# To take the entries out of the hash without losing any that arrive while
+# we are flushing, the hash is renamed first (RENAME is atomic), and new
+# requests start a fresh one under the old name. Each flush renames it to a
+# name of its own (last_seen:flushing:<random>), and lists that name in the
+# last_seen:snapshots sorted set in the same transaction. If the process dies
+# before reading its snapshot, the next flush after SNAPSHOT_TIMEOUT seconds
+# finds it there and writes it out too, so a crash loses nothing and never
+# blocks the flushes that come after it.
+
+# Pages that show the last seen time (the profile page) look in the buffer
+# first with User.get_last_seen(), so the value shown is still fresh. If
+# Redis is not available the handler falls back to the old commit per request.
@@ -0,0 +1,210 @@
+import atexit
+import os
+import queue
+import smtplib
+import socket
+import threading
+from time import time
+import redis
+
+
+class MailPool():
+    '''Sends emails from a bounded queue with a fixed number of threads, each
+    keeping its own SMTP connection open between emails.'''
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self.workers = app.config['MAIL_WORKERS']
+        self.queue_size = app.config['MAIL_QUEUE_SIZE']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self.put_timeout = app.config['MAIL_QUEUE_TIMEOUT']
+        self.queue = None
+        self._pid = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _start(self):
+        # threads don't survive a fork (the RQ worker forks for every job),
+        # so a child process starts its own
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self.queue = queue.Queue(self.queue_size)
+            self._threads = [
+                threading.Thread(target=self._run, args=(self.queue,),
+                                 name='mail-{}'.format(i), daemon=True)
+                for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, msg):
+        '''Queues msg for sending. If the queue is full, waits up to
+        MAIL_QUEUE_TIMEOUT seconds for room, then sends it from the calling
+        thread, so the caller slows down instead of the queue growing.'''
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put((time(), msg), timeout=self.put_timeout)
+        except queue.Full:
+            self.app.logger.warning('Mail queue is full, sending inline')
+            self._count('overflow')
+            self.mail.send(msg)
+
+    def stop(self, timeout=10):
+        '''Sends what is left in the queue and stops the threads.'''
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self.queue.put(None)
+        deadline = time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time()))
+
+    def _run(self, q):
+        conn = None
+        with self.app.app_context():
+            while True:
+                try:
+                    # an open connection is closed after a while without mail
+                    item = q.get(timeout=self.idle_timeout if conn else None)
+                except queue.Empty:
+                    conn = self._close(conn)
+                    continue
+                batch, stop = [], item is None
+                if item is not None:
+                    batch.append(item)
+                while not stop and len(batch) < self.batch_size:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                    else:
+                        batch.append(item)
+                if batch:
+                    conn = self._send(conn, batch)
+                if stop:
+                    self._close(conn)
+                    return
+
+    def _send(self, conn, batch):
+        for queued, msg in batch:
+            for attempt in range(2):
+                try:
+                    if conn is None:
+                        conn = self.mail.connect().__enter__()
+                    start = time()
+                    conn.send(msg)
+                except (smtplib.SMTPException, OSError):
+                    # the server may have dropped a connection we kept open
+                    # for too long, so try once more on a new one
+                    conn = self._close(conn)
+                    if attempt:
+                        self.app.logger.exception('Could not send email')
+                        self._count('failed')
+                except Exception:
+                    # a message that can't be sent at all (no recipients, a
+                    # bad header...) is dropped, and the thread goes on with
+                    # the next one on a fresh connection
+                    conn = self._close(conn)
+                    self.app.logger.exception('Could not send email')
+                    self._count('failed')
+                    break
+                else:
+                    end = time()
+                    self._count('sent')
+                    self._count('send_seconds', end - start)
+                    self._count('latency_seconds', end - queued)
+                    break
+        self._report()
+        return conn
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+        return None
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def _depth_key(self):
+        return 'mail:queue:{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def _report(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        try:
+            pipe = self.app.redis.pipeline(transaction=False)
+            for name, value in counts.items():
+                pipe.hincrbyfloat('mail:stats', name, value)
+            pipe.set(self._depth_key(), self.queue.qsize(),
+                     ex=2 * self.idle_timeout)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+    def stats(self):
+        '''Returns the counts of all processes and the queue depth of the
+        ones that sent mail recently.'''
+        conn = self.app.redis
+        counts = {k.decode('utf-8'): float(v)
+                  for k, v in conn.hgetall('mail:stats').items()}
+        sent = counts.get('sent', 0)
+        keys = list(conn.scan_iter('mail:queue:*'))
+        depths = [int(depth) for depth in conn.mget(keys) if depth] \
+            if keys else []
+        return {
+            'sent': int(sent),
+            'failed': int(counts.get('failed', 0)),
+            'overflow': int(counts.get('overflow', 0)),
+            'queue_depth': sum(depths),
+            'latency_ms': 1000 * counts.get('latency_seconds', 0) / sent
+            if sent else 0.0,
+            'send_ms': 1000 * counts.get('send_seconds', 0) / sent
+            if sent else 0.0,
+        }
+
+
+# A pool of email senders
+# -----------------------------------------------------------------------------
+# send_email() used to start a new thread for each email, which opened its own
+# connection to the SMTP server (login and TLS handshake included) to send
+# that one email. That's fine for the odd password reset, but a few hundred
+# reset requests at once means a few hundred threads and connections, and
+# most mail servers start refusing well before that.
+
+# Now each process has a MailPool (app.mail_pool) with a fixed number of
+# sender threads (MAIL_WORKERS), started the first time an email is sent. The
+# emails wait on a queue that holds at most MAIL_QUEUE_SIZE of them. Each
+# thread takes up to MAIL_BATCH_SIZE emails at a time and sends them over its
+# own connection from mail.connect(), which it keeps open for the next batch,
+# and closes after MAIL_IDLE_TIMEOUT seconds without mail. If the server has
+# closed it in the meantime, the email is sent again on a new connection. An
+# email that fails for any other reason is logged, counted as failed and
+# dropped, and the thread goes on with the next one: a thread that died on a
+# bad message would leave the queue with nobody to empty it.
+
+# When the queue is full, send_email() waits up to MAIL_QUEUE_TIMEOUT seconds
+# for room and then sends the email itself. This is the backpressure: the
+# requests that send mail get slower, rather than the queue (and memory)
+# growing without limit. The emails still in the queue when the process
+# exits normally are sent before it does.
+
+# Each batch adds to the counts in the mail:stats hash in Redis (emails sent,
+# failed, sent inline, and the seconds they spent waiting and being sent),
+# and each process writes its queue depth to a short-lived key:
+
+# (venv) $ flask mail stats
+
+# send_email(..., sync=True), used by the background tasks, still sends
+# straight away from the calling thread without going through the pool.
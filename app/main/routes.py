@@ -1,30 +1,72 @@
 from datetime import datetime
+import os
+import re
+import secrets
 from flask import g, flash, jsonify, render_template, redirect, request, \
-    url_for, current_app
+    url_for, current_app, abort, Response, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
-from app import db
+import redis
+from sqlalchemy.exc import SQLAlchemyError
+from app import db, last_seen, stream
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+from app.models import User, Post, Message, Translation
+from app.pagination import decode_key, get_cursor_args, paginate
+from app.language import post_language
+from app.translate import translate, translate_many
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        # there is no db.session.add() before the commit, because when you
-        # reference current_user, Flask-Login will invoke the user loader
-        # callback function, which will run a database query that will put the
-        # target user in the database session. So you can add the user again
-        # in this function, but it's not necessary because it's already there.
-        db.session.commit()
+        record_last_seen()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+def record_last_seen():
+    '''Buffers the last_seen update in Redis, writing the buffer to the
+    database every so often (see app/last_seen.py).'''
+    if current_app.config['LAST_SEEN_BUFFER']:
+        try:
+            due = last_seen.touch(current_user.id)
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('last_seen buffer unavailable',
+                                       exc_info=True)
+        else:
+            if due:
+                try:
+                    User.flush_last_seen()
+                except (SQLAlchemyError, redis.exceptions.RedisError):
+                    # the entries are back in the buffer (or still in their
+                    # snapshot) for the next flush, and the page still loads
+                    current_app.logger.exception(
+                        'Could not flush the last_seen buffer')
+            return
+    current_user.last_seen = datetime.utcnow()
+    # there is no db.session.add() before the commit, because when you
+    # reference current_user, Flask-Login will invoke the user loader
+    # callback function, which will run a database query that will put the
+    # target user in the database session. So you can add the user again
+    # in this function, but it's not necessary because it's already there.
+    db.session.commit()
+
+
+def post_author_context(posts):
+    '''Batch-loads what _post.html needs to know about the authors of a page
+    of posts (the follow status, the counts are columns on User), and the
+    stored translations, so the page renders with the same number of queries
+    however many posts it has.'''
+    authors = {post.author for post in posts}
+    # messages.html renders messages with _post.html too
+    translations = Translation.for_posts(
+        [post for post in posts if isinstance(post, Post)], g.locale) \
+        if current_app.config['PRETRANSLATE'] else {}
+    return {'followed_ids': current_user.followed_ids(authors),
+            'translations': translations}
+
+
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
@@ -39,43 +81,68 @@ def translate_text():
     # that is going to be sent back to the client.
 
 
+@bp.route('/translate/posts', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json() or {}
+    post_ids = data.get('post_ids') or []
+    dest_language = data.get('dest_language')
+    if not dest_language or not isinstance(post_ids, list) or \
+            len(post_ids) > 100:
+        abort(400)
+    try:
+        post_ids = [int(id) for id in post_ids]
+    except (TypeError, ValueError):
+        abort(400)
+    posts = [post for post in Post.query.filter(Post.id.in_(post_ids))
+             if post.language]
+    stored = Translation.for_posts(posts, dest_language)
+    posts = [post for post in posts if post.id not in stored]
+    translations = translate_many(
+        [(post.body, post.language) for post in posts], dest_language)
+    stored.update(zip([post.id for post in posts], translations))
+    return jsonify({'translations': stored})
+
+
 @bp.route('/home', methods=['GET', 'POST'])
 @login_required
 def index():
     '''View function for the main index page.'''
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        # Each time a post is submitted, we run the text through the
-        # guess_language function to try to determine the language. If it
-        # comes back as unknown or an unexpectedly long result, we play it
-        # safe and save an empty string to the database.
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # Each time a post is submitted, we try to determine the language of
+        # the text (see app/language.py). If it comes back as unknown, we
+        # play it safe and save an empty string to the database.
+        post = Post(body=form.post.data, author=current_user,
+                    language=post_language(form.post.data))
         db.session.add(post)
         db.session.commit()
         flash(_('Posted!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    posts = current_user.followed_posts_page(
+        current_app.config['POSTS_PER_PAGE'], **get_cursor_args())
+    next_url = url_for('main.index', before=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.index', after=posts.prev_cursor) \
+        if posts.prev_cursor else None
     return render_template('index.html', title='Home', form=form,
-                           posts=posts.items, next_url=next_url, prev_url=prev_url)
+                           posts=posts.items, next_url=next_url, prev_url=prev_url,
+                           **post_author_context(posts.items))
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    posts = paginate(Post.query.options(db.selectinload(Post.author)),
+                     Post.timestamp, Post.id,
+                     current_app.config['POSTS_PER_PAGE'], **get_cursor_args())
+    next_url = url_for('main.explore', before=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.explore', after=posts.prev_cursor) \
+        if posts.prev_cursor else None
     return render_template('index.html', title='Explore', posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+                           next_url=next_url, prev_url=prev_url,
+                           **post_author_context(posts.items))
 
 
 @bp.route('/about')
@@ -89,28 +156,26 @@ def about():
 def user(username):
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        # Each time a post is submitted, we run the text through the
-        # guess_language function to try to determine the language. If it
-        # comes back as unknown or an unexpectedly long result, we play it
-        # safe and save an empty string to the database.
-        post = Post(body=form.post.data, author=current_user, language=language)
+        # Each time a post is submitted, we try to determine the language of
+        # the text (see app/language.py). If it comes back as unknown, we
+        # play it safe and save an empty string to the database.
+        post = Post(body=form.post.data, author=current_user,
+                    language=post_language(form.post.data))
         db.session.add(post)
         db.session.commit()
         flash(_('Posted!'))
         return redirect(url_for('main.user', username=username))
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    posts = paginate(user.posts.options(db.selectinload(Post.author)),
+                     Post.timestamp, Post.id,
+                     current_app.config['POSTS_PER_PAGE'], **get_cursor_args())
+    next_url = url_for('main.user', username=user.username,
+                       before=posts.next_cursor) if posts.next_cursor else None
+    prev_url = url_for('main.user', username=user.username,
+                       after=posts.prev_cursor) if posts.prev_cursor else None
     return render_template('user.html', user=user, form=form, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+                           next_url=next_url, prev_url=prev_url,
+                           **post_author_context(posts.items))
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -168,15 +233,33 @@ def unfollow(username):
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
+    q = g.search_form.q.data
+    per_page = current_app.config['POSTS_PER_PAGE']
+    page = request.args.get('page', type=int)
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if page is not None and after is None and before is None:
+        # links from before cursors existed still use from/size pagination
+        posts, total = Post.search(q, page, per_page)
+        next_url = url_for('main.search', q=q, page=page + 1) \
+            if total > page * per_page else None
+        prev_url = url_for('main.search', q=q, page=page - 1) \
+            if page > 1 else None
+    else:
+        try:
+            after = decode_key(after) if after else None
+            before = decode_key(before) if before else None
+        except ValueError:
+            abort(404)
+        results = Post.search_after(q, per_page, after=after, before=before)
+        posts = results.items
+        next_url = url_for('main.search', q=q, after=results.next_cursor) \
+            if results.next_cursor else None
+        prev_url = url_for('main.search', q=q, before=results.prev_cursor) \
+            if results.prev_cursor else None
     return render_template('search.html', title=_('search'), posts=posts,
-                           next_url=next_url, prev_url=prev_url)
+                           next_url=next_url, prev_url=prev_url,
+                           **post_author_context(posts))
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -202,29 +285,50 @@ def messages():
     current_user.last_message_read_time = datetime.utcnow()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
+    query = current_user.messages_received.options(
+        db.selectinload(Message.author))
+    messages = paginate(query, Message.timestamp, Message.id,
+                        current_app.config['POSTS_PER_PAGE'],
+                        **get_cursor_args())
+    next_url = url_for('main.messages', before=messages.next_cursor) \
+        if messages.next_cursor else None
+    prev_url = url_for('main.messages', after=messages.prev_cursor) \
+        if messages.prev_cursor else None
     return render_template('messages.html', messages=messages.items,
-                           next_url=next_url, prev_url=prev_url)
+                           next_url=next_url, prev_url=prev_url,
+                           **post_author_context(messages.items))
 
 
 @bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
     return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+        'name': name,
+        'data': data,
+        'timestamp': timestamp
+    } for name, data, timestamp in current_user.get_notifications(since)])
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    if not current_app.config['NOTIFICATION_STREAM']:
+        abort(404)
+    # the browser sends the id of the last event it got when it reconnects
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    try:
+        events = stream.events(current_user.id, since,
+                               lambda: current_user.get_notifications(since))
+    except redis.exceptions.RedisError:
+        abort(503)
+    finally:
+        # don't hold on to a database connection while the stream is open
+        db.session.close()
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/export_posts')
@@ -233,11 +337,29 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        # the file gets a name nobody can guess, for the link in the email
+        name = secrets.token_urlsafe(16)
+        current_user.launch_task(
+            'export_posts', _('Exporting posts...'), name,
+            url_for('main.download_export', name=name, _external=True))
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
 
 
+@bp.route('/export_posts/<name>')
+@login_required
+def download_export(name):
+    # the names are made by token_urlsafe(), so a valid one is never a path
+    if not re.fullmatch(r'[\w-]+', name):
+        abort(404)
+    path = os.path.join(current_app.config['EXPORT_DIR'],
+                        str(current_user.id), name + '.ndjson.gz')
+    if not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     attachment_filename='posts.ndjson.gz')
+
+
 # render_template()
 # -----------------------------------------------------------------------------
 # The render_template() function invokes the Jinja2 template engine that
@@ -449,3 +571,9 @@ def export_posts():
 # keyword arguments to it, and if the names of those arguments are not
 # referenced in the URL directly, then Flask will include them in the URL
 # as query arguments.
+
+# The index, explore, user and messages views have since moved from page
+# numbers to before=/after= cursors, because OFFSET gets slower the deeper
+# the page. paginate() in app/pagination.py returns a CursorPage with
+# next_cursor and prev_cursor in place of next_num and prev_num, and still
+# accepts the old ?page= links.
@@ -10,21 +10,56 @@ import jwt
 import redis
 import rq
 from werkzeug.security import generate_password_hash, check_password_hash
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, login, last_seen, notifications, stream, timeline
+from app.language import queue_detection
+from app.pagination import CursorPage, encode_key, paginate
+from app.search import add_to_index, bulk_index, bulk_remove, \
+    bump_generation, queue_changes, remove_from_index, query_index, \
+    query_index_after
+from app.translate import queue_pretranslation
+
+
+def on_commit(func, *args, session=None):
+    '''Defers func(*args) until the current database session commits.'''
+    session = session or db.session
+    session.info.setdefault('on_commit', []).append((func, args))
+
+
+def _run_on_commit(session):
+    for func, args in session.info.pop('on_commit', []):
+        func(*args)
+
+
+def _discard_on_commit(session):
+    session.info.pop('on_commit', None)
 
 
 class SearchableMixin():
     @classmethod
     def search(cls, expression, page, per_page):
+        '''Returns (objects, total), the objects in order of relevance.'''
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+        return cls.get_ordered(ids), total
+
+    @classmethod
+    def search_after(cls, expression, per_page, after=None, before=None):
+        '''Returns a CursorPage of objects in order of relevance, after or
+        before a position given by the sort key of a search hit.'''
+        hits, total, has_next, has_prev = query_index_after(
+            cls.__tablename__, expression, per_page, after, before)
+        page = CursorPage(hits, has_next, has_prev,
+                          cursor=lambda hit: encode_key(hit[1]))
+        page.items = cls.get_ordered([id for id, _ in hits])
+        page.total = total
+        return page
+
+    @classmethod
+    def get_ordered(cls, ids):
+        '''Loads the objects with the given ids, in the order given.'''
+        if not ids:
+            return []
+        objs = {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
+        return [objs[id] for id in ids if id in objs]
 
     @classmethod
     def before_commit(cls, session):
@@ -36,6 +71,16 @@ class SearchableMixin():
 
     @classmethod
     def after_commit(cls, session):
+        if not any(session._changes.values()):
+            session._changes = None
+            return
+        if current_app.config['SEARCH_INDEXING'] == 'async' and queue_changes(
+                cls.__tablename__,
+                [obj.id for obj in session._changes['add'] +
+                 session._changes['update']],
+                [obj.id for obj in session._changes['delete']]):
+            session._changes = None
+            return
         for obj in session._changes['add']:
             add_to_index(cls.__tablename__, obj)
         for obj in session._changes['update']:
@@ -43,26 +88,116 @@ class SearchableMixin():
         for obj in session._changes['delete']:
             remove_from_index(cls.__tablename__, obj)
         session._changes = None
+        bump_generation(cls.__tablename__)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def index_inserted(cls, objs):
+        '''Indexes rows inserted without the ORM (so without before_commit()
+        seeing them), the same way after_commit() would have. objs only need
+        the id and the searchable fields.'''
+        if current_app.config['SEARCH_INDEXING'] == 'async' and \
+                queue_changes(cls.__tablename__, [obj.id for obj in objs], []):
+            return
+        bulk_index(cls.__tablename__, objs)
+        bump_generation(cls.__tablename__)
+
+    @classmethod
+    def apply_index_changes(cls, changes, batch_size=1000):
+        '''Applies changes queued by after_commit(), a dictionary of
+        id -> 'add' or 'delete', with bulk requests.'''
+        add = [id for id, op in changes.items() if op == 'add']
+        for i in range(0, len(add), batch_size):
+            bulk_index(cls.__tablename__, cls.query.filter(
+                cls.id.in_(add[i:i + batch_size])).all())
+        bulk_remove(cls.__tablename__,
+                    [id for id, op in changes.items() if op == 'delete'])
+        bump_generation(cls.__tablename__)
+
+    @classmethod
+    def reindex(cls, batch_size=1000, min_id=None, max_id=None,
+                progress=None):
+        '''Sends the rows with min_id <= id <= max_id (all of them by default)
+        to the index, one bulk request per batch_size rows. progress is called
+        with the number of rows in each batch. Returns the number indexed.'''
+        query = cls.query.order_by(cls.id.asc())
+        if min_id is not None:
+            query = query.filter(cls.id >= min_id)
+        if max_id is not None:
+            query = query.filter(cls.id <= max_id)
+        indexed, last = 0, None
+        while True:
+            batch = query if last is None else query.filter(cls.id > last)
+            batch = batch.limit(batch_size).all()
+            if not batch:
+                return indexed
+            indexed += bulk_index(cls.__tablename__, batch)
+            if progress:
+                progress(len(batch))
+            last = batch[-1].id
 
 
 class APIMixin():
-    '''Returns a dictionary from a given query'''
-    @staticmethod
-    def to_collection_dict(query):
-        resources = query.all()
+    '''Returns a dictionary from a given query, a page at a time'''
+    @classmethod
+    def _page(cls, query, after, limit):
+        # keyset pagination on the primary key, see app/pagination.py
+        query = query.order_by(None).order_by(cls.id)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.limit(limit).all()
+
+    @classmethod
+    def collection_page(cls, query, limit, after=None):
+        '''Returns the (at most) limit items of query that come after the id
+        after, and the cursor of the next page (None if there isn't one).'''
+        resources = cls._page(query, after, limit + 1)
+        next_cursor = encode_key([resources[limit - 1].id]) \
+            if len(resources) > limit else None
+        return resources[:limit], next_cursor
+
+    @classmethod
+    def to_collection_dict(cls, query, endpoint, limit, after=None,
+                           total=None, fields=None, page=None, **kwargs):
+        '''Returns the (at most) limit items of query that come after the id
+        after, with a link to the next page. The items only have the given
+        fields, if any. page is the result of collection_page(), if it was
+        already loaded. The other keyword arguments are for
+        url_for(endpoint).'''
+        if fields is not None:
+            kwargs['fields'] = ','.join(sorted(fields))
+        resources, next_cursor = page or cls.collection_page(
+            query, limit, after)
+        cursor = encode_key([after]) if after is not None else None
         data = {
-            'items': [item.to_dict() for item in resources],
+            'items': [item.to_dict(fields=fields) for item in resources],
             '_meta': {
-                'total_items': len(resources),
+                'limit': limit,
+                'next_cursor': next_cursor,
+                'total_items': total if total is not None else
+                query.order_by(None).count(),
+            },
+            '_links': {
+                'self': url_for(endpoint, limit=limit, cursor=cursor,
+                                **kwargs),
+                'next': url_for(endpoint, limit=limit, cursor=next_cursor,
+                                **kwargs) if next_cursor else None,
             }
         }
         return data
 
+    @classmethod
+    def iter_collection(cls, query, batch_size=1000):
+        '''Yields every item of query, loading batch_size of them at a
+        time.'''
+        after = None
+        while True:
+            resources = cls._page(query, after, batch_size)
+            for item in resources:
+                yield item
+            if len(resources) < batch_size:
+                return
+            after = resources[-1].id
+
 
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
@@ -99,6 +234,19 @@ class User(UserMixin, APIMixin, db.Model):
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    # denormalized counters, kept up to date by follow(), unfollow() and
+    # Post.after_flush() (see notes below):
+    post_count = db.Column(db.Integer, default=0, server_default='0',
+                           nullable=False)
+    follower_count = db.Column(db.Integer, default=0, server_default='0',
+                               nullable=False)
+    following_count = db.Column(db.Integer, default=0, server_default='0',
+                                nullable=False)
+    # bumped whenever the user's API representation changes, except for
+    # last_seen (see the ETag notes in app/api/users.py):
+    version = db.Column(db.Integer, default=1, server_default='1',
+                        nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -132,10 +280,113 @@ class User(UserMixin, APIMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.append(user)
+            self.add_to_counter('following_count', 1)
+            user.add_to_counter('follower_count', 1)
+            if current_app.config['TIMELINE_CACHE'] and \
+                    not user.is_pull_author():
+                on_commit(timeline.add_posts, self.id, user.recent_posts())
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.add_to_counter('following_count', -1)
+            user.add_to_counter('follower_count', -1)
+            if current_app.config['TIMELINE_CACHE']:
+                on_commit(timeline.remove_posts, self.id,
+                          [id for id, _ in user.recent_posts()])
+
+    def follow_many(self, users):
+        '''Follows the given users that this user doesn't follow yet, with
+        one multi-row INSERT. Returns the users that were followed.'''
+        followed = self.followed_ids(users)
+        new = [user for user in users
+               if user.id not in followed and user.id != self.id]
+        if not new:
+            return []
+        # pull or push is decided from the counts already loaded (plus the
+        # new follower), before they are expired below
+        threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+        push_ids = [user.id for user in new
+                    if user.follower_count + 1 < threshold]
+        db.session.execute(followers.insert(), [
+            {'follower_id': self.id, 'followed_id': user.id} for user in new])
+        self.add_to_counter('following_count', len(new))
+        User.add_to_counters([user.id for user in new], 'follower_count', 1)
+        for user in new:
+            db.session.expire(user, ['follower_count', 'version', 'updated'])
+        if current_app.config['TIMELINE_CACHE'] and push_ids:
+            # the timeline only keeps the newest TIMELINE_LENGTH posts, so
+            # those of all the pushed authors together are all it can take
+            posts = Post.query.filter(Post.user_id.in_(push_ids)).order_by(
+                Post.timestamp.desc()).with_entities(Post.id, Post.timestamp)
+            on_commit(timeline.add_posts, self.id, posts.limit(
+                current_app.config['TIMELINE_LENGTH']).all())
+        return new
+
+    def add_to_counter(self, name, delta, session=None):
+        '''Adds delta to one of the counter columns with an UPDATE statement,
+        so concurrent changes in other transactions don't get lost.'''
+        session = session or db.session
+        User.add_to_counters([self.id], name, delta, session)
+        if db.inspect(self).persistent:
+            session.expire(self, [name, 'version', 'updated'])
+
+    @staticmethod
+    def add_to_counters(ids, name, delta, session=None):
+        '''add_to_counter() for many users at once, with one UPDATE. Users
+        that are already loaded keep their old counts until expired.'''
+        session = session or db.session
+        user = User.__table__
+        session.execute(user.update().where(user.c.id.in_(ids)).values({
+            user.c[name]: user.c[name] + delta,
+            user.c.version: user.c.version + 1,
+            user.c.updated: datetime.utcnow()}))
+
+    @staticmethod
+    def before_flush(session, flush_context, instances):
+        # a changed profile is a new version of the user
+        for obj in session.dirty:
+            if isinstance(obj, User) and any(
+                    db.inspect(obj).attrs[field].history.has_changes()
+                    for field in ('username', 'email', 'about_me')):
+                obj.version = User.version + 1
+                obj.updated = datetime.utcnow()
+
+    @staticmethod
+    def counter_drift(batch_size=1000):
+        '''Yields (user, counter, stored, actual) for each counter column that
+        doesn't match the rows it counts, checking users in batches.'''
+        last_id = 0
+        while True:
+            users = User.query.filter(User.id > last_id).order_by(
+                User.id).limit(batch_size).all()
+            if not users:
+                return
+            post_counts = dict(db.session.query(
+                Post.user_id, db.func.count()).filter(Post.user_id.in_(
+                    [user.id for user in users])).group_by(Post.user_id))
+            follower_counts, following_counts = User.follow_counts(users)
+            for user in users:
+                for name, counts in (('post_count', post_counts),
+                                     ('follower_count', follower_counts),
+                                     ('following_count', following_counts)):
+                    actual = counts.get(user.id, 0)
+                    if getattr(user, name) != actual:
+                        yield user, name, getattr(user, name), actual
+            last_id = users[-1].id
+
+    @staticmethod
+    def repair_counters(ids):
+        '''Recounts the counter columns of the given users in the database.'''
+        user = User.__table__
+        db.session.execute(user.update().where(user.c.id.in_(ids)).values(
+            post_count=db.select([db.func.count()]).where(
+                Post.__table__.c.user_id == user.c.id).as_scalar(),
+            follower_count=db.select([db.func.count()]).where(
+                followers.c.followed_id == user.c.id).as_scalar(),
+            following_count=db.select([db.func.count()]).where(
+                followers.c.follower_id == user.c.id).as_scalar(),
+            version=user.c.version + 1, updated=datetime.utcnow()))
 
     def is_following(self, user):
         '''This method checks if user to user relationship already exists'''
@@ -145,6 +396,31 @@ class User(UserMixin, APIMixin, db.Model):
         # argument. The result of the count() query is going to be 0 or 1, so
         # checking for the count being 1 or greater than 0 is the same.
 
+    def followed_ids(self, users):
+        '''Returns the ids of the given users that this user follows, with a
+        single query instead of one is_following() call per user.'''
+        ids = [user.id for user in users]
+        if not ids:
+            return set()
+        return {row[0] for row in db.session.query(
+            followers.c.followed_id).filter(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id.in_(ids))}
+
+    @staticmethod
+    def follow_counts(users):
+        '''Returns ({id: follower count}, {id: following count}) for the given
+        users, with one grouped query per counter.'''
+        ids = [user.id for user in users]
+
+        def count(column):
+            if not ids:
+                return {}
+            return dict(db.session.query(column, db.func.count()).filter(
+                column.in_(ids)).group_by(column))
+
+        return count(followers.c.followed_id), count(followers.c.follower_id)
+
     def followed_posts(self):
         follow_posts = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)).filter(
@@ -152,15 +428,119 @@ class User(UserMixin, APIMixin, db.Model):
         own_posts = Post.query.filter_by(user_id=self.id)
         return follow_posts.union(own_posts).order_by(Post.timestamp.desc())
 
+    def followed_posts_page(self, per_page, before=None, after=None,
+                            page=None):
+        '''Returns a CursorPage of the home timeline, reading post ids from
+        Redis and falling back to followed_posts().'''
+        pull_ids = self.followed_pull_authors()
+        cached = None
+        if page is None:
+            cached = timeline.get_page(self.id, per_page, pull_ids,
+                                       before, after)
+            if cached is None and self.warm_timeline(pull_ids):
+                cached = timeline.get_page(self.id, per_page, pull_ids,
+                                           before, after)
+        if cached is None:
+            return paginate(
+                self.followed_posts().options(db.selectinload(Post.author)),
+                Post.timestamp, Post.id, per_page, before, after, page)
+        ids, has_more = cached
+        posts = Post.get_ordered(ids)
+        if after is not None:
+            return CursorPage(posts, True, has_more)
+        return CursorPage(posts, has_more, before is not None)
+
+    def followed_pull_authors(self):
+        '''Ids of followed users with too many followers to fan out to.'''
+        if not current_app.config['TIMELINE_CACHE']:
+            return []
+        return [row[0] for row in self.following.filter(
+            User.follower_count >=
+                current_app.config['TIMELINE_FANOUT_THRESHOLD']).with_entities(
+                    User.id)]
+
+    def is_pull_author(self):
+        '''True if this user's posts are merged into timelines at read time
+        instead of being pushed to every follower.'''
+        return self.follower_count >= \
+            current_app.config['TIMELINE_FANOUT_THRESHOLD']
+
+    def recent_posts(self):
+        '''Returns (id, timestamp) pairs for the user's latest posts.'''
+        return self.posts.order_by(Post.timestamp.desc()).with_entities(
+            Post.id, Post.timestamp).limit(
+                current_app.config['TIMELINE_LENGTH']).all()
+
+    def warm_timeline(self, pull_ids):
+        '''Rebuilds whatever the user's timeline needs that is missing from
+        Redis. Returns True if anything was rebuilt.'''
+        rebuilt = False
+        if timeline.is_cold(self.id):
+            self.rebuild_timeline(pull_ids)
+            rebuilt = True
+        cold_ids = timeline.cold_authors(pull_ids)
+        if cold_ids:
+            for author in User.query.filter(User.id.in_(cold_ids)):
+                timeline.rebuild_author(author.id, author.recent_posts())
+            rebuilt = True
+        return rebuilt
+
+    def rebuild_timeline(self, pull_ids=None):
+        if pull_ids is None:
+            pull_ids = self.followed_pull_authors()
+        posts = self.followed_posts()
+        pull_ids = [id for id in pull_ids if id != self.id]
+        if pull_ids:
+            posts = posts.filter(Post.user_id.notin_(pull_ids))
+        timeline.rebuild(self.id, posts.with_entities(
+            Post.id, Post.timestamp).limit(
+                current_app.config['TIMELINE_LENGTH']).all())
+
+    def get_last_seen(self):
+        '''Returns last_seen, including a newer time still in the buffer.'''
+        if current_app.config['LAST_SEEN_BUFFER']:
+            try:
+                return last_seen.get(self.id) or self.last_seen
+            except redis.exceptions.RedisError:
+                pass
+        return self.last_seen
+
+    @staticmethod
+    def flush_last_seen():
+        '''Writes the buffered last_seen times to the database in one bulk
+        UPDATE. Returns the number of users updated.'''
+        seen = last_seen.pop_all()
+        if not seen:
+            return 0
+        user = User.__table__
+        try:
+            db.session.execute(
+                user.update().where(user.c.id == db.bindparam('user_id')).values(
+                    last_seen=db.bindparam('seen')),
+                [{'user_id': id, 'seen': when} for id, when in seen.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            last_seen.restore(seen)
+            raise
+        return len(seen)
+
     def new_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
         return Message.query.filter_by(recipient=self).filter(
             Message.timestamp > last_read_time).count()
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
+        timestamp = time()
+        if current_app.config['NOTIFICATION_BACKEND'] == 'redis':
+            n = None
+            on_commit(notifications.add, self.id, name, data, timestamp)
+        else:
+            self.notifications.filter_by(name=name).delete()
+            n = Notification(name=name, payload_json=json.dumps(data),
+                             user=self, timestamp=timestamp)
+            db.session.add(n)
+        on_commit(stream.publish, self.id, name, data, timestamp)
         return n
         # This method not only adds a notification for the user to the
         # database, but also ensures that if a notification with the same name
@@ -170,6 +550,15 @@ class User(UserMixin, APIMixin, db.Model):
         # receives a new message and the message count goes to 4, we want to
         # replace the old notification.
 
+    def get_notifications(self, since=0.0):
+        '''Returns the notifications newer than since, oldest first, as a list
+        of (name, data, timestamp).'''
+        if current_app.config['NOTIFICATION_BACKEND'] == 'redis':
+            return notifications.get_since(self.id, since)
+        return [(n.name, n.get_data(), n.timestamp) for n in
+                self.notifications.filter(Notification.timestamp > since)
+                .order_by(Notification.timestamp.asc())]
+
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue(
             'app.tasks.' + name, self.id, *args, **kwargs)
@@ -184,22 +573,42 @@ class User(UserMixin, APIMixin, db.Model):
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self, complete=False).first()
 
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z', # Z is timezone code for UTC
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'following_count': self.following.count(),
-            '_links': {
+    # the fields of to_dict() (besides id), and the columns each one needs
+    api_fields = {
+        'username': ['username'],
+        'last_seen': ['last_seen'],
+        'about_me': ['about_me'],
+        'post_count': ['post_count'],
+        'follower_count': ['follower_count'],
+        'following_count': ['following_count'],
+        '_links': ['email'],  # for the avatar
+    }
+
+    def to_dict(self, include_email=False, fields=None):
+        '''fields is the set of fields to include besides the id, all of them
+        if it is None.'''
+        def wanted(field):
+            return fields is None or field in fields
+
+        data = {'id': self.id}
+        if wanted('username'):
+            data['username'] = self.username
+        if wanted('last_seen'):
+            data['last_seen'] = self.last_seen.isoformat() + 'Z' # Z is timezone code for UTC
+        if wanted('about_me'):
+            data['about_me'] = self.about_me
+        # the counters are columns (see add_to_counter()), so they come with
+        # the row and cost nothing more for a whole page of users
+        for counter in ('post_count', 'follower_count', 'following_count'):
+            if wanted(counter):
+                data[counter] = getattr(self, counter)
+        if wanted('_links'):
+            data['_links'] = {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'following': url_for('api.get_following', id=self.id),
                 'avatar': self.avatar(200)
             }
-        }
         if include_email:
             data['email'] = self.email
         return data
@@ -258,6 +667,144 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @staticmethod
+    def wants_pretranslation(language, author):
+        '''Whether a post in language by author is popular enough to be
+        translated ahead of time (see app/translate.py).'''
+        return current_app.config['PRETRANSLATE'] and bool(language) and \
+            author is not None and author.follower_count >= \
+            current_app.config['PRETRANSLATE_MIN_FOLLOWERS']
+
+    @classmethod
+    def get_ordered(cls, ids):
+        '''Loads the posts with the given ids (and their authors), in the
+        order given.'''
+        if not ids:
+            return []
+        posts = {post.id: post for post in cls.query.filter(
+            cls.id.in_(ids)).options(db.selectinload(cls.author))}
+        return [posts[id] for id in ids if id in posts]
+
+    @classmethod
+    def insert_many(cls, rows, batch_size=200):
+        '''Inserts rows (dicts of column values) into the posts table with
+        one multi-row INSERT per batch_size rows, and returns their ids in
+        order. The batches stay under SQLite's limit of 999 parameters.'''
+        table = cls.__table__
+        dialect = db.session.get_bind().dialect
+        ids = []
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            insert = table.insert().values(batch)
+            if dialect.implicit_returning:
+                # PostgreSQL hands the ids back in the order of the VALUES
+                ids += [id for id, in db.session.execute(
+                    insert.returning(table.c.id))]
+            elif dialect.name == 'sqlite':
+                # a statement writes with the database locked, so its rows
+                # get consecutive ids ending at the last one inserted
+                last = db.session.execute(insert).lastrowid
+                ids += range(last - len(batch) + 1, last + 1)
+            else:
+                # nothing portable tells which ids a multi-row INSERT got
+                ids += [db.session.execute(
+                    table.insert(), row).inserted_primary_key[0]
+                    for row in batch]
+        return ids
+
+    @classmethod
+    def bulk_create(cls, author, posts):
+        '''Inserts posts, a list of (body, language), by author with
+        insert_many(), and does for them what after_flush() and
+        before_commit() do for posts added to the session. Returns their ids,
+        in order. The caller commits.'''
+        timestamp = datetime.utcnow()
+        ids = cls.insert_many([
+            {'body': body, 'language': language, 'user_id': author.id,
+             'timestamp': timestamp} for body, language in posts])
+        author.add_to_counter('post_count', len(posts))
+        # the session can't be queried once it has committed, so the index
+        # gets objects that are never added to it
+        on_commit(cls.index_inserted, [
+            cls(id=id, body=body) for id, (body, _) in zip(ids, posts)])
+        detect_later = current_app.config['LANGUAGE_DETECTION'] == 'async'
+        for id, (body, language) in zip(ids, posts):
+            if language is None and detect_later:
+                on_commit(queue_detection, id)
+            elif cls.wants_pretranslation(language, author):
+                on_commit(queue_pretranslation, id)
+        if current_app.config['TIMELINE_CACHE']:
+            if author.is_pull_author():
+                for id in ids:
+                    on_commit(timeline.push_post, id, timestamp, [author.id],
+                              author.id)
+            else:
+                user_ids = [author.id] + [row[0] for row in db.session.query(
+                    followers.c.follower_id).filter(
+                        followers.c.followed_id == author.id)]
+                for id in ids:
+                    on_commit(timeline.push_post, id, timestamp, user_ids)
+        return ids
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        post_counts = {}
+        for obj in session.new:
+            if isinstance(obj, cls):
+                post_counts[obj.author] = post_counts.get(obj.author, 0) + 1
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                post_counts[obj.author] = post_counts.get(obj.author, 0) - 1
+        for author, delta in post_counts.items():
+            if author is not None and delta:
+                author.add_to_counter('post_count', delta, session=session)
+
+        detect_later = current_app.config['LANGUAGE_DETECTION'] == 'async'
+        for obj in session.new:
+            if isinstance(obj, cls):
+                if obj.language is None and detect_later:
+                    on_commit(queue_detection, obj.id, session=session)
+                elif cls.wants_pretranslation(obj.language, obj.author):
+                    on_commit(queue_pretranslation, obj.id, session=session)
+
+        if not current_app.config['TIMELINE_CACHE']:
+            return
+        for obj in session.new:
+            if isinstance(obj, cls):
+                # push to every follower, unless there are so many that the
+                # post is better pulled in at read time (see app/timeline.py)
+                if obj.author.is_pull_author():
+                    on_commit(timeline.push_post, obj.id, obj.timestamp,
+                              [obj.user_id], obj.user_id, session=session)
+                else:
+                    follower_ids = [row[0] for row in session.query(
+                        followers.c.follower_id).filter(
+                            followers.c.followed_id == obj.user_id)]
+                    on_commit(timeline.push_post, obj.id, obj.timestamp,
+                              [obj.user_id] + follower_ids, session=session)
+
+
+class Translation(db.Model):
+    '''A post translated ahead of time (see pretranslate_post in tasks.py).'''
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), index=True)
+    language = db.Column(db.String(5))
+    body = db.Column(db.Text)
+    __table_args__ = (db.UniqueConstraint('post_id', 'language'),)
+
+    @staticmethod
+    def for_posts(posts, language):
+        '''Returns {post_id: translated body} for the posts that have been
+        translated to language, in one query.'''
+        ids = [post.id for post in posts if post.language and
+               post.language != language]
+        if not ids:
+            return {}
+        return dict(db.session.query(
+            Translation.post_id, Translation.body).filter(
+                Translation.post_id.in_(ids),
+                Translation.language == language))
+
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -281,6 +828,36 @@ class Notification(db.Model):
         return json.loads(str(self.payload_json))
 
 
+class QueuedEmail(db.Model):
+    '''An email in the outbox (see app/outbox.py), one per recipient.'''
+    id = db.Column(db.Integer, primary_key=True)
+    # set until the email is sent, to keep it from being queued twice
+    key = db.Column(db.String(64), index=True, unique=True)
+    recipient = db.Column(db.String(120), index=True)
+    sender = db.Column(db.String(120))
+    subject = db.Column(db.String(256))
+    text_body = db.Column(db.Text)
+    html_body = db.Column(db.Text)
+    attachments_json = db.Column(db.Text)
+    digest = db.Column(db.Boolean, default=False)
+    # pending, sending, sent, digested or failed
+    status = db.Column(db.String(10), index=True, default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    sent = db.Column(db.DateTime)
+
+    def get_attachments(self):
+        return [(filename, content_type, base64.b64decode(data))
+                for filename, content_type, data in
+                json.loads(self.attachments_json or '[]')]
+
+    def set_attachments(self, attachments):
+        self.attachments_json = json.dumps([
+            (filename, content_type, base64.b64encode(data).decode('ascii'))
+            for filename, content_type, data in attachments or []])
+
+
 class Task(db.Model):
     # An interesting difference between this model and the previous ones is
     # that the id primary key field is a string, not an integer. This is
@@ -304,8 +881,12 @@ class Task(db.Model):
         return job.meta.get('progress', 0) if job is not None else 100
 
 
+db.event.listen(db.session, 'before_flush', User.before_flush)
 db.event.listen(db.session, 'before_commit', Post.before_commit)
 db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_commit', _run_on_commit)
+db.event.listen(db.session, 'after_rollback', _discard_on_commit)
 
 
 # db.relationship
@@ -605,11 +1186,17 @@ def example_posts(self):
 # indexes will be named with the name Flask-SQLAlchemy assigned to the
 # relational table.
 
-# The SQLAlchemy query that retrieves the list of objects by their IDs is based
-# on a CASE statement from the SQL language, which needs to be used to ensure
-# that the results from the database come in the same order as the IDs are
-# given. This is important because the Elasticsearch query returns results
-# sorted from more to less relevant.
+# The objects need to come back in the same order as the IDs are given,
+# because the Elasticsearch query returns results sorted from more to less
+# relevant. The first version did that in SQL, with ORDER BY CASE id WHEN 7
+# THEN 0 WHEN 3 THEN 1 ... END, an expression that grows with the page size
+# and that the database has to evaluate for every row before it can sort, with
+# no index to help. get_ordered() instead loads the page of rows by primary key
+# (a plain WHERE id IN (...)) into a dictionary and puts them in order in
+# Python, which for 25 rows costs next to nothing. Post overrides it to load
+# the authors in the same round of queries. search() now returns a list
+# rather than a query, and ids the index knows about but the database doesn't
+# (deleted rows not yet removed from the index) are simply skipped.
 
 # The before_commit() and after_commit() methods are going to respond to two
 # events from SQLAlchemy, which are triggered before and after a commit takes
@@ -647,7 +1234,7 @@ def example_posts(self):
 # >>> Post.reindex()
 
 # Then try a search:
-# >>> query, total = Post.search('flask', 1, 10)
+# >>> posts, total = Post.search('flask', 1, 10)
 # >>> total
 # 3
 
@@ -667,6 +1254,43 @@ def example_posts(self):
 # requested.
 
 
+# on_commit()
+# -----------------------------------------------------------------------------
+# Some changes have side effects outside of the database, for example the home
+# timelines kept in Redis (see app/timeline.py). These should only happen if
+# the database changes actually get committed, so instead of writing to Redis
+# straight away, the models register the write with on_commit(). The calls
+# are stored in session.info (a dictionary SQLAlchemy gives each session for
+# this kind of thing), run by the after_commit event and thrown away by the
+# after_rollback event.
+
+# Any database reads the side effect needs (like the list of followers of an
+# author) are done before the commit. Once the after_commit event fires, the
+# session's transaction is over and no further SQL can be issued on it.
+
+
+# Denormalized counters
+# -----------------------------------------------------------------------------
+# Showing how many posts, followers and followed users someone has used to
+# cost a COUNT(*) query each, for every user in an API response and every
+# post popover. Instead, the User model has post_count, follower_count and
+# following_count columns that are updated in the same transaction as the
+# change they count: follow() and unfollow() adjust the follower/following
+# counters, and Post.after_flush() adjusts post_count for every post added to
+# or deleted from the session.
+
+# add_to_counter() does this with an UPDATE ... SET x = x + 1 statement
+# rather than reading the value into Python, adding one and writing it back,
+# because two requests doing the latter at the same time would both write the
+# same number and one of the changes would be lost.
+
+# A bug or a manual change in the database can still make a counter drift
+# from the real count, so there's a command to find and fix that:
+
+# (venv) $ flask counters check
+# (venv) $ flask counters check --repair
+
+
 # misc notes:
 # -----------------------------------------------------------------------------
 # Note that setting a VARCHAR (maximum string length) helps a database optimize
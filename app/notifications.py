@@ -0,0 +1,66 @@
+import json
+from flask import current_app
+import redis
+
+
+def _key(user_id):
+    return 'notifications:{}'.format(user_id)
+
+
+def _data_key(user_id):
+    return 'notifications:{}:data'.format(user_id)
+
+
+def add(user_id, name, data, timestamp):
+    '''Stores the latest notification with this name for a user, replacing
+    the previous one.'''
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hset(_data_key(user_id), name, json.dumps(data))
+        pipe.zadd(_key(user_id), **{name: timestamp})
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not store notification %s for '
+                                   'user %s', name, user_id, exc_info=True)
+
+
+def get_since(user_id, since):
+    '''Returns the notifications of a user newer than since, oldest first,
+    as a list of (name, data, timestamp).'''
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(_key(user_id), '({!r}'.format(since), '+inf',
+                           withscores=True)
+        # a handful of fields at most, so reading them all is cheaper than
+        # a second round trip to HMGET the ones we need
+        pipe.hgetall(_data_key(user_id))
+        names, payloads = pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not read notifications for user %s',
+                                   user_id, exc_info=True)
+        return []
+    return [(name.decode('utf-8'), json.loads(payloads[name].decode('utf-8')),
+             timestamp) for name, timestamp in names if name in payloads]
+
+
+# Notifications in Redis
+# -----------------------------------------------------------------------------
+# A notification is really just "the latest value of X for user Y", but with
+# the Notification model every new value is a DELETE and an INSERT, and that
+# happens on every message sent and on every progress tick of a background
+# task, while the page asks for new ones with a query on the timestamp index.
+
+# With NOTIFICATION_BACKEND = 'redis' the latest value of each notification
+# is kept in Redis instead, in two keys per user:
+# - notifications:<user_id>:data, a hash of name -> JSON payload,
+# - notifications:<user_id>, a sorted set of names scored by timestamp.
+
+# Replacing a notification is an HSET and a ZADD (which moves the name to its
+# new score), and /notifications?since= is a ZRANGEBYSCORE with an exclusive
+# lower bound, sent in the same pipeline as an HGETALL of the payloads. As in
+# the SQL version, the store is only written once the transaction that added
+# the notification commits (see User.add_notification()).
+
+# The default is still 'sql', which keeps using the Notification table and
+# works without Redis. Switching backends doesn't move the old notifications
+# across, which is fine since they are replaced on the next message or task.
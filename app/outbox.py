@@ -0,0 +1,245 @@
+from datetime import datetime, timedelta
+import hashlib
+import smtplib
+from flask import current_app
+from flask_mail import Message
+from markupsafe import escape
+import redis
+from sqlalchemy.exc import IntegrityError
+from app import db, mail
+from app.models import QueuedEmail, on_commit
+
+
+def _key(*parts):
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def add(subject, sender, recipients, text_body, html_body, attachments=None,
+        key=None, digest=False):
+    '''Saves an email to the outbox, one per recipient, and commits. It is
+    sent by the RQ worker once the commit is done. An email with the same
+    key as one still waiting in the outbox (by default, the same recipient
+    and content) is not added again. Low priority emails (digest=True) are
+    combined with the others of the same recipient and sent later.'''
+    content = [subject, text_body, html_body] + [
+        hashlib.sha256(data).hexdigest() for _, _, data in attachments or []]
+    emails = {}
+    for recipient in recipients:
+        email = QueuedEmail(
+            key=_key(key, recipient) if key else _key(recipient, *content),
+            recipient=recipient, sender=sender, subject=subject,
+            text_body=text_body, html_body=html_body, digest=digest)
+        email.set_attachments(attachments)
+        emails[email.key] = email
+    # only the emails that haven't gone out yet have a key (see _done())
+    known = {key for key, in db.session.query(QueuedEmail.key).filter(
+        QueuedEmail.key.in_(list(emails)))}
+    emails = [email for key, email in emails.items() if key not in known]
+    if not emails:
+        return
+    try:
+        # in a savepoint, so that losing the race below doesn't roll back
+        # whatever else the caller has in the session
+        with db.session.begin_nested():
+            db.session.add_all(emails)
+    except IntegrityError:
+        # the same email, added by another request in the meantime
+        return
+    if not digest:
+        on_commit(queue_delivery, [email.id for email in emails])
+    db.session.commit()
+
+
+def _done(email, status):
+    # frees the key, so the same email can be sent again later
+    email.status = status
+    email.key = None
+
+
+def queue_delivery(ids):
+    try:
+        current_app.task_queue.enqueue('app.tasks.deliver_emails', ids)
+    except redis.exceptions.RedisError:
+        # still in the outbox, flask mail outbox will queue them again
+        current_app.logger.warning('Could not queue the delivery of emails '
+                                   '%s', ids, exc_info=True)
+
+
+def _claim(id, now):
+    # only one worker gets to send each email, and if it dies while sending,
+    # the email is given to another one once next_attempt has passed
+    claimed = QueuedEmail.query.filter(
+        QueuedEmail.id == id, QueuedEmail.status == 'pending',
+        QueuedEmail.next_attempt <= now).update({
+            'status': 'sending',
+            'next_attempt': now + timedelta(
+                seconds=current_app.config['MAIL_SEND_TIMEOUT'])},
+        synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def _message(email):
+    msg = Message(email.subject, sender=email.sender,
+                  recipients=[email.recipient])
+    msg.body = email.text_body
+    msg.html = email.html_body
+    # the same Message-ID on every attempt, so a mail client can tell that
+    # an email it got twice is the same one
+    msg.msgId = '<outbox.{}.{:%Y%m%d%H%M%S}@microblog>'.format(
+        email.id, email.created)
+    for attachment in email.get_attachments():
+        msg.attach(*attachment)
+    return msg
+
+
+def _failed(email, now):
+    email.attempts += 1
+    if email.attempts >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        current_app.logger.error('Giving up on email %s to %s', email.id,
+                                 email.recipient)
+        _done(email, 'failed')
+    else:
+        email.status = 'pending'
+        email.next_attempt = now + timedelta(
+            seconds=current_app.config['MAIL_RETRY_DELAY'] *
+            2 ** (email.attempts - 1))
+
+
+def deliver(ids):
+    '''Sends the emails of the outbox with the given ids that are due, over
+    one SMTP connection. Returns how many were sent.'''
+    now = datetime.utcnow()
+    emails = [QueuedEmail.query.get(id) for id in ids if _claim(id, now)]
+    if not emails:
+        return 0
+    sent = 0
+    try:
+        with mail.connect() as conn:
+            for email in emails:
+                try:
+                    conn.send(_message(email))
+                except (smtplib.SMTPException, OSError):
+                    current_app.logger.warning(
+                        'Could not send email %s', email.id, exc_info=True)
+                    _failed(email, now)
+                else:
+                    _done(email, 'sent')
+                    email.sent = datetime.utcnow()
+                    sent += 1
+                db.session.commit()
+    except (smtplib.SMTPException, OSError):
+        current_app.logger.warning('Could not connect to the mail server',
+                                   exc_info=True)
+    for email in emails:
+        if email.status == 'sending':
+            _failed(email, now)
+    db.session.commit()
+    return sent
+
+
+def digest(recipient):
+    '''Combines the low priority emails waiting for recipient into one, and
+    queues it for delivery.'''
+    emails = QueuedEmail.query.filter_by(
+        recipient=recipient, digest=True, status='pending').order_by(
+            QueuedEmail.created).all()
+    if not emails:
+        return
+    if len(emails) == 1:
+        subject = emails[0].subject
+    else:
+        subject = 'Microblog: {} updates'.format(len(emails))
+    attachments = []
+    for email in emails:
+        attachments += email.get_attachments()
+        _done(email, 'digested')
+    combined = QueuedEmail(
+        key=_key('digest', *[str(email.id) for email in emails]),
+        recipient=recipient, sender=emails[0].sender, subject=subject,
+        text_body='\n\n---\n\n'.join('{}\n\n{}'.format(
+            email.subject, email.text_body) for email in emails),
+        html_body='<hr>'.join('<h3>{}</h3>{}'.format(
+            escape(email.subject), email.html_body) for email in emails))
+    combined.set_attachments(attachments)
+    db.session.add(combined)
+    db.session.flush()
+    on_commit(queue_delivery, [combined.id])
+    db.session.commit()
+
+
+def sweep(batch_size=100):
+    '''Queues the emails that are due for another attempt (or whose worker
+    died while sending them), and the digests that are due. Returns the
+    number of emails and digests queued.'''
+    now = datetime.utcnow()
+    # a new email that has never been tried probably has its job waiting in
+    # the queue, give it a while before queuing another one
+    fresh = now - timedelta(seconds=current_app.config['MAIL_RETRY_DELAY'])
+    ids = [id for id, in db.session.query(QueuedEmail.id).filter(
+        QueuedEmail.status.in_(('pending', 'sending')),
+        QueuedEmail.digest.is_(False),
+        QueuedEmail.next_attempt <= now,
+        db.or_(QueuedEmail.attempts > 0, QueuedEmail.status == 'sending',
+               QueuedEmail.created <= fresh)).order_by(QueuedEmail.id)]
+    # an email abandoned by a dead worker is pending again
+    QueuedEmail.query.filter(
+        QueuedEmail.status == 'sending',
+        QueuedEmail.next_attempt <= now).update(
+            {'status': 'pending'}, synchronize_session=False)
+    db.session.commit()
+    for i in range(0, len(ids), batch_size):
+        queue_delivery(ids[i:i + batch_size])
+    cutoff = now - timedelta(seconds=current_app.config['MAIL_DIGEST_INTERVAL'])
+    recipients = [recipient for recipient, in db.session.query(
+        QueuedEmail.recipient).filter(
+            QueuedEmail.digest.is_(True),
+            QueuedEmail.status == 'pending').group_by(
+                QueuedEmail.recipient).having(
+                    db.func.min(QueuedEmail.created) <= cutoff)]
+    for recipient in recipients:
+        digest(recipient)
+    return len(ids), len(recipients)
+
+
+# The outbox
+# -----------------------------------------------------------------------------
+# Emails sent by a thread of the web process (app/mailer.py) are lost if the
+# mail server is down, or if the process is restarted before they go out. With
+# MAIL_OUTBOX=on, send_email() saves the email in the QueuedEmail table
+# instead, one row per recipient, and commits before returning. Once the
+# commit is done, a deliver_emails job is queued on RQ, which sends it. The
+# request never talks to the mail server, and once send_email() returns the
+# email is in the database, whatever happens next.
+
+# The worker claims each email before sending it (an UPDATE from pending to
+# sending that only one worker can win), sends the batch over one SMTP
+# connection and marks them sent. An email that fails is tried again after
+# MAIL_RETRY_DELAY seconds, then twice that, and so on, up to
+# MAIL_MAX_ATTEMPTS attempts, after which it is marked failed and logged.
+# RQ can't schedule a job for later, so the retries (and the emails whose job
+# couldn't be queued because Redis was down, and those of a worker that died
+# while sending) are queued again by a command that cron runs every minute:
+
+# (venv) $ flask mail outbox
+
+# Delivery is at least once: if a worker dies after sending an email but
+# before marking it sent, the email goes out again. To make that harmless,
+# the Message-ID is made from the id of the row, so the copies are
+# recognisably the same message. Each email also has a key that stops the
+# same email from being queued twice while it is waiting: by default it is a
+# hash of the recipient and the whole content (attachments included), so a
+# password reset form submitted twice in the same second sends one email.
+# Callers can pass their own key instead. The key is cleared once the email
+# is sent (or given up on, or put in a digest), so sending the same email
+# again later, like a second export of the same posts, works.
+
+# add() commits the session, since that is what makes the email safe, so
+# call send_email() once the rest of the request's changes are ready to be
+# committed too. Losing the race for a key to another request only rolls
+# back the savepoint the email was added in.
+
+# Low priority emails (send_email(..., digest=True)) are not sent one at a
+# time. Once the oldest one for a recipient has waited MAIL_DIGEST_INTERVAL
+# seconds, flask mail outbox combines all of them into a single email, which
+# then goes through the outbox like any other.
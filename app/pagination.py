@@ -0,0 +1,130 @@
+import base64
+from datetime import datetime
+import json
+from flask import abort, request
+from app import db
+
+
+def encode_cursor(obj):
+    '''Returns an opaque token for the (timestamp, id) position of obj.'''
+    value = '{}|{}'.format(obj.timestamp.isoformat(), obj.id)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    '''Returns the (timestamp, id) in a token made by encode_cursor(). Raises
+    ValueError if it isn't one.'''
+    try:
+        value = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+        timestamp, id = value.split('|')
+        try:
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+        except ValueError:
+            timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+        return timestamp, int(id)
+    except (ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+
+
+def encode_key(values):
+    '''Returns an opaque token for a list of sort values (see app/search.py).'''
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_key(token):
+    '''Returns the list of sort values in a token made by encode_key(). Raises
+    ValueError if it isn't one, which the views turn into a 404 and the API
+    into a 400.'''
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+
+def get_cursor_args():
+    '''Reads the before=/after= cursors (and the old page= number) from the
+    query string, as keyword arguments for paginate().'''
+    before = request.args.get('before')
+    after = request.args.get('after')
+    try:
+        return {
+            'before': decode_cursor(before) if before else None,
+            'after': decode_cursor(after) if after else None,
+            'page': request.args.get('page', type=int)
+        }
+    except ValueError:
+        abort(404)
+
+
+class CursorPage():
+    '''A page of results, with cursors for the next (older) and previous
+    (newer) pages instead of page numbers.'''
+    def __init__(self, items, has_next, has_prev, cursor=encode_cursor):
+        self.items = items
+        self.next_cursor = cursor(items[-1]) if has_next and items else None
+        self.prev_cursor = cursor(items[0]) if has_prev and items else None
+
+    @classmethod
+    def from_rows(cls, rows, per_page, before=None, after=None):
+        '''Builds the page from up to per_page + 1 rows fetched past the
+        cursor, newest first. The extra row tells us if there is more.'''
+        has_more = len(rows) > per_page
+        if after is not None:
+            return cls(rows[:per_page], True, has_more)
+        return cls(rows[:per_page], has_more, before is not None)
+
+
+def paginate(query, timestamp, id, per_page, before=None, after=None,
+             page=None):
+    '''Keyset pagination of query on (timestamp, id), newest first.'''
+    if page is not None and before is None and after is None:
+        # links from before cursors existed still use OFFSET pagination
+        posts = query.order_by(None).order_by(
+            timestamp.desc(), id.desc()).paginate(page, per_page, False)
+        return CursorPage(posts.items, posts.has_next, posts.has_prev)
+    query = query.order_by(None)
+    if after is not None:
+        rows = query.filter(db.or_(
+            timestamp > after[0],
+            db.and_(timestamp == after[0], id > after[1]))).order_by(
+                timestamp.asc(), id.asc()).limit(per_page + 1).all()
+        # newest first, keeping the extra row (if any) at the end
+        rows = rows[:per_page][::-1] + rows[per_page:]
+    else:
+        if before is not None:
+            query = query.filter(db.or_(
+                timestamp < before[0],
+                db.and_(timestamp == before[0], id < before[1])))
+        rows = query.order_by(timestamp.desc(), id.desc()).limit(
+            per_page + 1).all()
+    return CursorPage.from_rows(rows, per_page, before, after)
+
+
+# Keyset (cursor) pagination
+# -----------------------------------------------------------------------------
+# Flask-SQLAlchemy's paginate() turns page 10,000 into OFFSET 249975, and the
+# database has to walk past all of those rows to find the 25 we want, so every
+# page is slower than the one before it. Keyset pagination remembers where the
+# last page ended instead, and asks for the rows that come after that point:
+
+# WHERE timestamp < :ts OR (timestamp = :ts AND id < :id)
+# ORDER BY timestamp DESC, id DESC LIMIT 26
+
+# With an index on timestamp this costs the same on every page. The id is
+# there to break ties between posts with the same timestamp, so no row is
+# skipped or shown twice. We fetch one row more than we need to find out if
+# there is another page after this one.
+
+# The position is passed around in the URL as an opaque token (the timestamp
+# and the id, base64 encoded), in before= for older posts and after= for
+# newer ones. Going back to newer posts runs the same query the other way
+# (ascending, with the comparisons flipped) and reverses the rows.
+
+# The ?page= links that were handed out before this change (bookmarks, search
+# engines) still work, they just get the old OFFSET query, and the links on
+# that page are cursor links again.
@@ -1,31 +1,297 @@
+import hashlib
+import json
+from time import time
+from uuid import uuid4
+from elasticsearch import helpers
+from elasticsearch.exceptions import ElasticsearchException
 from flask import current_app
+import redis
+from app.fts import SQLiteBackend
 
+# queued changes are read straight after they are taken, so a snapshot this
+# old belongs to a job that died in between (see pop_queued())
+SNAPSHOT_TIMEOUT = 60
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+
+class ElasticsearchBackend():
+    '''Search backend that talks to an Elasticsearch cluster.'''
+    # errors worth retrying later (see index_queued in app/tasks.py)
+    errors = (ElasticsearchException,)
+
+    def __init__(self, client):
+        self.client = client
+        self._version = None
+        self._mapped = set()
+
+    def _map_id(self, index):
+        # the id is also stored as a number that hits can be sorted on
+        # (sorting on _id needs fielddata, which Elasticsearch 8 refuses);
+        # not indexed, so the search terms are never matched against it
+        if index in self._mapped:
+            return
+        self.client.indices.create(index=index, ignore=400)
+        self.client.indices.put_mapping(index=index, doc_type=index, body={
+            'properties': {'id': {'type': 'long', 'index': False}}})
+        self._mapped.add(index)
+
+    def index(self, index, documents):
+        '''Adds or replaces (id, payload) documents with a single bulk
+        request. Returns the number of documents that were indexed.'''
+        self._map_id(index)
+        actions = [{'_index': index, '_type': index, '_id': id,
+                    '_source': dict(payload, id=id)}
+                   for id, payload in documents]
+        # refresh='wait_for' returns once the documents are searchable, so
+        # the cache generation isn't bumped while searches still miss them
+        indexed, errors = helpers.bulk(self.client, actions,
+                                       chunk_size=len(actions),
+                                       raise_on_error=False, max_retries=3,
+                                       refresh='wait_for')
+        for error in errors:
+            current_app.logger.warning('Could not index %s: %s', index, error)
+        return indexed
+
+    def remove(self, index, ids):
+        actions = [{'_op_type': 'delete', '_index': index, '_type': index,
+                    '_id': id} for id in ids]
+        _, errors = helpers.bulk(self.client, actions, chunk_size=len(actions),
+                                 raise_on_error=False, max_retries=3,
+                                 refresh='wait_for')
+        for error in errors:
+            if error.get('delete', {}).get('status') != 404:
+                current_app.logger.warning('Could not remove from %s: %s',
+                                           index, error)
+
+    def _track_total_hits(self, max_total):
+        # Elasticsearch 7 can stop counting hits at max_total, older versions
+        # always count them all and reject the parameter
+        if self._version is None:
+            self._version = int(
+                self.client.info()['version']['number'].split('.')[0])
+        return {'track_total_hits': max_total} if self._version >= 7 else {}
+
+    def _search(self, index, body, max_total):
+        body = dict(body, **self._track_total_hits(max_total))
+        search = self.client.search(index=index, doc_type=index, body=body)
+        total = search['hits']['total']
+        if isinstance(total, dict):
+            total = total['value']
+        return search['hits']['hits'], total
+
+    def query(self, index, query, page, per_page, max_total=10000):
+        hits, total = self._search(index, {
+            'query': {'multi_match': {'query': query, 'fields': ['*']}},
+            'from': (page - 1) * per_page, 'size': per_page}, max_total)
+        return [int(hit['_id']) for hit in hits], total
+
+    def query_after(self, index, query, size, after=None, reverse=False,
+                    max_total=10000):
+        '''Returns up to size (id, sort key) hits following the sort key
+        after, best first (worst first if reverse), and the total.'''
+        order = 'asc' if reverse else 'desc'
+        body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                'size': size,
+                'sort': [{'_score': order}, {'id': order}]}
+        if after is not None:
+            body['search_after'] = after
+        hits, total = self._search(index, body, max_total)
+        return [(int(hit['_id']), hit['sort']) for hit in hits], total
+
+
+def create_backend(app):
+    '''Returns the search backend selected by SEARCH_BACKEND, or None when
+    search is not configured.'''
+    backend = app.config['SEARCH_BACKEND']
+    if backend == 'sqlite':
+        return SQLiteBackend(app.config['SEARCH_SQLITE_PATH'])
+    if backend == 'elasticsearch' and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    return None
+
+
+def _payload(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, doc_type=index, id=model.id,
-                                    body=payload)
+    return payload
+
+
+def add_to_index(index, model):
+    if not current_app.search_backend:
+        return
+    current_app.search_backend.index(index, [(model.id, _payload(model))])
+
+
+def bulk_index(index, models):
+    '''Indexes many models at once. Returns the number of documents that
+    were indexed.'''
+    if not current_app.search_backend or not models:
+        return 0
+    return current_app.search_backend.index(
+        index, [(model.id, _payload(model)) for model in models])
+
+
+def bulk_remove(index, ids):
+    '''Removes many documents at once.'''
+    if not current_app.search_backend or not ids:
+        return
+    current_app.search_backend.remove(index, ids)
+
+
+def _queue_key(index):
+    return 'search:queue:{}'.format(index)
+
+
+def _schedule(pipe, index):
+    # only one job at a time per index, until it starts running
+    pipe.set(_queue_key(index) + ':scheduled', 1, nx=True,
+             ex=current_app.config['SEARCH_QUEUE_TIMEOUT'])
+
+
+def queue_changes(index, add_ids, delete_ids):
+    '''Queues index changes to be applied in bulk by the index_queued task.
+    Returns False if they could not be queued.'''
+    if not current_app.search_backend or not (add_ids or delete_ids):
+        return True
+    changes = {str(id): 'add' for id in add_ids}
+    changes.update({str(id): 'delete' for id in delete_ids})
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.hmset(_queue_key(index), changes)
+        _schedule(pipe, index)
+        _, schedule = pipe.execute()
+        if schedule:
+            current_app.task_queue.enqueue('app.tasks.index_queued', index)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not queue changes to %s', index,
+                                   exc_info=True)
+        return False
+    return True
+
+
+def pop_queued(index):
+    '''Takes all the queued changes of an index, as {id: 'add' or 'delete'},
+    including those of a job that died while taking them.'''
+    conn = current_app.redis
+    key = _queue_key(index)
+    conn.delete(key + ':scheduled')
+    now = time()
+    snapshot = '{}:processing:{}'.format(key, uuid4().hex)
+    # recorded in the same transaction as the rename, as in app/last_seen.py
+    pipe = conn.pipeline()
+    pipe.zadd(key + ':snapshots', **{snapshot: now})
+    pipe.rename(key, snapshot)
+    try:
+        pipe.execute()
+    except redis.exceptions.ResponseError:
+        conn.zrem(key + ':snapshots', snapshot)  # nothing queued
+        snapshot = None
+    # oldest first, so newer changes to the same id win
+    snapshots = conn.zrangebyscore(key + ':snapshots', 0,
+                                   now - SNAPSHOT_TIMEOUT)
+    if snapshot:
+        snapshots.append(snapshot)
+    if not snapshots:
+        return {}
+    pipe = conn.pipeline()
+    for name in snapshots:
+        pipe.hgetall(name)
+    pipe.delete(*snapshots)
+    pipe.zrem(key + ':snapshots', *snapshots)
+    changes = {}
+    for queued in pipe.execute()[:len(snapshots)]:
+        changes.update({int(id): op.decode('utf-8')
+                        for id, op in queued.items()})
+    return changes
+
+
+def restore_queued(index, changes):
+    '''Puts changes that could not be applied back in the queue, without
+    overwriting newer ones, and queues a job to try them again.'''
+    pipe = current_app.redis.pipeline()
+    for id, op in changes.items():
+        pipe.hsetnx(_queue_key(index), id, op)
+    _schedule(pipe, index)
+    if pipe.execute()[-1]:
+        current_app.task_queue.enqueue('app.tasks.index_queued', index)
+
 
 def remove_from_index(index, model):
     # (assuming one day we'll support deleting blog posts)
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, doc_type=index, id=model.id)
+    current_app.search_backend.remove(index, [model.id])
+
+
+def _generation_key(index):
+    return 'search:generation:{}'.format(index)
+
+
+def bump_generation(index):
+    '''Makes the cached results of an index stale, after it changed.'''
+    if not current_app.search_backend or not current_app.search_cache:
+        return
+    try:
+        current_app.redis.incr(_generation_key(index))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate the %s search cache',
+                                   index, exc_info=True)
+
+
+def _cached(index, key, compute):
+    '''Returns compute(), cached under key and the generation of the index
+    if the search cache is on.'''
+    cache = current_app.search_cache
+    if not cache:
+        return compute()
+    try:
+        generation = int(current_app.redis.get(_generation_key(index)) or 0)
+    except redis.exceptions.RedisError:
+        # can't tell if cached results are stale
+        return compute()
+    key = hashlib.sha1(json.dumps([index, generation] + key).encode(
+        'utf-8')).hexdigest()
+    cached = cache.get(key)
+    if cached is None:
+        cached = compute()
+        cache.set(key, cached)
+    return cached
+
+
+def _normalize(query):
+    return ' '.join(query.lower().split())
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, doc_type=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']
+    ids, total = _cached(
+        index, [_normalize(query), page, per_page],
+        lambda: list(current_app.search_backend.query(
+            index, query, page, per_page,
+            max_total=current_app.config['SEARCH_MAX_TOTAL'])))
+    return ids, total
+
+
+def query_index_after(index, query, per_page, after=None, before=None):
+    '''Returns a page of hits following the sort key after, or preceding
+    the sort key before, as (hits, total, has_next, has_prev). The hits are
+    (id, sort key) pairs, best first.'''
+    if not current_app.search_backend:
+        return [], 0, False, False
+    hits, total = _cached(
+        index, [_normalize(query), per_page, after, before],
+        lambda: list(current_app.search_backend.query_after(
+            index, query, per_page + 1, after=before or after,
+            reverse=before is not None,
+            max_total=current_app.config['SEARCH_MAX_TOTAL'])))
+    # one hit more than needed, to know if there is another page
+    has_more = len(hits) > per_page
+    hits = [tuple(hit) for hit in hits[:per_page]]
+    if before is not None:
+        hits.reverse()
+        return hits, total, True, has_more
+    return hits, total, has_more, after is not None
 
 
 # All the code that interacts with the Elasticsearch index is in this module.
@@ -35,7 +301,7 @@ def query_index(index, query, page, per_page):
 # engine, all you need to do is rewrite the functions in this module, and the
 # application will continue to work as before.
 
-# These functions all start by checking if app.elasticsearch is None, and in
+# These functions all start by checking if app.search_backend is None, and in
 # that case return without doing anything. This is so that when the
 # Elasticsearch server isn't configured, the application continues to run
 # without the search capability and without giving any errors. This is just
@@ -93,3 +359,111 @@ def query_index(index, query, page, per_page):
 # Elasticsearch index. We'll do all this using a 'mixin' class (see models.py).
 # This class will act as a "glue" layer between the SQLAlchemy and
 # Elasticsearch worlds.
+
+
+# Bulk reindexing
+# -----------------------------------------------------------------------------
+# add_to_index() is one HTTP request per document, which is fine for the odd
+# new post but means a full reindex of the post table takes hours, mostly
+# waiting on round trips. bulk_index() sends a whole batch of documents in one
+# request to the _bulk endpoint, using the bulk() helper from the
+# elasticsearch package. Documents that fail (e.g. because the cluster is busy,
+# HTTP 429) are retried a few times with a backoff, and anything that still
+# fails is logged rather than stopping the whole reindex.
+
+# SearchableMixin.reindex() reads the table in id order, batch_size rows at a
+# time, and sends each batch with bulk_index(). To go faster still the id
+# range can be split between several processes:
+
+# (venv) $ flask search reindex --batch-size 2000 --workers 4
+
+# (see reindex in app/cli.py)
+
+
+# Indexing in the background
+# -----------------------------------------------------------------------------
+# SearchableMixin.after_commit() used to call Elasticsearch once for every
+# object in the commit, so a new post had to wait for a round trip to the
+# search cluster before the page could redirect, and with the cluster down
+# posting would hang until the request timed out.
+
+# With SEARCH_INDEXING = 'async', after_commit() only records the ids that
+# changed in a Redis hash per index (search:queue:post), id -> 'add' or
+# 'delete', and makes sure an RQ job is queued to apply them. Because it is a
+# hash, a post edited five times before the job runs is indexed once, with its
+# latest content, and a post that was deleted is just deleted. The
+# search:queue:post:scheduled key (SET NX) keeps it to one waiting job per
+# index; the job deletes it as it starts, so changes made while it runs get a
+# job of their own.
+
+# The job (index_queued in app/tasks.py) takes the whole hash at once (with
+# RENAME to a name of its own, as in app/last_seen.py, so a job that dies
+# halfway leaves a snapshot that the next job picks up), loads the rows in
+# batches and sends them with the bulk API. If Elasticsearch can't be reached
+# it tries again a few times with a growing delay, then puts the changes back
+# in the queue and queues another job for them. The scheduled key expires
+# after SEARCH_QUEUE_TIMEOUT seconds, in case a job is lost. If Redis can't be
+# reached the commit falls back to indexing right away. The default, 'sync',
+# keeps the old behaviour.
+
+
+# Caching search results
+# -----------------------------------------------------------------------------
+# Popular searches are run over and over, and each page of each one is a
+# round trip to the search backend. With SEARCH_CACHE on, query_index()
+# keeps (ids, total) for every (index, query, page, page size) it answers in
+# a two-tier cache (app/cache.py): an LRU in each process in front of Redis
+# keys that expire after SEARCH_CACHE_TTL seconds. The query is lowercased
+# and its whitespace collapsed first, so 'Flask ' and 'flask' share an entry.
+
+# Stale results are handled with a generation number per index
+# (search:generation:post), which is part of every cache key. Whenever the
+# index changes, SearchableMixin bumps it with a single INCR, and from then on
+# every lookup uses new keys; the old entries are never read again and
+# simply expire. That costs one GET per search to read the generation, but
+# nothing has to go looking for the entries that a new post made stale. With
+# SEARCH_INDEXING = 'async' the generation is bumped when the worker has
+# applied the changes, so results aren't cached from an index that is about
+# to change.
+
+# Elasticsearch makes new documents searchable at its next refresh, up to a
+# second after the bulk request returns. A search in that second would cache
+# the old results under the new generation, where they would stay for
+# SEARCH_CACHE_TTL. So the bulk requests ask for refresh='wait_for', which
+# returns only once the changes are visible, and the generation is bumped
+# after that. It doesn't force a refresh (which is expensive), it just waits
+# for the next one, and that wait is on the worker or after the commit.
+
+# Hits and misses are counted in Redis, see:
+
+# (venv) $ flask search stats
+
+
+# Deep pagination with search_after
+# -----------------------------------------------------------------------------
+# query_index() pages with from and size, so page 400 asks every shard for its
+# best 10,000 hits and throws away all but the last 25, and Elasticsearch
+# refuses to go past index.max_result_window (10,000 hits) at all. The
+# search page now uses query_index_after() instead, which sorts the hits by
+# (_score, id) and passes the sort values of the last hit of the previous
+# page as search_after, so every page costs the same as the first. This is
+# the search version of the keyset pagination in app/pagination.py.
+
+# The tiebreaker for equal scores is the post id, stored in each document as
+# an id field mapped as a long that isn't indexed (only its doc_values are
+# kept, which is what sorting reads). Sorting on the built-in _id would need
+# fielddata on it, which is deprecated in Elasticsearch 7 and off by default
+# in 8. The mapping is added the first time the app indexes into an index;
+# documents indexed before that have no id to sort on, so run flask search
+# reindex once after upgrading.
+
+# The sort values travel in the URL as an opaque token (base64 encoded JSON,
+# encode_key() in app/pagination.py), in after= for the next page. The
+# previous page runs the same query sorted the other way from the first hit
+# (before=) and reverses the hits. The old ?page= links still work with
+# from/size.
+
+# Counting the total is the other expensive part of a search for a common
+# word, and with cursors it is only informational. Elasticsearch 7 and up can
+# stop counting at SEARCH_MAX_TOTAL (track_total_hits), and so does the SQLite
+# backend; Elasticsearch 6 always counts them all.
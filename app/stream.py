@@ -0,0 +1,113 @@
+import json
+from time import time
+from flask import current_app
+import redis
+
+
+def _channel(user_id):
+    return 'notifications:{}'.format(user_id)
+
+
+def publish(user_id, name, data, timestamp):
+    '''Sends a notification to the open streams of a user.'''
+    if not current_app.config['NOTIFICATION_STREAM']:
+        return
+    message = json.dumps({'name': name, 'data': data, 'timestamp': timestamp})
+    try:
+        current_app.redis.publish(_channel(user_id), message)
+    except redis.exceptions.RedisError:
+        # the polling fallback will still find it in the database
+        current_app.logger.warning('Could not publish notification %s', name,
+                                   exc_info=True)
+
+
+def format_event(name, data, timestamp):
+    '''One Server-Sent Event. The id is the notification timestamp, which the
+    browser sends back in the Last-Event-ID header when it reconnects.'''
+    return 'id: {!r}\nevent: {}\ndata: {}\n\n'.format(
+        timestamp, name, json.dumps(data))
+
+
+def events(user_id, since, load_backlog):
+    '''Generates the event stream for a user: the notifications they missed
+    (load_backlog() returns them, a list of (name, data, timestamp) from the
+    notification store), then whatever gets published, with a comment line as
+    heartbeat.
+
+    The app and request contexts are gone by the time the generator runs,
+    so everything it needs is read up front.'''
+    conn = current_app.redis
+    heartbeat = current_app.config['NOTIFICATION_HEARTBEAT']
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    # subscribe before loading the backlog, so a notification committed in
+    # between is in one or the other (or both, and is then skipped because it
+    # is not newer than what was sent)
+    pubsub.subscribe(_channel(user_id))
+    try:
+        backlog = load_backlog()
+    except Exception:
+        pubsub.close()
+        raise
+
+    def generate():
+        last = since
+        try:
+            yield 'retry: 3000\n\n'
+            for name, data, timestamp in backlog:
+                last = max(last, timestamp)
+                yield format_event(name, data, timestamp)
+            deadline = time() + timeout
+            while time() < deadline:
+                message = pubsub.get_message(timeout=heartbeat)
+                if message is None:
+                    yield ': heartbeat\n\n'
+                    continue
+                n = json.loads(message['data'])
+                if n['timestamp'] > last:
+                    last = n['timestamp']
+                    yield format_event(n['name'], n['data'], n['timestamp'])
+        finally:
+            pubsub.close()
+    return generate()
+
+
+# Server-Sent Events
+# -----------------------------------------------------------------------------
+# base.html used to ask /notifications?since= for news every 5 seconds, for
+# every open tab, which is 12 requests (and 12 SQL queries) a minute per tab,
+# almost all of them answered with an empty list. Now the page opens a single
+# long-lived request to /notifications/stream instead, using the browser's
+# EventSource API, and the server writes to it when something happens.
+
+# Every time User.add_notification() is called, the notification is published
+# on the Redis channel notifications:<user_id> once the transaction commits
+# (on_commit() in models.py), so a stream never shows something that was
+# rolled back. The RQ worker publishes task_progress the same way. Each open
+# stream is subscribed to the channel of its user and turns the messages into
+# events:
+
+# id: 1536173482.314
+# event: unread_message_count
+# data: 3
+
+# When the connection drops, EventSource reconnects on its own after the
+# retry: delay and sends the id of the last event it got in the Last-Event-ID
+# header. The stream starts by sending every notification newer than that
+# (User.get_notifications()), so nothing is missed while the browser was away.
+# The backlog is only read once the stream is subscribed to the channel:
+# read first, a notification committed between the two would be in neither.
+
+# An idle stream gets a comment line (": heartbeat") every
+# NOTIFICATION_HEARTBEAT seconds. Proxies tend to close connections that are
+# quiet for too long, and it is also how we find out that the browser went
+# away (the write fails and the generator is closed). Streams are also ended
+# after NOTIFICATION_STREAM_TIMEOUT seconds, and the browser reconnects.
+
+# Each open stream keeps a worker busy for up to NOTIFICATION_STREAM_TIMEOUT
+# seconds. With the default sync gunicorn workers, a handful of open tabs
+# would take every worker and nothing else could be served, so the stream is
+# off unless NOTIFICATION_STREAM=on, which should only be set with a server
+# that can hold many idle connections cheaply, e.g. gunicorn with gevent
+# workers (gunicorn -k gevent). When it is off, Redis is down or the browser
+# doesn't support EventSource, the page polls /notifications?since= as before.
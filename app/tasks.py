@@ -1,11 +1,18 @@
+import glob
+import gzip
 import json
+import os
 import sys
 import time
 from flask import render_template
 from rq import get_current_job
-from app import create_app, db
+from app import create_app, db, outbox
 from app.email import send_email
-from app.models import Task, User, Post
+from app.language import detect
+from app.models import SearchableMixin, Task, Translation, User, Post, \
+    on_commit
+from app.search import pop_queued, restore_queued
+from app.translate import pretranslate, queue_pretranslation
 
 
 app = create_app()
@@ -25,28 +32,66 @@ def _set_task_progress(progress):
         db.session.commit()
 
 
-def export_posts(user_id):
+def _iter_posts(user_id, chunk_size=1000):
+    '''Yields (body, timestamp) for all of a user's posts, oldest first, reading
+    them chunk_size rows at a time.'''
+    query = db.session.query(Post.body, Post.timestamp, Post.id).filter(
+        Post.user_id == user_id).order_by(Post.timestamp.asc(), Post.id.asc())
+    last = None
+    while True:
+        chunk = query
+        if last is not None:
+            chunk = chunk.filter(db.or_(
+                Post.timestamp > last[0],
+                db.and_(Post.timestamp == last[0], Post.id > last[1])))
+        rows = chunk.limit(chunk_size).all()
+        for body, timestamp, id in rows:
+            yield body, timestamp
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][1:]
+
+
+def _export_path(user_id, name):
+    return os.path.join(app.config['EXPORT_DIR'], str(user_id),
+                        name + '.ndjson.gz')
+
+
+def export_posts(user_id, name, url):
     try:
         # read user posts from database:
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.timestamp.asc()):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(0.1) # NOTE: this is only here so we can see the progress
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-
-        # send email with data to user:
+        # the counter is denormalized on the user, so no COUNT(*) is needed
+        total_posts = max(user.post_count, 1)
+        last_progress, last_update = 0, time.time()
+        path = _export_path(user.id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as out:
+            for i, (body, timestamp) in enumerate(_iter_posts(user.id), 1):
+                out.write(json.dumps({
+                    'body': body,
+                    'timestamp': timestamp.isoformat() + 'Z'}) + '\n')
+                # report at most once per percent and once per second
+                progress = min(100 * i // total_posts, 99)
+                if progress > last_progress and \
+                        time.time() - last_update >= 1:
+                    _set_task_progress(progress)
+                    last_progress, last_update = progress, time.time()
+        # only the latest export of a user is kept
+        for old in glob.glob(_export_path(user.id, '*')):
+            os.remove(old)
+        os.rename(path + '.tmp', path)
+
+        # send email with a link to the file to user:
         send_email('Microblog: Your blog posts',
                 sender=app.config['ADMINS'][0], recipients=[user.email],
-                text_body=render_template('email/export_posts.txt', user=user),
-                html_body=render_template('email/export_posts.html', user=user),
-                attachments=[('posts.json', 'application/json',
-                              json.dumps({'posts': data}, indent=4))], sync=True)
+                text_body=render_template('email/export_posts.txt', user=user,
+                                          url=url),
+                html_body=render_template('email/export_posts.html', user=user,
+                                          url=url),
+                sync=not app.config['MAIL_OUTBOX'])
+        _set_task_progress(100)
     except:
         # handle unexpected errors:
         _set_task_progress(100)
@@ -62,3 +107,83 @@ def export_posts(user_id):
     # then will go back to wait for new jobs. So basically, unless you are
     # watching the output of the RQ worker or logging it to a file, you will
     # never find out there was an error.
+
+
+def index_queued(index, retries=3):
+    # applies the search index changes queued by SearchableMixin.after_commit()
+    cls = {c.__tablename__: c for c in SearchableMixin.__subclasses__()}[index]
+    changes = pop_queued(index)
+    for attempt in range(retries + 1):
+        try:
+            cls.apply_index_changes(changes)
+            return
+        except app.search_backend.errors:
+            app.logger.warning('Indexing %s failed (attempt %d)', index,
+                               attempt + 1, exc_info=True)
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+    restore_queued(index, changes)
+
+
+def deliver_emails(ids):
+    # sends emails from the outbox (see app/outbox.py)
+    outbox.deliver(ids)
+
+
+def detect_post_language(post_id):
+    # fills in the language of a post saved without one (see app/language.py)
+    post = Post.query.get(post_id)
+    if post is None or post.language is not None:
+        return
+    post.language = detect(post.body)
+    if Post.wants_pretranslation(post.language, post.author):
+        on_commit(queue_pretranslation, post.id)
+    db.session.commit()
+
+
+def pretranslate_post(post_id):
+    # stores translations of a popular post (see app/translate.py)
+    post = Post.query.get(post_id)
+    if post is None or not post.language:
+        return
+    done = {t.language for t in Translation.query.filter_by(post_id=post_id)}
+    languages = [language for language in app.config['LANGUAGES']
+                 if language != post.language and language not in done]
+    for language, body in pretranslate(post.body, post.language,
+                                       languages).items():
+        db.session.add(Translation(post_id=post_id, language=language,
+                                   body=body))
+    db.session.commit()
+
+
+# Streaming the export
+# -----------------------------------------------------------------------------
+# The first version of export_posts() built a list of every post in memory,
+# turned it into one big indented JSON string, and committed a progress update
+# (and a notification) after every single post, with a sleep in between so
+# the progress could be seen moving. That's fine for a few posts, but not for
+# a user with 100k of them.
+
+# Now the posts are read in chunks of 1000 with a keyset query on
+# (timestamp, id), the same idea as app/pagination.py, and each one is written
+# out as a line of JSON (NDJSON) to a gzip-compressed file as soon as it is
+# read, so the export doesn't need more memory for more posts. A plain
+# yield_per() cursor would do the same, but the progress updates commit in the
+# middle of the loop, and a commit can invalidate an open cursor on some
+# databases. Each keyset chunk is a fresh query, so that can't happen.
+
+# Progress is reported when the percentage goes up, but no more than once a
+# second, so an export commits at most 100 progress updates however big it is.
+# It stops at 99% and reaches 100% once the email has been sent.
+
+# The file (posts.ndjson.gz) is no longer attached to the email. Flask-Mail
+# (and smtplib under it) can only send a message that is entirely in memory,
+# base64-encoded at that, and with MAIL_OUTBOX on the attachment would be
+# stored in the database row of the email too, so the memory an export needed
+# still grew with the number of posts. Instead the file is kept in
+# EXPORT_DIR/<user_id>/ under a random name, and the email has a link to
+# /export_posts/<name>, which only works for the logged in user who owns it.
+# send_file() streams it from disk in blocks, so serving it takes constant
+# memory as well. Each user only has their latest export: the older ones are
+# deleted when a new one is ready. The file is written under a .tmp name and
+# renamed when complete, so a link never serves half an export.
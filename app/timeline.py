@@ -0,0 +1,254 @@
+from datetime import datetime
+from flask import current_app
+import redis
+
+# Member added to every rebuilt set, so that a user with an empty timeline (or
+# an author without posts) still has a key in Redis and doesn't look cold.
+# Post ids start at 1, and a score of 0 sorts it after every real post.
+SENTINEL = '0'
+
+
+def _key(user_id):
+    return 'timeline:{}'.format(user_id)
+
+
+def _author_key(user_id):
+    return 'posts:{}'.format(user_id)
+
+
+def _score(timestamp):
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+def _enabled():
+    return current_app.config['TIMELINE_CACHE']
+
+
+def _trim(pipe, key):
+    length = current_app.config['TIMELINE_LENGTH']
+    pipe.zremrangebyrank(key, 0, -length - 1)
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+
+
+def _replace(key, posts):
+    pipe = current_app.redis.pipeline()
+    pipe.delete(key)
+    members = {str(id): _score(ts) for id, ts in posts}
+    members[SENTINEL] = 0
+    pipe.zadd(key, **members)
+    _trim(pipe, key)
+    pipe.execute()
+
+
+def is_cold(user_id):
+    '''True if Redis is reachable but holds no timeline for the user.'''
+    if not _enabled():
+        return False
+    try:
+        return not current_app.redis.exists(_key(user_id))
+    except redis.exceptions.RedisError:
+        return False
+
+
+def cold_authors(author_ids):
+    '''Returns the authors whose recent-post lists are missing from Redis.'''
+    if not _enabled() or not author_ids:
+        return []
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for author_id in author_ids:
+            pipe.exists(_author_key(author_id))
+        return [author_id for author_id, exists in
+                zip(author_ids, pipe.execute()) if not exists]
+    except redis.exceptions.RedisError:
+        return []
+
+
+def push_post(post_id, timestamp, user_ids, author_id=None, chunk_size=1000):
+    '''Fan a new post out to the (warm) timelines of the given users, and to
+    the recent-post list of its author when given.'''
+    if not _enabled():
+        return
+    score = _score(timestamp)
+    keys = [_key(user_id) for user_id in user_ids]
+    if author_id is not None:
+        keys.append(_author_key(author_id))
+    try:
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key in chunk:
+                pipe.exists(key)
+            warm = [key for key, exists in zip(chunk, pipe.execute()) if exists]
+            pipe = current_app.redis.pipeline(transaction=False)
+            for key in warm:
+                pipe.zadd(key, **{str(post_id): score})
+                _trim(pipe, key)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Timeline fan-out failed for post %s',
+                                   post_id, exc_info=True)
+
+
+def add_posts(user_id, posts):
+    '''Merge (id, timestamp) pairs into a user's timeline if it is warm.'''
+    if not _enabled() or not posts:
+        return
+    key = _key(user_id)
+    try:
+        if not current_app.redis.exists(key):
+            return
+        pipe = current_app.redis.pipeline()
+        pipe.zadd(key, **{str(id): _score(ts) for id, ts in posts})
+        _trim(pipe, key)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Timeline update failed for user %s',
+                                   user_id, exc_info=True)
+
+
+def remove_posts(user_id, post_ids):
+    if not _enabled() or not post_ids:
+        return
+    try:
+        current_app.redis.zrem(_key(user_id), *post_ids)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Timeline update failed for user %s',
+                                   user_id, exc_info=True)
+
+
+def rebuild(user_id, posts):
+    '''Replace a user's timeline with the given (id, timestamp) pairs.'''
+    if not _enabled():
+        return
+    try:
+        _replace(_key(user_id), posts)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Timeline rebuild failed for user %s',
+                                   user_id, exc_info=True)
+
+
+def rebuild_author(author_id, posts):
+    '''Replace an author's recent-post list with the given pairs.'''
+    if not _enabled():
+        return
+    try:
+        _replace(_author_key(author_id), posts)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Post list rebuild failed for user %s',
+                                   author_id, exc_info=True)
+
+
+def get_page(user_id, per_page, author_ids=(), before=None, after=None):
+    '''Returns (ids, has_more) for a page of a user's timeline, merged with
+    the recent-post lists of the given (pull) authors. before and after are
+    (timestamp, id) cursors, and has_more tells if there are more posts past
+    the page in that direction. Returns None when the page can't be served
+    from Redis (a cold set, or a page past the cap).'''
+    if not _enabled():
+        return None
+    keys = [_key(user_id)] + [_author_key(id) for id in author_ids]
+    cursor = after or before
+    score = _score(cursor[0]) if cursor else None
+    try:
+        pipe = current_app.redis.pipeline()
+        for key in keys:
+            pipe.zcard(key)
+            if after is not None:
+                pipe.zrangebyscore(key, '({!r}'.format(score), '+inf', start=0,
+                                   num=per_page + 1, withscores=True)
+            else:
+                pipe.zrevrangebyscore(
+                    key, '({!r}'.format(score) if before else '+inf', '-inf',
+                    start=0, num=per_page + 1, withscores=True)
+            if cursor:
+                # posts with the same timestamp as the cursor, to be ordered
+                # by id like the SQL query does
+                pipe.zrangebyscore(key, score, score)
+            pipe.expire(key, current_app.config['TIMELINE_TTL'])
+        results = iter(pipe.execute())
+    except redis.exceptions.RedisError:
+        return None
+    posts = {}
+    for key in keys:
+        size, entries = next(results), next(results)
+        ties = next(results) if cursor else []
+        next(results)
+        if size == 0:
+            return None
+        if after is None and size >= current_app.config['TIMELINE_LENGTH'] \
+                and len(entries) <= per_page:
+            # the set is capped, so older posts may exist that were trimmed
+            return None
+        for id, s in entries:
+            posts[int(id)] = s
+        for id in ties:
+            id = int(id)
+            if (after and id > cursor[1]) or (before and id < cursor[1]):
+                posts[id] = score
+    posts.pop(int(SENTINEL), None)
+    ids = sorted(posts, key=lambda id: (posts[id], id), reverse=after is None)
+    has_more = len(ids) > per_page
+    ids = ids[:per_page]
+    if after is not None:
+        ids.reverse()
+    return ids, has_more
+
+
+# Fan-out-on-write timelines
+# -----------------------------------------------------------------------------
+# User.followed_posts() asks the database to join the followers table against
+# the post table, union the result with the user's own posts and sort it all,
+# every time someone loads /home. Instead of doing that work on every read,
+# this module keeps a materialized copy of each user's home timeline in Redis
+# and does the work once, at write time.
+
+# Each timeline is a sorted set named timeline:<user_id>. The members are post
+# ids and the scores are the post timestamps (as seconds since the epoch), so
+# Redis keeps the set in chronological order for us and ZREVRANGEBYSCORE gives
+# us the page of posts older than the cursor (see app/pagination.py). The sets
+# are capped at TIMELINE_LENGTH entries (ZREMRANGEBYRANK drops the oldest) and
+# expire after TIMELINE_TTL seconds without being read, so users that never
+# come back don't cost any memory.
+
+# The timelines are kept up to date from models.py, once a commit succeeds:
+# - a new post is pushed into its author's timeline and into the timeline of
+#   every follower (push_post),
+# - following someone merges their recent posts in (add_posts),
+# - unfollowing someone removes their posts again (remove_posts).
+
+# Only timelines that already exist get updated. A timeline that is missing
+# (never built, expired or flushed) is "cold", and pushing a single post into
+# it would create a partial timeline that looks complete. A cold timeline is
+# instead rebuilt in one query the next time the user loads the home page,
+# or for everyone with:
+
+# (venv) $ flask timeline rebuild
+
+# If Redis is down, or a page is deeper than the cached window, get_page()
+# returns None and the view falls back to the plain SQL query.
+
+# Note on zadd(): redis-py 2.x accepts members as keyword arguments in the
+# form member=score, which is why the ids are passed as **{str(id): score}.
+
+
+# Hybrid push/pull
+# -----------------------------------------------------------------------------
+# Fan-out on write is cheap for most users, but one post from an account with
+# 100k followers turns into 100k timeline writes. So accounts with at least
+# TIMELINE_FANOUT_THRESHOLD followers are treated differently: their posts are
+# not pushed to followers at all. Instead each of these "pull" authors gets a
+# recent-post list of their own (posts:<user_id>, capped and expiring just
+# like a timeline) and get_page() merges those lists into the reader's
+# timeline at read time. A reader only follows a handful of such accounts, so
+# the read costs a few extra ZREVRANGEs in the same pipeline, while the write
+# costs one ZADD no matter how many followers there are.
+
+# Each source returns at most one page (plus one post, to know if there is
+# more) past the cursor, so merging them is a matter of sorting a few dozen
+# ids by (timestamp, id). A post can show up in two sources, for example when
+# an author crosses the threshold and older posts were pushed before that, so
+# the ids are collected in a dictionary first.
+
+# To see the trade-off between write amplification and read latency for a
+# few thresholds, run benchmarks/timelines.py against a scratch Redis.
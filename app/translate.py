@@ -1,4 +1,7 @@
+from datetime import datetime
+import hashlib
 import json
+import redis
 import requests
 from flask import current_app
 from flask_babel import _
@@ -25,18 +28,39 @@ from flask_babel import _
 
 
 
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: translation service is not configured.')
+_session = None
+
+
+def _get_session():
+    # one Session per process, so connections to the translator are kept
+    # alive and reused instead of opened (with a TLS handshake) for each call
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=current_app.config['TRANSLATOR_POOL_SIZE'])
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
 
+def _request_translations(texts, source_language, dest_language):
+    '''Translates a list of texts with one call to the translator. Returns
+    the list of translations, or None if the call failed.'''
     base_url = 'https://api.cognitive.microsofttranslator.com'
     path = '/translate?api-version=3.0'
     params = '&from={}&to={}'.format(source_language, dest_language)
     url = base_url + path + params
     auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
-    body = [{'text': text}]
+    body = [{'text': text} for text in texts]
 
-    r = requests.post(url, headers=auth, json=body)
+    try:
+        r = _get_session().post(url, headers=auth, json=body, timeout=(
+            current_app.config['TRANSLATOR_CONNECT_TIMEOUT'],
+            current_app.config['TRANSLATOR_READ_TIMEOUT']))
+    except requests.exceptions.RequestException:
+        current_app.logger.warning('Translator call failed', exc_info=True)
+        return None
 
     # You can get the response like this:
     # response = r.json()
@@ -47,9 +71,143 @@ def translate(text, source_language, dest_language):
     # print(response[0]['translations'][0]['text'])
 
     if r.status_code != 200:
+        return None
+
+    return [item['translations'][0]['text'] for item in r.json()]
+
+
+def _request_translation(text, source_language, dest_language):
+    translations = _request_translations([text], source_language,
+                                         dest_language)
+    return translations[0] if translations else None
+
+
+def _cache_key(text, source_language, dest_language):
+    return hashlib.sha256(json.dumps(
+        [text, source_language, dest_language]).encode('utf-8')).hexdigest()
+
+
+def translate(text, source_language, dest_language):
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
+        return _('Error: translation service is not configured.')
+
+    cache = current_app.translation_cache
+    if cache:
+        translation = cache.fetch(
+            _cache_key(text, source_language, dest_language),
+            lambda: _request_translation(text, source_language, dest_language))
+    else:
+        translation = _request_translation(text, source_language,
+                                           dest_language)
+    if translation is None:
         return _('Error: translation service failed.')
+    return translation
+
+
+def _batches(texts):
+    # the translator takes at most 100 texts and 10,000 characters per call
+    batch, size = [], 0
+    for text in texts:
+        if batch and (len(batch) == 100 or size + len(text) > 10000):
+            yield batch
+            batch, size = [], 0
+        batch.append(text)
+        size += len(text)
+    if batch:
+        yield batch
+
+
+def translate_many(items, dest_language):
+    '''Translates a list of (text, source_language) pairs, with as few calls
+    to the translator as possible. Returns a list with the translations, or
+    error messages for the ones that failed.'''
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
+        return [_('Error: translation service is not configured.')] * len(items)
 
-    return r.json()[0]['translations'][0]['text']
+    cache = current_app.translation_cache
+    results = {}
+    missing = {}  # source language -> texts to translate
+    for text, source_language in set(items):
+        key = _cache_key(text, source_language, dest_language)
+        translation = cache.get(key) if cache else None
+        if translation is not None:
+            results[(text, source_language)] = translation
+        else:
+            missing.setdefault(source_language, []).append(text)
+    for source_language, texts in missing.items():
+        for batch in _batches(texts):
+            translations = _request_translations(batch, source_language,
+                                                 dest_language)
+            if translations is None:
+                continue
+            for text, translation in zip(batch, translations):
+                results[(text, source_language)] = translation
+                if cache:
+                    cache.set(_cache_key(text, source_language,
+                                         dest_language), translation)
+    error = _('Error: translation service failed.')
+    return [results.get(item, error) for item in items]
+
+
+def _request_translations_to(text, source_language, dest_languages):
+    # one call can translate to several languages (a to= for each)
+    base_url = 'https://api.cognitive.microsofttranslator.com'
+    path = '/translate?api-version=3.0'
+    params = '&from={}'.format(source_language) + ''.join(
+        '&to={}'.format(language) for language in dest_languages)
+    auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY']}
+    try:
+        r = _get_session().post(
+            base_url + path + params, headers=auth, json=[{'text': text}],
+            timeout=(current_app.config['TRANSLATOR_CONNECT_TIMEOUT'],
+                     current_app.config['TRANSLATOR_READ_TIMEOUT']))
+    except requests.exceptions.RequestException:
+        current_app.logger.warning('Translator call failed', exc_info=True)
+        return {}
+    if r.status_code != 200:
+        return {}
+    return {t['to']: t['text'] for t in r.json()[0]['translations']}
+
+
+def _spend_budget(characters):
+    '''Takes characters out of today's pre-translation budget. Returns False
+    (and takes nothing) if there isn't enough left.'''
+    key = 'translate:budget:{}'.format(datetime.utcnow().strftime('%Y-%m-%d'))
+    pipe = current_app.redis.pipeline()
+    pipe.incrby(key, characters)
+    pipe.expire(key, 2 * 24 * 3600)
+    spent = pipe.execute()[0]
+    if spent > current_app.config['PRETRANSLATE_DAILY_CHARACTERS']:
+        current_app.redis.decr(key, characters)
+        return False
+    return True
+
+
+def pretranslate(text, source_language, dest_languages):
+    '''Translates text to all of dest_languages in one call, if today's
+    budget allows it. Returns {language: translation} for the ones that
+    succeeded.'''
+    if not current_app.config['MS_TRANSLATOR_KEY'] or not dest_languages:
+        return {}
+    # the translator bills every character once per target language
+    if not _spend_budget(len(text) * len(dest_languages)):
+        current_app.logger.info('Pre-translation budget used up for today')
+        return {}
+    translations = _request_translations_to(text, source_language,
+                                            dest_languages)
+    cache = current_app.translation_cache
+    if cache:
+        for language, translation in translations.items():
+            cache.set(_cache_key(text, source_language, language), translation)
+    return translations
+
+
+def queue_pretranslation(post_id):
+    try:
+        current_app.task_queue.enqueue('app.tasks.pretranslate_post', post_id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not queue pre-translation of post '
+                                   '%s', post_id, exc_info=True)
 
 
 # Note this code is for the Ajax translation of the user posts only
@@ -72,3 +230,62 @@ def translate(text, source_language, dest_language):
 # standard library) to decode the JSON into a Python string. The content
 # attribute of the response object contains the raw body of the response as a
 # bytes object, which is converted to a UTF-8 string and sent to json.loads().
+
+
+# Caching translations
+# -----------------------------------------------------------------------------
+# A post reads the same in French no matter who clicks Translate, yet every
+# click used to be a call to the translator API, which is slow and billed per
+# character. With TRANSLATION_CACHE on, translations are kept in a two-tier
+# cache (app/cache.py): an LRU in each process in front of Redis keys that
+# expire after TRANSLATION_CACHE_TTL seconds. The key is a SHA-256 hash of
+# the text and the two languages, so a long post doesn't make a long key, and
+# an edited post gets a new one.
+
+# The lookup goes through Cache.fetch(), which makes sure that when many
+# people translate the same (popular) post at the same moment, only one of
+# them calls the API and the others wait for that result. Failed calls
+# (_request_translation() returns None) are not cached, so the next click
+# tries again. The hit ratio is shown by:
+
+# (venv) $ flask translate cache-stats
+
+
+# Batches and connection reuse
+# -----------------------------------------------------------------------------
+# requests.post() opens a new connection (DNS, TCP and TLS handshakes) for
+# every call and, without a timeout, waits forever for an answer, so a slow
+# translator could hold on to every web worker we have. All calls now go
+# through one requests.Session per process, which keeps up to
+# TRANSLATOR_POOL_SIZE connections alive, with a connect timeout of
+# TRANSLATOR_CONNECT_TIMEOUT and a read timeout of TRANSLATOR_READ_TIMEOUT
+# seconds. A call that times out is logged and reported as failed.
+
+# The translator also accepts a list of texts in the body, so the "Translate
+# all" link sends the ids of all the untranslated posts on the page to
+# /translate/posts in one request, and translate_many() translates them
+# with one call per source language (split in batches of 100 texts and 10,000
+# characters, the service's limits). Texts that are already in the cache are
+# not sent again, and the new translations are added to it. The single-post
+# /translate endpoint is still there for the Translate link on each post.
+
+
+# Pre-translation
+# -----------------------------------------------------------------------------
+# Posts by popular authors are read by many people, in many languages, so
+# with PRETRANSLATE=on they are translated ahead of time instead of on the
+# first click. When a post by an author with at least
+# PRETRANSLATE_MIN_FOLLOWERS followers is committed (Post.after_flush() in
+# models.py), a pretranslate_post job is queued on RQ. The job translates the
+# post into every language in LANGUAGES other than its own, with a single
+# call (the translator takes several to= languages), and stores the results
+# in the Translation table. The pages then load the stored translations for
+# the posts they show in one query, and the Translate link shows them
+# without calling the server at all. They are also added to the translation
+# cache, for the /translate endpoints.
+
+# Translating ahead of time spends money on posts that nobody may ever
+# translate, so it has a budget: PRETRANSLATE_DAILY_CHARACTERS characters a
+# day (counted the way the service bills them, once per target language), in
+# a Redis counter per day. Once it is used up, jobs do nothing until the
+# next day, and those posts are translated on click like any other.
@@ -0,0 +1,98 @@
+'''Speed and agreement of app.language.detect() and guess_language.
+
+Builds posts of up to 300 characters (the longest a post can be) by shuffling
+the words of a short paragraph in each of a few languages, and runs them
+through both detectors:
+
+(venv) $ python benchmarks/language.py --posts 5000
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from guess_language import guess_language
+from app.language import detect, load
+
+PARAGRAPHS = {
+    'en': 'I spent the whole weekend fixing the old bike in the garage and it '
+          'finally works again. Tomorrow I am going to ride along the river to '
+          'the market, buy some fresh bread and coffee, and then meet my sister '
+          'for lunch near the harbour if the weather stays this nice.',
+    'es': 'Pasé todo el fin de semana arreglando la bicicleta vieja en el '
+          'garaje y por fin funciona otra vez. Mañana voy a ir por el río hasta '
+          'el mercado, comprar pan fresco y café, y luego comer con mi hermana '
+          'cerca del puerto si el tiempo sigue así de bueno.',
+    'fr': "J'ai passé tout le week-end à réparer le vieux vélo dans le garage "
+          "et il marche enfin. Demain je vais longer la rivière jusqu'au "
+          "marché, acheter du pain frais et du café, puis déjeuner avec ma "
+          "sœur près du port si le temps reste aussi beau.",
+    'de': 'Ich habe das ganze Wochenende das alte Fahrrad in der Garage '
+          'repariert und endlich funktioniert es wieder. Morgen fahre ich am '
+          'Fluss entlang zum Markt, kaufe frisches Brot und Kaffee und treffe '
+          'dann meine Schwester zum Mittagessen am Hafen, wenn das Wetter so '
+          'schön bleibt.',
+    'it': 'Ho passato tutto il fine settimana a riparare la vecchia bicicletta '
+          'in garage e finalmente funziona di nuovo. Domani andrò lungo il '
+          'fiume fino al mercato, comprerò pane fresco e caffè, e poi pranzerò '
+          'con mia sorella vicino al porto se il tempo resta così bello.',
+    'ru': 'Я провёл все выходные, чиня старый велосипед в гараже, и наконец '
+          'он снова работает. Завтра поеду вдоль реки на рынок, куплю свежий '
+          'хлеб и кофе, а потом пообедаю с сестрой у гавани, если погода '
+          'останется такой же хорошей.',
+}
+
+
+def make_posts(count, length, rng):
+    posts = []
+    for _ in range(count):
+        words = rng.choice(list(PARAGRAPHS.values())).split()
+        rng.shuffle(words)
+        posts.append(' '.join(words)[:length])
+    return posts
+
+
+def old_detect(text):
+    # what the views used to do
+    language = guess_language(text)
+    return '' if language == 'UNKNOWN' or len(language) > 5 else language
+
+
+def timed(func, posts):
+    start = time.perf_counter()
+    results = [func(post) for post in posts]
+    return results, 1e6 * (time.perf_counter() - start) / len(posts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    load()
+    print('Loaded the models in {:.1f} ms.'.format(
+        1000 * (time.perf_counter() - start)))
+    rng = random.Random(args.seed)
+    # warm up guess_language, which loads each model on first use
+    for text in PARAGRAPHS.values():
+        guess_language(text)
+
+    print('{:>6} {:>18} {:>12} {:>9} {:>7}'.format(
+        'length', 'guess_language us', 'detect us', 'speedup', 'agree'))
+    for length in (300, 140, 40, 15):
+        posts = make_posts(args.posts, length, rng)
+        old, old_us = timed(old_detect, posts)
+        new, new_us = timed(detect, posts)
+        agree = sum(a == b for a, b in zip(old, new)) / len(posts)
+        print('{:>6} {:>18.1f} {:>12.1f} {:>8.1f}x {:>6.1%}'.format(
+            length, old_us, new_us, old_us / new_us, agree))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''Indexing throughput and query latency of the search backends.
+
+Generates synthetic posts with a Zipf-like word distribution and feeds the
+same documents and queries to the SQLite FTS5 backend and, when --es-url is
+given, to Elasticsearch (in a scratch index that is deleted afterwards):
+
+(venv) $ python benchmarks/search.py --posts 1000000 --es-url http://localhost:9200
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elasticsearch import Elasticsearch
+from app import create_app
+from app.fts import SQLiteBackend
+from app.search import ElasticsearchBackend
+from config import Config
+
+INDEX = 'benchmark_post'
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+def make_vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+            for _ in range(size)]
+
+
+def make_post(vocabulary, rng):
+    # low ranks (common words) come up much more often than high ones
+    words = [vocabulary[min(len(vocabulary) - 1,
+                            int(rng.paretovariate(1.1)) - 1)]
+             for _ in range(rng.randint(5, 40))]
+    return ' '.join(words)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(name, backend, args, seed, refresh=None):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    start = time.perf_counter()
+    for first in range(1, args.posts + 1, args.batch_size):
+        last = min(args.posts, first + args.batch_size - 1)
+        backend.index(INDEX, [(id, {'body': make_post(vocabulary, rng)})
+                              for id in range(first, last + 1)])
+    if refresh:
+        refresh()
+    index_time = time.perf_counter() - start
+
+    # the same queries for every backend, from common to rare words
+    queries = [' '.join(rng.sample(vocabulary[:args.vocabulary // 10],
+                                   rng.randint(1, 3)))
+               for _ in range(args.queries)]
+    times, deep_times = [], []
+    for query in queries:
+        t = time.perf_counter()
+        backend.query(INDEX, query, 1, 25)
+        times.append(time.perf_counter() - t)
+    for query in queries[:args.queries // 10 or 1]:
+        t = time.perf_counter()
+        backend.query(INDEX, query, 100, 25)
+        deep_times.append(time.perf_counter() - t)
+    return {
+        'backend': name,
+        'docs_per_s': args.posts / index_time,
+        'query_ms': 1000 * sum(times) / len(times),
+        'query_p95_ms': 1000 * percentile(times, 0.95),
+        'deep_ms': 1000 * sum(deep_times) / len(deep_times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--es-url', default=None)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context(), tempfile.TemporaryDirectory() as tmp:
+        results = [run('sqlite', SQLiteBackend(os.path.join(tmp, 'search.db')),
+                       args, args.seed)]
+        if args.es_url:
+            es = Elasticsearch([args.es_url])
+            es.indices.delete(INDEX, ignore=[404])
+            try:
+                results.append(run(
+                    'elasticsearch', ElasticsearchBackend(es), args, args.seed,
+                    refresh=lambda: es.indices.refresh(INDEX)))
+            finally:
+                es.indices.delete(INDEX, ignore=[404])
+        print('{:>14} {:>12} {:>10} {:>13} {:>16}'.format(
+            'backend', 'docs/s', 'query ms', 'query p95 ms', 'page 100 ms'))
+        for r in results:
+            print('{backend:>14} {docs_per_s:>12.0f} {query_ms:>10.2f} '
+                  '{query_p95_ms:>13.2f} {deep_ms:>16.2f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
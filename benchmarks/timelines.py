@@ -0,0 +1,125 @@
+'''Write amplification vs. read latency of the Redis home timelines.
+
+Builds a synthetic follower graph in an in-memory SQLite database, then for
+each fan-out threshold creates the same stream of posts and loads the same
+home pages, reporting how many timeline entries each post wrote and how long
+a page took to read. Needs a Redis server it is allowed to flush:
+
+(venv) $ python benchmarks/timelines.py --redis-url redis://localhost:6379/15
+'''
+
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis import Redis
+from app import create_app, db
+from app.models import User, Post, followers
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    TIMELINE_CACHE = True
+
+
+def build_graph(num_users, rng):
+    '''Users followed by a Zipf-like number of followers, so a few accounts
+    are very popular and most have a handful.'''
+    users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+             for i in range(num_users)]
+    db.session.add_all(users)
+    db.session.commit()
+    rows = set()
+    for rank, user in enumerate(users, start=1):
+        count = min(num_users - 1, int(num_users / rank ** 0.9))
+        for follower in rng.sample(users, count):
+            if follower is not user:
+                rows.add((follower.id, user.id))
+    db.session.execute(followers.insert(), [
+        {'follower_id': f, 'followed_id': u} for f, u in rows])
+    User.repair_counters([user.id for user in users])
+    db.session.commit()
+    return users
+
+
+def zadd_calls(redis):
+    return redis.info('commandstats').get('cmdstat_zadd', {}).get('calls', 0)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(app, users, threshold, num_posts, readers, rng):
+    app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+    app.redis.flushdb()
+    db.session.query(Post).delete()
+    db.session.commit()
+    for user in users:
+        user.warm_timeline(user.followed_pull_authors())
+
+    start_calls = zadd_calls(app.redis)
+    now = datetime.utcnow()
+    write_times = []
+    for i in range(num_posts):
+        # popular accounts post more often
+        author = users[min(len(users) - 1, int(rng.paretovariate(1.2)) - 1)]
+        post = Post(body='post {}'.format(i), author=author,
+                    timestamp=now + timedelta(milliseconds=i))
+        db.session.add(post)
+        t = time.perf_counter()
+        db.session.commit()
+        write_times.append(time.perf_counter() - t)
+    writes = zadd_calls(app.redis) - start_calls
+
+    read_times = []
+    for user in readers:
+        t = time.perf_counter()
+        user.followed_posts_page(app.config['POSTS_PER_PAGE'])
+        read_times.append(time.perf_counter() - t)
+    return {
+        'threshold': threshold,
+        'writes_per_post': writes / num_posts,
+        'write_ms': 1000 * sum(write_times) / num_posts,
+        'read_ms': 1000 * sum(read_times) / len(read_times),
+        'read_p95_ms': 1000 * percentile(read_times, 0.95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=200)
+    parser.add_argument('--thresholds', default='10,100,500,1000000',
+                        help='comma separated follower-count thresholds')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    app = create_app(BenchmarkConfig)
+    app.redis = Redis.from_url(args.redis_url)
+    with app.app_context():
+        db.create_all()
+        users = build_graph(args.users, rng)
+        readers = rng.sample(users, min(args.readers, len(users)))
+        print('{:>10} {:>16} {:>10} {:>10} {:>12}'.format(
+            'threshold', 'writes per post', 'write ms', 'read ms', 'read p95 ms'))
+        for threshold in [int(t) for t in args.thresholds.split(',')]:
+            r = run(app, users, threshold, args.posts, readers, rng)
+            print('{threshold:>10} {writes_per_post:>16.1f} {write_ms:>10.2f} '
+                  '{read_ms:>10.2f} {read_p95_ms:>12.2f}'.format(**r))
+        app.redis.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,18 +12,92 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     POSTS_PER_PAGE = 25
+    # Collections in the API (see app/api/users.py):
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE') or 100)
+    API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE') or 1000)
+    API_STREAM_BATCH_SIZE = int(os.environ.get('API_STREAM_BATCH_SIZE') or 1000)
+    API_BULK_SIZE = int(os.environ.get('API_BULK_SIZE') or 1000)
     LANGUAGES = ['en', 'es', 'fr']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_CONNECT_TIMEOUT = float(
+        os.environ.get('TRANSLATOR_CONNECT_TIMEOUT') or 3.05)
+    TRANSLATOR_READ_TIMEOUT = float(os.environ.get('TRANSLATOR_READ_TIMEOUT') or 5)
+    TRANSLATOR_POOL_SIZE = int(os.environ.get('TRANSLATOR_POOL_SIZE') or 10)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379'
 
+    # 'elasticsearch' or 'sqlite' (an FTS5 index file, see app/fts.py):
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'elasticsearch'
+    SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH') or \
+        os.path.join(basedir, 'search.db')
+    # 'sync' or 'async' (queued for the RQ worker, see app/search.py):
+    SEARCH_INDEXING = os.environ.get('SEARCH_INDEXING') or 'sync'
+    SEARCH_QUEUE_TIMEOUT = int(os.environ.get('SEARCH_QUEUE_TIMEOUT') or 600)
+    # stop counting search hits past this (Elasticsearch 7+ and sqlite):
+    SEARCH_MAX_TOTAL = int(os.environ.get('SEARCH_MAX_TOTAL') or 10000)
+    # Search results cached in Redis and in each process (see app/search.py):
+    SEARCH_CACHE = os.environ.get('SEARCH_CACHE') != 'off'
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+
+    # Translations cached in Redis and in each process (see app/translate.py):
+    TRANSLATION_CACHE = os.environ.get('TRANSLATION_CACHE') != 'off'
+    TRANSLATION_CACHE_TTL = int(
+        os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 24 * 3600)
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 5000)
+    # Translate posts by popular authors ahead of time (see app/translate.py):
+    PRETRANSLATE = os.environ.get('PRETRANSLATE') == 'on'
+    PRETRANSLATE_MIN_FOLLOWERS = int(
+        os.environ.get('PRETRANSLATE_MIN_FOLLOWERS') or 1000)
+    PRETRANSLATE_DAILY_CHARACTERS = int(
+        os.environ.get('PRETRANSLATE_DAILY_CHARACTERS') or 200000)
+    # 'sync' detects the language of a post before saving it, 'async' in an RQ
+    # job after (see app/language.py):
+    LANGUAGE_DETECTION = os.environ.get('LANGUAGE_DETECTION') or 'sync'
+
+    # Home timelines cached in Redis (see app/timeline.py):
+    TIMELINE_CACHE = os.environ.get('TIMELINE_CACHE') != 'off'
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    TIMELINE_TTL = int(os.environ.get('TIMELINE_TTL') or 7 * 24 * 3600)
+    TIMELINE_FANOUT_THRESHOLD = int(
+        os.environ.get('TIMELINE_FANOUT_THRESHOLD') or 10000)
+
+    # Buffered last_seen updates (see app/last_seen.py):
+    LAST_SEEN_BUFFER = os.environ.get('LAST_SEEN_BUFFER') != 'off'
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 1000)
+
+    # 'sql' (the Notification table) or 'redis' (see app/notifications.py):
+    NOTIFICATION_BACKEND = os.environ.get('NOTIFICATION_BACKEND') or 'sql'
+    # Notifications pushed with Server-Sent Events instead of polled for,
+    # which needs an async server like gunicorn -k gevent (see app/stream.py):
+    NOTIFICATION_STREAM = os.environ.get('NOTIFICATION_STREAM') == 'on'
+    NOTIFICATION_HEARTBEAT = int(os.environ.get('NOTIFICATION_HEARTBEAT') or 15)
+    NOTIFICATION_STREAM_TIMEOUT = int(
+        os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+
     # For emailing error log:
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # Emails are sent by a pool of threads per process (see app/mailer.py):
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 4)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_IDLE_TIMEOUT = int(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
+    # Or saved in the database and sent by the RQ worker (see app/outbox.py):
+    MAIL_OUTBOX = os.environ.get('MAIL_OUTBOX') == 'on'
+    MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS') or 8)
+    MAIL_RETRY_DELAY = int(os.environ.get('MAIL_RETRY_DELAY') or 60)
+    MAIL_SEND_TIMEOUT = int(os.environ.get('MAIL_SEND_TIMEOUT') or 600)
+    MAIL_DIGEST_INTERVAL = int(os.environ.get('MAIL_DIGEST_INTERVAL') or 3600)
     ADMINS = ['jesskrush@me.com']
+    # Post exports are kept here for the download link in the email (see
+    # app/tasks.py):
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
 
     # Extend csrf token expirey to 1 week
     # Note: If set to None, the CSRF token is valid for the life of the session
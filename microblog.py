@@ -1,5 +1,6 @@
 from app import create_app, db, cli
-from app.models import User, Post, Message, Notification, Task
+from app.models import User, Post, Message, Notification, Task, \
+    Translation
 
 app = create_app()
 cli.register(app)
@@ -7,7 +8,8 @@ cli.register(app)
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Post': Post, 'Message': Message,
-            'Notification': Notification, 'Task': Task}
+            'Notification': Notification, 'Task': Task,
+            'Translation': Translation}
 
 # Instead of running a python interpreter session, you can run a flask shell
 # session. This is basically the same thing but it pre-imports 'app' and you
@@ -0,0 +1,57 @@
+"""user counters
+
+Revision ID: 5f1c9a2e7b3d
+Revises: 0eb4c8ae9ec0
+Create Date: 2026-10-17 09:12:44.301127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f1c9a2e7b3d'
+down_revision = '0eb4c8ae9ec0'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+user = sa.table('user', sa.column('id', sa.Integer),
+                sa.column('post_count', sa.Integer),
+                sa.column('follower_count', sa.Integer),
+                sa.column('following_count', sa.Integer))
+post = sa.table('post', sa.column('user_id', sa.Integer))
+followers = sa.table('followers', sa.column('follower_id', sa.Integer),
+                     sa.column('followed_id', sa.Integer))
+
+
+def upgrade():
+    op.add_column('user', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill the counters a batch of users at a time, so no single UPDATE
+    # has to count the posts and followers of the whole user table
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        ids = [row[0] for row in conn.execute(
+            sa.select([user.c.id]).where(user.c.id > last_id).order_by(
+                user.c.id).limit(BATCH_SIZE))]
+        if not ids:
+            break
+        conn.execute(user.update().where(user.c.id.in_(ids)).values(
+            post_count=sa.select([sa.func.count()]).where(
+                post.c.user_id == user.c.id).as_scalar(),
+            follower_count=sa.select([sa.func.count()]).where(
+                followers.c.followed_id == user.c.id).as_scalar(),
+            following_count=sa.select([sa.func.count()]).where(
+                followers.c.follower_id == user.c.id).as_scalar()))
+        last_id = ids[-1]
+
+
+def downgrade():
+    op.drop_column('user', 'following_count')
+    op.drop_column('user', 'follower_count')
+    op.drop_column('user', 'post_count')
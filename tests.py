@@ -1,13 +1,40 @@
 from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from time import sleep, time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+import fakeredis
+from guess_language import guess_language
+from flask_login import login_user
+from flask_mail import Message
+import rq
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import cli, create_app, db, last_seen, mail, outbox, stream, \
+    tasks
+from app.email import send_email
+from app.main.routes import record_last_seen
+from app.models import User, Post, QueuedEmail, Translation
+from app.cache import LRU
+from app.fts import SQLiteBackend
+from app.language import detect, post_language
+from app.pagination import decode_cursor, encode_key, paginate
+from app.search import ElasticsearchBackend, pop_queued, restore_queued
+from app.translate import _cache_key, translate, translate_many
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    TIMELINE_CACHE = False
+    LAST_SEEN_BUFFER = False
 
 
 class UserModelCase(unittest.TestCase):
@@ -50,12 +77,16 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following.first().username, 'susan')
         self.assertEqual(u2.followers.count(), 1)
         self.assertEqual(u2.followers.first().username, 'john')
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.follower_count, 1)
 
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
         self.assertEqual(u1.following.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.follower_count, 0)
 
     def test_follow_posts(self):
         # create four users
@@ -91,6 +122,974 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add_all([Post(body='one', author=u1),
+                            Post(body='two', author=u1)])
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        self.assertEqual(u1.follower_count, 1)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(list(User.counter_drift()), [])
+
+        u1.follower_count = 5
+        db.session.commit()
+        self.assertEqual(list(User.counter_drift()),
+                         [(u1, 'follower_count', 5, 1)])
+        User.repair_counters([u1.id])
+        db.session.commit()
+        self.assertEqual(u1.follower_count, 1)
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestamp=now + timedelta(seconds=i)) for i in range(5)]
+        # same timestamp as the newest post, so the id breaks the tie
+        posts.append(Post(body='post 5', author=u,
+                          timestamp=now + timedelta(seconds=4)))
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+
+        page1 = paginate(u.posts, Post.timestamp, Post.id, 4)
+        self.assertEqual(page1.items, newest_first[:4])
+        self.assertIsNone(page1.prev_cursor)
+        page2 = paginate(u.posts, Post.timestamp, Post.id, 4,
+                         before=decode_cursor(page1.next_cursor))
+        self.assertEqual(page2.items, newest_first[4:])
+        self.assertIsNone(page2.next_cursor)
+        back = paginate(u.posts, Post.timestamp, Post.id, 4,
+                        after=decode_cursor(page2.prev_cursor))
+        self.assertEqual(back.items, newest_first[:4])
+        self.assertIsNone(back.prev_cursor)
+
+        # old ?page= links and the home timeline (a UNION query)
+        old = paginate(u.posts, Post.timestamp, Post.id, 4, page=2)
+        self.assertEqual(old.items, newest_first[4:])
+        home = u.followed_posts_page(4, before=decode_cursor(page1.next_cursor))
+        self.assertEqual(home.items, newest_first[4:])
+
+
+class RedisCase(unittest.TestCase):
+    '''Runs the tests with an in-memory Redis (fakeredis).'''
+    config = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.redis.flushall()
+        self.app.task_queue = rq.Queue('microblog-tasks',
+                                       connection=self.app.redis)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_users(self, *names):
+        users = [User(username=name, email='{}@example.com'.format(name))
+                 for name in names]
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def client_for(self, user):
+        '''A test client logged in as user (over https, because the session
+        cookie is secure).'''
+        client = self.app.test_client()
+        with client.session_transaction(base_url='https://localhost') as sess:
+            sess['user_id'] = str(user.id)
+            sess['_fresh'] = True
+        return client
+
+    def statements(self):
+        '''Records the SQL statements run from now until the test ends.'''
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        record)
+        return statements
+
+
+class TimelineConfig(TestConfig):
+    TIMELINE_CACHE = True
+
+
+class TimelineCase(RedisCase):
+    config = TimelineConfig
+
+    def cached_ids(self, user):
+        return {int(id) for id in
+                self.app.redis.zrange('timeline:{}'.format(user.id), 0, -1)}
+
+    def test_fan_out(self):
+        u1, u2, u3 = self.add_users('john', 'susan', 'mary')
+        now = datetime.utcnow()
+        p1 = Post(body='one', author=u2, timestamp=now)
+        db.session.add(p1)
+        u1.follow(u2)
+        db.session.commit()
+
+        # a cold timeline is built from the database on first read
+        self.assertEqual(u1.followed_posts_page(10).items, [p1])
+        self.assertEqual(self.cached_ids(u1), {0, p1.id})
+
+        # new posts are pushed into the warm timelines of the followers only
+        p2 = Post(body='two', author=u2, timestamp=now + timedelta(seconds=1))
+        p3 = Post(body='three', author=u3, timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p2, p3])
+        db.session.commit()
+        self.assertEqual(self.cached_ids(u1), {0, p1.id, p2.id})
+        self.assertEqual(u1.followed_posts_page(10).items, [p2, p1])
+
+        # following merges the posts in, unfollowing takes them out
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts_page(10).items, [p3, p2, p1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts_page(10).items, [p3])
+        self.assertEqual(u1.followed_posts_page(10).items,
+                         u1.followed_posts().all())
+
+    def test_pull_authors(self):
+        self.app.config['TIMELINE_FANOUT_THRESHOLD'] = 2
+        u1, u2, u3, u4 = self.add_users('john', 'susan', 'mary', 'david')
+        now = datetime.utcnow()
+        p1 = Post(body='one', author=u2, timestamp=now)
+        p2 = Post(body='two', author=u3, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        u4.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        self.assertTrue(u2.is_pull_author())
+        self.assertEqual(u1.followed_pull_authors(), [u2.id])
+        self.assertEqual(u1.followed_posts_page(10).items, [p2, p1])
+
+        # posts of a pull author stay out of the timelines of its followers,
+        # and are merged in from its own list when the page is read
+        p3 = Post(body='three', author=u2, timestamp=now + timedelta(seconds=2))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertNotIn(p3.id, self.cached_ids(u1))
+        self.assertEqual(u1.followed_posts_page(10).items, [p3, p2, p1])
+        page = u1.followed_posts_page(2)
+        self.assertEqual(page.items, [p3, p2])
+        self.assertEqual(u1.followed_posts_page(
+            2, before=decode_cursor(page.next_cursor)).items, [p1])
+
+    def test_follow_many(self):
+        u1, = self.add_users('john')
+        self.assertEqual(u1.followed_posts_page(10).items, [])  # warm it up
+
+        def follow(n):
+            authors = self.add_users(*['{}-{}'.format(n, i) for i in range(n)])
+            posts = [Post(body='hi', author=author) for author in authors]
+            db.session.add_all(posts)
+            db.session.commit()
+            ids = [author.id for author in authors]
+            post_ids = {post.id for post in posts}
+            statements = self.statements()
+            count = len(statements)
+            authors = User.query.filter(User.id.in_(ids)).all()
+            self.assertEqual(len(u1.follow_many(authors)), n)
+            db.session.commit()
+            count = len(statements) - count
+            self.assertTrue(post_ids <= self.cached_ids(u1))
+            return count
+        self.assertEqual(follow(2), follow(20))
+
+
+class LastSeenConfig(TestConfig):
+    LAST_SEEN_BUFFER = True
+
+
+class LastSeenCase(RedisCase):
+    config = LastSeenConfig
+
+    def test_flush(self):
+        u1, u2, u3 = self.add_users('john', 'susan', 'mary')
+        last_seen.touch(u1.id)
+        last_seen.touch(u2.id)
+        # left behind by a process that died in the middle of a flush
+        self.app.redis.hset('last_seen:flushing:dead', u3.id, time())
+        self.app.redis.zadd('last_seen:snapshots',
+                            **{'last_seen:flushing:dead': time() - 3600})
+        self.assertEqual(User.flush_last_seen(), 3)
+        self.assertEqual(self.app.redis.keys('last_seen:flushing*'), [])
+        self.assertEqual(self.app.redis.zcard('last_seen:snapshots'), 0)
+        self.assertEqual(last_seen.pop_all(), {})
+        last_seen.touch(u1.id)
+        self.assertEqual(set(last_seen.pop_all()), {u1.id})
+
+    def test_flush_error(self):
+        u, = self.add_users('john')
+        self.app.config['LAST_SEEN_FLUSH_SIZE'] = 1
+        error = OperationalError('UPDATE', {}, Exception('database is locked'))
+        with self.app.test_request_context(), \
+                mock.patch.object(User, 'flush_last_seen', side_effect=error):
+            login_user(u)
+            record_last_seen()
+        self.assertIsNotNone(last_seen.get(u.id))
+
+
+class NotificationConfig(TestConfig):
+    NOTIFICATION_BACKEND = 'redis'
+
+
+class NotificationCase(RedisCase):
+    config = NotificationConfig
+
+    def test_redis_notifications(self):
+        u, = self.add_users('john')
+        u.add_notification('unread_message_count', 1)
+        u.add_notification('task_progress', {'progress': 10})
+        db.session.commit()
+        # a new value replaces the old one, and moves it to its new time
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+        (name1, data1, t1), (name2, data2, t2) = u.get_notifications()
+        self.assertEqual((name1, data1), ('task_progress', {'progress': 10}))
+        self.assertEqual((name2, data2), ('unread_message_count', 2))
+        self.assertLess(t1, t2)
+
+        # since is exclusive
+        self.assertEqual(u.get_notifications(t1),
+                         [('unread_message_count', 2, t2)])
+        self.assertEqual(u.get_notifications(t2), [])
+
+        # nothing is stored for a transaction that is rolled back
+        u.add_notification('unread_message_count', 3)
+        db.session.rollback()
+        self.assertEqual(u.get_notifications(t1),
+                         [('unread_message_count', 2, t2)])
+
+
+class StreamConfig(TestConfig):
+    NOTIFICATION_STREAM = True
+    NOTIFICATION_HEARTBEAT = 0
+    NOTIFICATION_STREAM_TIMEOUT = 1
+
+
+class StreamCase(RedisCase):
+    config = StreamConfig
+
+    def test_stream(self):
+        u, = self.add_users('john')
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        since = u.get_notifications()[0][2]
+        u.add_notification('unread_message_count', 2)
+        db.session.commit()
+
+        # the stream starts with what was missed since Last-Event-ID
+        rv = self.client_for(u).get('/notifications/stream',
+                                    base_url='https://localhost',
+                                    headers={'Last-Event-ID': repr(since)})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = iter(rv.response)
+        self.assertEqual(next(events), b'retry: 3000\n\n')
+        self.assertIn(b'event: unread_message_count\ndata: 2\n', next(events))
+
+        # then what gets published, with heartbeats in between
+        stream.publish(u.id, 'task_progress', {'progress': 50}, time())
+        rest = b''.join(events)
+        self.assertIn(b'event: task_progress\ndata: {"progress": 50}', rest)
+        self.assertIn(b': heartbeat', rest)
+
+    def test_published_while_loading_backlog(self):
+        u, = self.add_users('john')
+        u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        missed, = u.get_notifications()
+
+        def load_backlog():
+            # committed and published after the backlog was read, and one
+            # that is both in the backlog and published
+            stream.publish(u.id, 'task_progress', {'progress': 50}, time())
+            stream.publish(u.id, *missed)
+            return [missed]
+        events = stream.events(u.id, 0.0, load_backlog)
+        sent = ''.join(events)
+        self.assertEqual(sent.count('event: unread_message_count'), 1)
+        self.assertIn('event: task_progress', sent)
+
+    def test_stream_off(self):
+        u, = self.add_users('john')
+        self.app.config['NOTIFICATION_STREAM'] = False
+        rv = self.client_for(u).get('/notifications/stream',
+                                    base_url='https://localhost')
+        self.assertEqual(rv.status_code, 404)
+
+
+class SearchConfig(TestConfig):
+    SEARCH_BACKEND = 'sqlite'
+
+
+class SearchCase(RedisCase):
+    '''Searches an SQLite FTS5 index in a temporary directory.'''
+    config = SearchConfig
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.search_backend = SQLiteBackend(
+            os.path.join(self.tmpdir, 'search.db'))
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sqlite_backend(self):
+        self.app.search_cache = None
+        u, = self.add_users('john')
+        p1 = Post(body='Flask and SQLite', author=u)
+        p2 = Post(body='flask flask flask', author=u)
+        p3 = Post(body='Nothing to see', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        # case insensitive, best match first, words joined with OR
+        self.assertEqual(Post.search('FLASK', 1, 10), ([p2, p1], 2))
+        self.assertEqual(Post.search('sqlite see', 1, 10)[1], 2)
+        self.assertEqual(Post.search('flask', 2, 1), ([p1], 2))
+        # what users type is never read as query syntax
+        self.assertEqual(Post.search('flask" OR *', 1, 10)[1], 2)
+        self.assertEqual(Post.search('!!!', 1, 10), ([], 0))
+
+        p2.body = 'django'
+        db.session.commit()
+        self.assertEqual(Post.search('flask', 1, 10), ([p1], 1))
+        self.app.search_backend.remove('post', [p1.id])
+        self.assertEqual(Post.search('flask', 1, 10), ([], 0))
+
+    def test_search_after(self):
+        u, = self.add_users('john')
+        # same body, same score: the pages are ordered by the id tiebreaker
+        posts = [Post(body='flask', author=u) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = sorted((post.id for post in posts), reverse=True)
+
+        backend, seen, after = self.app.search_backend, [], None
+        while True:
+            hits, total = backend.query_after('post', 'flask', 3, after=after)
+            if not hits:
+                break
+            seen += [id for id, _ in hits]
+            after = hits[-1][1]
+        self.assertEqual((seen, total), (ids, 7))
+        hits, _ = backend.query_after('post', 'flask', 3, after=after,
+                                      reverse=True)
+        self.assertEqual([id for id, _ in hits], ids[-2:-5:-1])
+
+        # the same pages through the next and previous links of /search
+        self.app.config['POSTS_PER_PAGE'] = 3
+        client, url, pages = self.client_for(u), '/search?q=flask', []
+        while url:
+            html = client.get(url, base_url='https://localhost').get_data(
+                as_text=True)
+            pages.append([int(id) for id in re.findall(r'id="post(\d+)"',
+                                                       html)])
+            links = {rel: href.replace('&amp;', '&') for href, rel in
+                     re.findall(r'<a href="([^"]+)">(next|previous)</a>',
+                                html)}
+            url = links.get('next')
+        self.assertEqual(sum(pages, []), ids)
+        html = client.get(links['previous'], base_url='https://localhost')
+        self.assertEqual([int(id) for id in re.findall(
+            r'id="post(\d+)"', html.get_data(as_text=True))], pages[-2])
+
+    def test_page_queries(self):
+        # the pages that list posts run the same number of queries for one
+        # post as for a full page of them, by different authors
+        self.app.search_cache = None
+        john, susan, mary = self.add_users('john', 'susan', 'mary')
+        john.follow(susan)
+        john.follow(mary)
+        db.session.commit()
+        client = self.client_for(john)
+        urls = ['/home', '/explore', '/user/susan', '/search?q=flask']
+
+        def count_queries():
+            counts = []
+            for url in urls:
+                # the test shares the session with the app, so start each
+                # request without any loaded objects
+                db.session.expire_all()
+                statements = self.statements()
+                count = len(statements)
+                rv = client.get(url, base_url='https://localhost')
+                self.assertEqual(rv.status_code, 200)
+                counts.append(len(statements) - count)
+            return counts
+        db.session.add(Post(body='flask', author=susan))
+        db.session.commit()
+        count_queries()  # the first requests set things up
+        one = count_queries()
+        db.session.add_all([Post(body='more flask', author=author)
+                            for author in [susan, mary] * 6])
+        db.session.commit()
+        self.assertEqual(count_queries(), one)
+
+    def test_reindex(self):
+        self.app.search_cache = None
+        backend, self.app.search_backend = self.app.search_backend, None
+        u, = self.add_users('john')
+        posts = [Post(body='post number {}'.format(i), author=u)
+                 for i in range(23)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.app.search_backend = backend
+        self.assertEqual(Post.search('number', 1, 100), ([], 0))
+
+        # a slice of the id range, then all of it, in batches of 5
+        ids = sorted(post.id for post in posts)
+        batches = []
+        self.assertEqual(Post.reindex(5, ids[0], ids[6],
+                                      progress=batches.append), 7)
+        self.assertEqual(batches, [5, 2])
+        self.assertEqual(Post.search('number', 1, 100)[1], 7)
+        batches = []
+        self.assertEqual(Post.reindex(5, progress=batches.append), 23)
+        self.assertEqual(batches, [5, 5, 5, 5, 3])
+        found, total = Post.search('number', 1, 100)
+        self.assertEqual((sorted(post.id for post in found), total), (ids, 23))
+
+        # the command, into an empty index
+        self.app.search_backend = SQLiteBackend(
+            os.path.join(self.tmpdir, 'fresh.db'))
+        cli.register(self.app)  # done by microblog.py
+        result = self.app.test_cli_runner().invoke(
+            args=['search', 'reindex', '--batch-size', '4'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('post: 23/23', result.output)
+        found, total = Post.search('number', 1, 100)
+        self.assertEqual((sorted(post.id for post in found), total), (ids, 23))
+
+    def test_search_cache(self):
+        u, = self.add_users('john')
+        p1 = Post(body='flask', author=u)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(Post.search('flask', 1, 10), ([p1], 1))
+        # served from the cache, which doesn't see a change made behind its
+        # back, in this process or (with the local tier emptied) in Redis
+        self.app.search_backend.remove('post', [p1.id])
+        self.assertEqual(Post.search('Flask ', 1, 10), ([p1], 1))
+        self.app.search_cache.local = LRU(10, 60)
+        self.assertEqual(Post.search('flask', 1, 10), ([p1], 1))
+        stats = self.app.search_cache.stats()
+        self.assertEqual((stats['local_hits'], stats['redis_hits'],
+                          stats['misses']), (1, 1, 1))
+
+        # a commit that changes the index makes every cached result stale
+        p2 = Post(body='more flask', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('flask', 1, 10), ([p2], 1))
+
+    def test_elasticsearch_waits_for_refresh(self):
+        # the generation is bumped after index() returns, so the documents
+        # must be searchable by then
+        backend = ElasticsearchBackend(mock.Mock())
+        with mock.patch('app.search.helpers.bulk',
+                        return_value=(1, [])) as bulk:
+            backend.index('post', [(1, {'body': 'flask'})])
+            backend.remove('post', [1])
+        for call in bulk.call_args_list:
+            self.assertEqual(call[1]['refresh'], 'wait_for')
+
+    def test_elasticsearch_sorts_on_id_field(self):
+        client = mock.Mock()
+        client.info.return_value = {'version': {'number': '8.1.0'}}
+        client.search.return_value = {'hits': {'total': {'value': 1}, 'hits': [
+            {'_id': '5', 'sort': [1.5, 5]}]}}
+        backend = ElasticsearchBackend(client)
+        self.assertEqual(backend.query_after('post', 'flask', 10),
+                         ([(5, [1.5, 5])], 1))
+        body = client.search.call_args[1]['body']
+        self.assertEqual(body['sort'], [{'_score': 'desc'}, {'id': 'desc'}])
+        with mock.patch('app.search.helpers.bulk',
+                        return_value=(1, [])) as bulk:
+            backend.index('post', [(5, {'body': 'flask'})])
+        self.assertEqual(bulk.call_args[0][1][0]['_source'],
+                         {'body': 'flask', 'id': 5})
+        mapping = client.indices.put_mapping.call_args[1]['body']
+        self.assertEqual(mapping['properties']['id']['type'], 'long')
+
+    def test_queued_indexing(self):
+        self.app.config['SEARCH_INDEXING'] = 'async'
+        u, = self.add_users('john')
+        p1, p2 = Post(body='first post', author=u), Post(body='second', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(Post.search('first', 1, 10), ([], 0))
+        self.assertEqual(len(self.app.task_queue), 1)
+
+        # a job that died after taking the changes left them in a snapshot
+        key = 'search:queue:post'
+        self.app.redis.rename(key, key + ':processing:dead')
+        self.app.redis.zadd(key + ':snapshots',
+                            **{key + ':processing:dead': time() - 3600})
+        changes = pop_queued('post')
+        self.assertEqual(changes, {p1.id: 'add', p2.id: 'add'})
+        self.assertEqual(self.app.redis.keys(key + '*'), [])
+
+        # changes that could not be applied are queued again, with a job
+        restore_queued('post', changes)
+        self.assertEqual(len(self.app.task_queue), 2)
+        Post.apply_index_changes(pop_queued('post'))
+        self.assertEqual(Post.search('first', 1, 10), ([p1], 1))
+
+
+class ExportCase(RedisCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.config['EXPORT_DIR'])
+
+    def test_export_posts(self):
+        u1, u2 = self.add_users('john', 'susan')
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u1,
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(3)])
+        db.session.commit()
+        with mock.patch('app.tasks.app', self.app), \
+                mail.record_messages() as outbox:
+            tasks.export_posts(u1.id, 'abc', 'https://localhost/x')
+            tasks.export_posts(u1.id, 'def', 'https://localhost/y')
+        # the file is linked, not attached, and only the latest is kept
+        self.assertEqual(len(outbox), 2)
+        self.assertIn('https://localhost/y', outbox[1].body)
+        self.assertEqual(outbox[1].attachments, [])
+        path = os.path.join(self.app.config['EXPORT_DIR'], str(u1.id))
+        self.assertEqual(os.listdir(path), ['def.ndjson.gz'])
+
+        rv = self.client_for(u1).get('/export_posts/def',
+                                     base_url='https://localhost')
+        self.assertEqual(rv.mimetype, 'application/gzip')
+        lines = gzip.decompress(rv.get_data()).decode('utf-8').splitlines()
+        rv.close()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'body': 'post {}'.format(i), 'timestamp': (
+                now + timedelta(seconds=i)).isoformat() + 'Z'}
+            for i in range(3)])
+        for user, name in ((u2, 'def'), (u1, 'abc'), (u1, '..')):
+            self.assertEqual(self.client_for(user).get(
+                '/export_posts/' + name,
+                base_url='https://localhost').status_code, 404)
+
+
+class TranslateConfig(TestConfig):
+    MS_TRANSLATOR_KEY = 'key'
+
+
+class TranslateCase(RedisCase):
+    config = TranslateConfig
+
+    def test_single_flight(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_translation(text, source_language, dest_language):
+            started.set()
+            release.wait(5)
+            return 'Bonjour'
+
+        results = []
+
+        def run():
+            with self.app.app_context():
+                results.append(translate('Hello', 'en', 'fr'))
+
+        with mock.patch('app.translate._request_translation',
+                        side_effect=slow_translation) as request:
+            threads = [threading.Thread(target=run) for _ in range(3)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual(results, ['Bonjour'] * 3)
+            # the others waited for the first one instead of calling again
+            self.assertEqual(request.call_count, 1)
+            self.assertEqual(self.app.translation_cache.stats()['coalesced'], 2)
+
+            # cached in Redis for the other processes
+            self.app.translation_cache.local = LRU(10, 60)
+            self.assertEqual(translate('Hello', 'en', 'fr'), 'Bonjour')
+            self.assertEqual(request.call_count, 1)
+
+    def test_translate_many(self):
+        def translations(texts, source_language, dest_language):
+            if source_language == 'de':
+                return None  # the translator failed
+            return [text.upper() for text in texts]
+
+        self.app.translation_cache.set(_cache_key('hola', 'es', 'fr'), 'SALUT')
+        with self.app.test_request_context(), \
+                mock.patch('app.translate._request_translations',
+                           side_effect=translations) as request:
+            results = translate_many(
+                [('hello', 'en'), ('hola', 'es'), ('bye', 'en'),
+                 ('hello', 'en'), ('hallo', 'de')], 'fr')
+        self.assertEqual(results[:4], ['HELLO', 'SALUT', 'BYE', 'HELLO'])
+        self.assertTrue(results[4].startswith('Error'))
+        # one call per source language, for the texts that weren't cached
+        calls = sorted((args[1], sorted(args[0]))
+                       for args, _ in request.call_args_list)
+        self.assertEqual(calls, [('de', ['hallo']), ('en', ['bye', 'hello'])])
+
+    def test_pretranslation(self):
+        self.app.config.update(PRETRANSLATE=True, PRETRANSLATE_MIN_FOLLOWERS=1,
+                               PRETRANSLATE_DAILY_CHARACTERS=20)
+        u1, u2 = self.add_users('john', 'susan')
+        self.assertFalse(Post.wants_pretranslation('es', u1))
+        u2.follow(u1)
+        db.session.commit()
+        self.assertTrue(Post.wants_pretranslation('es', u1))
+        self.assertFalse(Post.wants_pretranslation(None, u1))
+        self.app.config['PRETRANSLATE'] = False
+        self.assertFalse(Post.wants_pretranslation('es', u1))
+        self.app.config['PRETRANSLATE'] = True
+
+        p1 = Post(body='hola', language='es', author=u1)
+        p2 = Post(body='adios amigos', language='es', author=u1)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        with mock.patch('app.tasks.app', self.app), \
+                mock.patch('app.translate._request_translations_to',
+                           return_value={'en': 'hello', 'fr': 'salut'}) \
+                as request:
+            tasks.pretranslate_post(p1.id)
+            # already done
+            tasks.pretranslate_post(p1.id)
+            # 12 characters to 2 languages is more than the 12 left today
+            tasks.pretranslate_post(p2.id)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(request.call_args[0], ('hola', 'es', ['en', 'fr']))
+        # the refused post took nothing from the budget
+        self.assertEqual(int(self.app.redis.get('translate:budget:{:%Y-%m-%d}'
+                                                .format(datetime.utcnow()))), 8)
+        self.assertEqual(Translation.for_posts([p1, p2], 'fr'),
+                         {p1.id: 'salut'})
+        self.assertEqual(Translation.for_posts([p1], 'es'), {})
+
+        # the stored translation is in the page, no request needed
+        html = self.client_for(u2).get(
+            '/explore', base_url='https://localhost',
+            headers={'Accept-Language': 'en'}).get_data(as_text=True)
+        self.assertIn('data-text="hello"', html)
+
+
+class LanguageConfig(TestConfig):
+    LANGUAGE_DETECTION = 'async'
+
+
+class LanguageCase(RedisCase):
+    config = LanguageConfig
+
+    def test_detect(self):
+        # the same answers as guess_language, which it replaced
+        corpus = [
+            'Hello, how are you doing today? I hope the weather is nice.',
+            'Hola, ¿cómo estás? Espero que tengas un buen día.',
+            "Bonjour, comment allez-vous aujourd'hui? Il fait beau.",
+            'Guten Tag, wie geht es Ihnen heute? Das Wetter ist schön.',
+            'Olá, tudo bem com você? Espero que sim, meu amigo.',
+            'Ciao, come stai? Spero che tutto vada bene oggi.',
+            'Dit is een Nederlandse zin over het weer vandaag.',
+            'Привет, как дела? Надеюсь, у тебя всё хорошо.',
+            'مرحبا كيف حالك اليوم؟ أتمنى أن تكون بخير',
+            'नमस्ते, आप कैसे हैं? आशा है सब ठीक है।',
+            'Γεια σου, τι κάνεις;', 'こんにちは、元気ですか', '你好，今天怎么样',
+            '안녕하세요 잘 지내세요', 'hi', '', '12345 !!!']
+        for text in corpus:
+            expected = guess_language(text)
+            if expected == 'UNKNOWN' or len(expected) > 5:
+                expected = ''
+            self.assertEqual(detect(text), expected, text)
+
+    def test_detect_later(self):
+        u, = self.add_users('john')
+        p = Post(body='Hola, ¿cómo estás? Espero que tengas un buen día.',
+                 language=post_language('Hola'), author=u)
+        db.session.add(p)
+        db.session.commit()
+        self.assertIsNone(p.language)
+        job, = self.app.task_queue.jobs
+        self.assertEqual((job.func_name, job.args),
+                         ('app.tasks.detect_post_language', (p.id,)))
+        with mock.patch('app.tasks.app', self.app):
+            tasks.detect_post_language(p.id)
+        db.session.expire_all()
+        self.assertEqual(Post.query.get(p.id).language, 'es')
+
+
+class MailPoolConfig(TestConfig):
+    MAIL_WORKERS = 1
+
+
+class MailPoolCase(RedisCase):
+    config = MailPoolConfig
+
+    def test_bad_message(self):
+        pool = self.app.mail_pool
+        with mail.record_messages() as outbox:
+            # no recipients, which Flask-Mail refuses with an AssertionError
+            pool.submit(Message('bad', sender='a@example.com'))
+            pool.submit(Message('good', sender='a@example.com',
+                                recipients=['b@example.com']))
+            pool.stop()
+        # the thread lived on to send the next message
+        self.assertEqual([msg.subject for msg in outbox], ['good'])
+        stats = pool.stats()
+        self.assertEqual((stats['sent'], stats['failed']), (1, 1))
+
+
+class OutboxConfig(TestConfig):
+    MAIL_OUTBOX = True
+
+
+class OutboxCase(RedisCase):
+    config = OutboxConfig
+
+    def send(self, subject='Hi', text='Hello', recipients=('a@example.com',),
+             **kwargs):
+        send_email(subject, 'admin@example.com', list(recipients), text,
+                   '<p>{}</p>'.format(text), **kwargs)
+
+    def test_outbox(self):
+        self.send(recipients=['a@example.com', 'b@example.com',
+                              'a@example.com'])
+        self.send()  # still waiting, so not added again
+        self.assertEqual(QueuedEmail.query.count(), 2)
+        self.assertEqual(len(self.app.task_queue), 1)
+        ids = [email.id for email in QueuedEmail.query]
+        with mail.record_messages() as sent:
+            self.assertEqual(outbox.deliver(ids), 2)
+            self.assertEqual(outbox.deliver(ids), 0)
+        self.assertEqual(sorted(msg.recipients[0] for msg in sent),
+                         ['a@example.com', 'b@example.com'])
+        self.assertEqual({email.status for email in QueuedEmail.query},
+                         {'sent'})
+
+        # once sent, the same email can be sent again (e.g. a second export)
+        self.send()
+        self.assertEqual(QueuedEmail.query.filter_by(
+            status='pending').count(), 1)
+
+    def test_lost_race(self):
+        u, = self.add_users('john')
+        self.send()
+        db.session.expunge(QueuedEmail.query.one())
+        u.about_me = 'not committed yet'
+        # as if another request added it between the check and the insert
+        with mock.patch.object(db.session, 'query',
+                               return_value=mock.Mock(filter=lambda *a: [])):
+            self.send()
+        # only the email was rolled back
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(QueuedEmail.query.count(), 1)
+        self.assertEqual(User.query.get(u.id).about_me, 'not committed yet')
+
+    def test_digest(self):
+        self.send(subject='<b>New</b> follower', text='one', digest=True)
+        self.send(subject='Another', text='two', digest=True)
+        self.assertEqual(len(self.app.task_queue), 0)
+        outbox.digest('a@example.com')
+        combined = QueuedEmail.query.filter_by(digest=False).one()
+        self.assertEqual(combined.subject, 'Microblog: 2 updates')
+        self.assertIn('<h3>&lt;b&gt;New&lt;/b&gt; follower</h3><p>one</p>',
+                      combined.html_body)
+        self.assertEqual(QueuedEmail.query.filter_by(
+            status='digested').count(), 2)
+        self.assertEqual(len(self.app.task_queue), 1)
+
+
+class APICase(RedisCase):
+    def setUp(self):
+        super().setUp()
+        self.users = self.add_users('john', 'susan', 'mary', 'david')
+        self.token = self.users[0].get_token()
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def api(self, method, url, json=None, etag=None):
+        headers = {'Authorization': 'Bearer ' + self.token}
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client.open(url, method=method, json=json,
+                                headers=headers)
+
+    def test_collection_pages(self):
+        self.users += self.add_users('linda', 'paul', 'anne')
+        ids = sorted(u.id for u in self.users)
+        seen, url = [], '/api/users?limit=3'
+        while url:
+            data = self.api('GET', url).get_json()
+            self.assertEqual(data['_meta']['total_items'], 7)
+            self.assertLessEqual(len(data['items']), 3)
+            seen += [user['id'] for user in data['items']]
+            url = data['_links']['next']
+        self.assertEqual(seen, ids)
+        self.assertEqual(self.api('GET', '/api/users?cursor=' + encode_key(
+            ['john'])).status_code, 400)
+        # a cursor that doesn't decode is a bad request too, but a page that
+        # doesn't exist in the views
+        self.assertEqual(self.api('GET', '/api/users?cursor=garbage!')
+                         .status_code, 400)
+        for url in ('/explore?before=garbage!', '/search?q=x&after=garbage!'):
+            self.assertEqual(self.client_for(self.users[0]).get(
+                url, base_url='https://localhost').status_code, 404)
+        self.assertEqual(self.api('GET', '/api/users?limit=0').status_code,
+                         400)
+
+        self.app.config['API_STREAM_BATCH_SIZE'] = 2
+        rv = self.client.get('/api/users', headers={
+            'Authorization': 'Bearer ' + self.token,
+            'Accept': 'application/x-ndjson'})
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in
+                          rv.data.decode('utf-8').splitlines()], ids)
+
+    def test_fields(self):
+        self.users[1].follow(self.users[0])
+        db.session.commit()
+        data = self.api('GET', '/api/users/{}?fields=username,follower_count'
+                        .format(self.users[0].id)).get_json()
+        self.assertEqual(data, {'id': self.users[0].id, 'username': 'john',
+                                'follower_count': 1})
+        data = self.api('GET', '/api/users?fields=username&limit=2').get_json()
+        self.assertEqual([sorted(user) for user in data['items']],
+                         [['id', 'username']] * 2)
+        self.assertIn('fields=username', data['_links']['next'])
+        rv = self.api('GET', '/api/users?fields=username,password_hash')
+        self.assertEqual(rv.status_code, 400)
+
+        # one query for the page, reading only the columns it needs
+        db.session.expire_all()
+        statements = self.statements()
+        self.api('GET', '/api/users?fields=post_count&limit=10')
+        pages = [s for s in statements if s.startswith('SELECT user.id') and
+                 'user.token =' not in s]
+        self.assertEqual(len(pages), 1)
+        self.assertNotIn('user.about_me', pages[0])
+
+    def test_conditional_get(self):
+        u = self.users[1]
+        rv = self.api('GET', '/api/users/{}'.format(u.id))
+        etag = rv.headers['ETag']
+        self.assertIsNotNone(rv.last_modified)
+        rv = self.api('GET', '/api/users/{}'.format(u.id), etag=etag)
+        self.assertEqual((rv.status_code, rv.data), (304, b''))
+        # ?fields= is another representation, with its own ETag
+        rv = self.api('GET', '/api/users/{}?fields=username'.format(u.id),
+                      etag=etag)
+        self.assertEqual(rv.status_code, 200)
+
+        u.about_me = 'changed'
+        db.session.commit()
+        rv = self.api('GET', '/api/users/{}'.format(u.id), etag=etag)
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+        # a page of a collection changes with its users and its total
+        rv = self.api('GET', '/api/users?limit=2')
+        etag = rv.headers['ETag']
+        self.assertEqual(self.api('GET', '/api/users?limit=2',
+                                  etag=etag).status_code, 304)
+        self.add_users('linda')
+        self.assertEqual(self.api('GET', '/api/users?limit=2',
+                                  etag=etag).status_code, 200)
+        self.users[2].follow(self.users[0])
+        db.session.commit()
+        rv = self.api('GET', '/api/users/{}/followers'.format(
+            self.users[0].id))
+        etag = rv.headers['ETag']
+        self.users[3].follow(self.users[0])
+        db.session.commit()
+        self.assertEqual(self.api('GET', '/api/users/{}/followers'.format(
+            self.users[0].id), etag=etag).status_code, 200)
+
+    def test_stream_doesnt_count(self):
+        statements = self.statements()
+        rv = self.api('GET', '/api/users?format=ndjson')
+        self.assertEqual(len(rv.data.splitlines()), 4)
+        self.assertFalse([s for s in statements if 'count(' in s.lower()])
+
+    def test_lookup(self):
+        john, susan, mary, david = self.users
+        url = '/api/users?ids={},999,{}&fields=username'
+        data = self.api('GET', url.format(mary.id, john.id)).get_json()
+        self.assertEqual([u['username'] for u in data['items']],
+                         ['mary', 'john'])
+        self.assertEqual(data['_meta']['missing'], [999])
+        self.assertEqual(self.api('GET', '/api/users?ids=1,x').status_code,
+                         400)
+
+    def test_create_posts(self):
+        john = self.users[0]
+        rv = self.api('POST', '/api/posts', {'posts': [
+            {'body': 'one'}, {'body': ''}, 'two', {'body': 'three'}]})
+        results = rv.get_json()['results']
+        self.assertEqual([r['status'] for r in results], [201, 400, 400, 201])
+        self.assertEqual(Post.query.get(results[0]['id']).body, 'one')
+        self.assertEqual(Post.query.get(results[3]['id']).body, 'three')
+        db.session.expire_all()
+        self.assertEqual(john.post_count, 2)
+        self.assertEqual(self.api('POST', '/api/posts', {'posts': []})
+                         .status_code, 400)
+
+    def test_create_many_posts(self):
+        statements = self.statements()
+        bodies = ['post {}'.format(i) for i in range(450)]
+        rv = self.api('POST', '/api/posts', {'posts': [
+            {'body': body} for body in bodies]})
+        ids = [result['id'] for result in rv.get_json()['results']]
+        self.assertEqual([Post.query.get(id).body for id in ids], bodies)
+        inserts = [s for s in statements if s.startswith('INSERT INTO post')]
+        self.assertEqual(len(inserts), 3)  # 200 + 200 + 50
+
+    def test_follow_users(self):
+        john, susan, mary, david = self.users
+        john.follow(susan)
+        db.session.commit()
+        url = '/api/users/{}/following'.format(john.id)
+        rv = self.api('POST', url, {'user_ids': [
+            susan.id, mary.id, 999, john.id, mary.id]})
+        self.assertEqual([r['status'] for r in rv.get_json()['results']],
+                         [200, 201, 404, 400, 200])
+        db.session.expire_all()
+        self.assertTrue(john.is_following(mary))
+        self.assertEqual(john.following_count, 2)
+        for ids in ([[david.id]], [True], [david.id, '3'], []):
+            self.assertEqual(self.api('POST', url, {'user_ids': ids})
+                             .status_code, 400)
+        self.assertFalse(john.is_following(david))
+        self.assertEqual(self.api('POST', '/api/users/{}/following'.format(
+            susan.id), {'user_ids': [david.id]}).status_code, 400)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 